@@ -1,16 +1,34 @@
 ﻿-- PostgreSQL schema (run as the turion DB user)
 
+-- Partitioned by month on created_at. Monthly partitions are created ahead of
+-- time by the agent (or `turion memory partitions ensure`); rows outside them
+-- fall into the default partition. Existing installs with the old
+-- unpartitioned table: `turion memory partitions migrate`.
 create table if not exists memory_items (
-  id uuid primary key,
+  id uuid not null,
   user_id text not null,
   role text not null,
   text text not null,
   tags text[] default '{}',
-  created_at timestamptz default now()
-);
+  created_at timestamptz not null default now(),
+  primary key (id, created_at)
+) partition by range (created_at);
+
+-- Skipped while memory_items is still the old unpartitioned table, so this
+-- file can be re-applied before migrating.
+do $$
+begin
+  if exists (select 1 from pg_class where relname = 'memory_items' and relkind = 'p') then
+    create table if not exists memory_items_default partition of memory_items default;
+  end if;
+end
+$$;
 
-create index if not exists memory_items_user_id_created_at
-  on memory_items (user_id, created_at desc);
+-- Serves get_recent and the (created_at, id) keyset paging in iter_history.
+create index if not exists memory_items_user_created_id
+  on memory_items (user_id, created_at desc, id desc);
+-- Replaced by the index above; older installs still carry it.
+drop index if exists memory_items_user_id_created_at;
 
 create table if not exists user_profiles (
   user_id text primary key,
@@ -18,5 +36,11 @@ create table if not exists user_profiles (
   preferences text,
   style text,
   language text,
-  updated_at timestamptz default now()
+  updated_at timestamptz default now(),
+  -- (created_at, id) of the last message profile maintenance processed.
+  watermark_at timestamptz,
+  watermark_id uuid
 );
+
+alter table user_profiles add column if not exists watermark_at timestamptz;
+alter table user_profiles add column if not exists watermark_id uuid;
@@ -7,9 +7,11 @@ import makeWASocket, {
 import pino from "pino";
 import fs from "fs";
 import path from "path";
+import crypto from "crypto";
 
 const PORT = process.env.PORT || 3001;
 const API_KEY = process.env.API_KEY || "";
+const BACKLOG_SIZE = Number(process.env.BACKLOG_SIZE || 1000);
 
 const app = express();
 app.use(express.json());
@@ -28,7 +30,20 @@ const server = app.listen(PORT, () => {
 const wss = new WebSocketServer({ server, path: "/events" });
 const clients = new Set();
 
-wss.on("connection", (ws) => {
+// Message events are numbered and kept in a ring buffer so a client that
+// reconnects with ?boot=&since= gets what it missed while it was away.
+const BOOT_ID = crypto.randomUUID();
+let seq = 0;
+const backlog = [];
+
+wss.on("connection", (ws, req) => {
+  const params = new URL(req.url, "http://localhost").searchParams;
+  const since = params.get("boot") === BOOT_ID ? Number(params.get("since") || 0) : 0;
+  if (params.has("since")) {
+    for (const event of backlog) {
+      if (event.seq > since) ws.send(JSON.stringify(event));
+    }
+  }
   clients.add(ws);
   ws.on("close", () => clients.delete(ws));
 });
@@ -44,6 +59,16 @@ function broadcast(event) {
   }
 }
 
+// Baileys only reports presence for chats it subscribed to; subscribe on a
+// chat's first message (and again after a reconnect).
+const presenceSubscribed = new Set();
+
+function subscribePresence(jid) {
+  if (!jid || presenceSubscribed.has(jid)) return;
+  presenceSubscribed.add(jid);
+  sock.presenceSubscribe(jid).catch(() => presenceSubscribed.delete(jid));
+}
+
 const logger = pino({ level: "info" });
 let sock;
 let currentQR = null;
@@ -76,22 +101,37 @@ async function startSocket() {
 
     if (update.connection === "close") {
       currentStatus = "disconnected";
+      presenceSubscribed.clear();
       currentQR = null;
       broadcast({ type: "status", data: "disconnected" });
       startSocket().catch(() => {});
     }
   });
 
+  // Typing indicators let the agent warm a user's context before the
+  // message lands. They are ephemeral, so they skip the backlog.
+  sock.ev.on("presence.update", ({ id, presences }) => {
+    for (const [participant, presence] of Object.entries(presences || {})) {
+      const state = presence?.lastKnownPresence;
+      if (state !== "composing" && state !== "recording") continue;
+      broadcast({ type: "presence", from: id, participant, state });
+    }
+  });
+
   sock.ev.on("messages.upsert", async ({ messages }) => {
     for (const msg of messages) {
       if (!msg.message || msg.key.fromMe) continue;
       const from = msg.key.remoteJid || "";
+      subscribePresence(from);
       const text =
         msg.message.conversation ||
         msg.message.extendedTextMessage?.text ||
         "";
       if (!text) continue;
-      broadcast({ type: "message", from, text });
+      const event = { type: "message", id: msg.key.id, from, text, boot: BOOT_ID, seq: ++seq };
+      backlog.push(event);
+      if (backlog.length > BACKLOG_SIZE) backlog.shift();
+      broadcast(event);
     }
   });
 }
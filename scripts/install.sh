@@ -166,6 +166,14 @@ fi
 
 (cd "$GATEWAY_DIR" && npm install)
 
+# Members of this group may use turion (the daemon socket is 0660).
+CONTROL_GROUP=$(grep -E '^CONTROL_GROUP=' "$APP_DIR/.env" | cut -d'=' -f2-)
+CONTROL_GROUP=${CONTROL_GROUP:-turion}
+groupadd -f "$CONTROL_GROUP"
+if [[ -n "${SUDO_USER:-}" && "$SUDO_USER" != "root" ]]; then
+  usermod -aG "$CONTROL_GROUP" "$SUDO_USER"
+fi
+
 cp scripts/bot-ai.service "$SERVICE_FILE"
 cp scripts/bot-ai-gateway.service "$GATEWAY_SERVICE_FILE"
 
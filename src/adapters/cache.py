@@ -0,0 +1,183 @@
+﻿from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+
+from adapters.grok import LLMClient, LLMRequest, LLMResponse
+from core.metrics import metrics
+
+# Workers share the file; a writer holding it longer than this is treated
+# as a cache miss rather than failing the turn.
+BUSY_TIMEOUT_SEC = 2.0
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split())
+
+
+def request_key(req: LLMRequest) -> str:
+    # Whitespace-only differences must not defeat the cache.
+    raw = json.dumps(
+        [_normalize(req.system), _normalize(req.context), _normalize(req.user), req.max_tokens],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    writes: int = 0
+    evictions: int = 0
+    size: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class ResponseCache:
+    def __init__(self, path: str | Path, ttl_sec: int = 259200, max_entries: int = 5000) -> None:
+        self.path = Path(path)
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(
+            str(self.path), timeout=BUSY_TIMEOUT_SEC, check_same_thread=False, isolation_level=None
+        )
+        self._db.execute("pragma journal_mode=wal")
+        self._db.execute("pragma synchronous=normal")
+        self._db.execute(
+            """
+            create table if not exists responses (
+                key text primary key,
+                text text not null,
+                confidence real not null,
+                created_at real not null,
+                accessed_at real not null
+            )
+            """
+        )
+        self._db.execute("create index if not exists responses_accessed_at on responses (accessed_at)")
+        self._db.execute("delete from responses where created_at < ?", (time.time() - self.ttl_sec,))
+        self.stats.size = int(self._db.execute("select count(*) from responses").fetchone()[0])
+
+    def get(self, key: str) -> LLMResponse | None:
+        try:
+            return self._get(key)
+        except sqlite3.Error as exc:
+            self._failed("get", exc)
+            self.stats.misses += 1
+            return None
+
+    def _get(self, key: str) -> LLMResponse | None:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "select text, confidence, created_at from responses where key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                self.stats.misses += 1
+                return None
+            if now - row[2] > self.ttl_sec:
+                self._db.execute("delete from responses where key = ?", (key,))
+                self.stats.size -= 1
+                self.stats.misses += 1
+                return None
+            self._db.execute("update responses set accessed_at = ? where key = ?", (now, key))
+            self.stats.hits += 1
+        return LLMResponse(text=row[0], confidence=float(row[1]))
+
+    def put(self, key: str, response: LLMResponse) -> None:
+        try:
+            self._put(key, response)
+        except sqlite3.Error as exc:
+            self._failed("put", exc)
+
+    def _failed(self, op: str, exc: sqlite3.Error) -> None:
+        # Locked or broken database: the turn goes on without the cache.
+        metrics.incr("llm_cache_errors")
+        print(f"[cache] {op} falhou: {exc}")
+
+    def _put(self, key: str, response: LLMResponse) -> None:
+        now = time.time()
+        with self._lock:
+            existed = self._db.execute("select 1 from responses where key = ?", (key,)).fetchone()
+            self._db.execute(
+                """
+                insert or replace into responses (key, text, confidence, created_at, accessed_at)
+                values (?, ?, ?, ?, ?)
+                """,
+                (key, response.text, response.confidence, now, now),
+            )
+            self.stats.writes += 1
+            if not existed:
+                self.stats.size += 1
+            if self.stats.size > self.max_entries:
+                self._evict(self.stats.size - self.max_entries)
+
+    def _evict(self, excess: int) -> None:
+        # Least recently used first; expired rows go in the same pass.
+        cur = self._db.execute(
+            """
+            delete from responses where key in (
+                select key from responses order by accessed_at asc limit ?
+            ) or created_at < ?
+            """,
+            (excess, time.time() - self.ttl_sec),
+        )
+        self.stats.evictions += cur.rowcount
+        self.stats.size -= cur.rowcount
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("delete from responses")
+            self.stats.size = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+@dataclass
+class CachedLLM:
+    client: LLMClient
+    cache: ResponseCache
+
+    def generate(self, req: LLMRequest) -> LLMResponse:
+        if not req.cache:
+            return self.client.generate(req)
+        key = request_key(req)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        response = self.client.generate(req)
+        if response.text.strip():
+            self.cache.put(key, response)
+        return response
+
+    def stream(self, req: LLMRequest) -> Iterator[str]:
+        key = request_key(req) if req.cache else None
+        cached = self.cache.get(key) if key else None
+        if cached is not None:
+            yield cached.text
+            return
+        parts = []
+        for delta in self.client.stream(req):
+            parts.append(delta)
+            yield delta
+        text = "".join(parts)
+        if key and text.strip():
+            self.cache.put(key, LLMResponse(text=text))
@@ -1,8 +1,9 @@
 ﻿from __future__ import annotations
 
+import json
+import time
 from dataclasses import dataclass
-
-import requests
+from typing import Iterator, Protocol
 
 
 @dataclass
@@ -11,29 +12,93 @@ class LLMRequest:
     user: str
     context: str
     max_tokens: int = 2000
+    cache: bool = True
+    # Identity of a byte-stable system prefix; providers with prompt caching
+    # use it to route repeat prefixes to the same cache.
+    prefix_key: str | None = None
+    # What is left of the turn's deadline; None waits the default 30s.
+    timeout_sec: float | None = None
 
 
 @dataclass
 class LLMResponse:
     text: str
     confidence: float = 0.5
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+
+
+class LLMClient(Protocol):
+    def generate(self, req: LLMRequest) -> LLMResponse: ...
+
+
+class StreamingLLMClient(LLMClient, Protocol):
+    # Yields the reply text in pieces as the provider produces it.
+    def stream(self, req: LLMRequest) -> Iterator[str]: ...
 
 
 @dataclass
 class GrokClient:
     api_base: str
     api_key: str
+    model: str | None = None
 
-    def generate(self, req: LLMRequest) -> LLMResponse:
+    def _request(self, req: LLMRequest) -> tuple[dict, dict]:
         # Generic JSON API; update for your Grok endpoint when ready.
+        # Field order matters to prefix caches: stable system first, then the
+        # per-turn context, then the message.
         payload = {
             "system": req.system,
-            "user": req.user,
             "context": req.context,
+            "user": req.user,
             "max_tokens": req.max_tokens,
         }
+        if self.model:
+            payload["model"] = self.model
         headers = {"authorization": f"Bearer {self.api_key}"}
-        resp = requests.post(self.api_base, json=payload, headers=headers, timeout=30)
+        if req.prefix_key:
+            payload["prompt_cache_key"] = req.prefix_key
+            headers["x-grok-conv-id"] = req.prefix_key
+        return payload, headers
+
+    def generate(self, req: LLMRequest) -> LLMResponse:
+        import requests
+
+        payload, headers = self._request(req)
+        resp = requests.post(self.api_base, json=payload, headers=headers, timeout=req.timeout_sec or 30)
         resp.raise_for_status()
         data = resp.json()
-        return LLMResponse(text=data.get("text", ""), confidence=float(data.get("confidence", 0.5)))
+        usage = data.get("usage") or {}
+        return LLMResponse(
+            text=data.get("text", ""),
+            confidence=float(data.get("confidence", 0.5)),
+            prompt_tokens=int(usage.get("prompt_tokens", 0) or 0),
+            cached_tokens=int((usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0) or 0),
+        )
+
+    def stream(self, req: LLMRequest) -> Iterator[str]:
+        import requests
+
+        # Server-sent events: "data: {"text": "..."}" lines, ending in [DONE].
+        payload, headers = self._request(req)
+        payload["stream"] = True
+        # The requests timeout bounds each read; the deadline bounds the whole
+        # stream. Both surface as TimeoutError.
+        timeout = req.timeout_sec or 30
+        deadline = time.monotonic() + timeout
+        try:
+            with requests.post(self.api_base, json=payload, headers=headers, timeout=timeout, stream=True) as resp:
+                resp.raise_for_status()
+                for line in resp.iter_lines(decode_unicode=True):
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"stream excedeu {timeout:.1f}s")
+                    if not line or not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        return
+                    delta = json.loads(data).get("text", "")
+                    if delta:
+                        yield delta
+        except requests.Timeout as exc:
+            raise TimeoutError(f"stream sem resposta em {timeout:.1f}s") from exc
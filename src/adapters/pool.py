@@ -0,0 +1,240 @@
+﻿from __future__ import annotations
+
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field, replace
+from typing import Iterator
+
+from adapters.grok import LLMClient, LLMRequest, LLMResponse
+from core.metrics import metrics
+
+
+@dataclass
+class Endpoint:
+    name: str
+    client: LLMClient
+    weight: float = 1.0
+    ewma_ms: float | None = None
+    error_rate: float = 0.0
+    requests: int = 0
+    errors: int = 0
+    down_until: float = 0.0
+    _latencies: deque = field(default_factory=lambda: deque(maxlen=256), repr=False)
+
+    def p95_ms(self) -> float | None:
+        if len(self._latencies) < 20:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+
+class ProviderPool:
+    # Routes each request to the endpoint with the best latency/weight/error
+    # score (EWMA on both). With hedging on, a duplicate goes to the runner-up
+    # once the primary exceeds its own p95; the first good answer wins and the
+    # loser only feeds the statistics. Errors fail over to the next endpoint.
+    def __init__(
+        self,
+        endpoints: list[Endpoint],
+        hedge: bool = True,
+        hedge_min_ms: float = 150.0,
+        alpha: float = 0.2,
+        max_error_rate: float = 0.5,
+        cooldown_sec: float = 30.0,
+        explore: float = 0.05,
+    ) -> None:
+        if not endpoints:
+            raise ValueError("ProviderPool precisa de ao menos um endpoint")
+        self.endpoints = endpoints
+        self.hedge = hedge and len(endpoints) > 1
+        self.hedge_min_ms = hedge_min_ms
+        self.alpha = alpha
+        self.max_error_rate = max_error_rate
+        self.cooldown_sec = cooldown_sec
+        self.explore = explore
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=4 * len(endpoints), thread_name_prefix="llm-pool")
+        # generate() calls in flight; close() waits for them to drain.
+        self._active = 0
+        self._closing = False
+
+    def _score(self, ep: Endpoint, prior_ms: float) -> float:
+        latency = ep.ewma_ms if ep.ewma_ms is not None else prior_ms
+        return latency * (1.0 + 4.0 * ep.error_rate) / max(ep.weight, 1e-6)
+
+    def _ranked(self, exclude: set[str] = frozenset()) -> list[Endpoint]:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [ep for ep in self.endpoints if ep.name not in exclude]
+            known = [ep.ewma_ms for ep in candidates if ep.ewma_ms is not None]
+            # Unmeasured endpoints look as good as the best one so they get tried.
+            prior = min(known) if known else 1000.0
+            healthy = [ep for ep in candidates if ep.down_until <= now]
+            ranked = sorted(healthy or candidates, key=lambda ep: self._score(ep, prior))
+        if len(ranked) > 1 and random.random() < self.explore:
+            # Occasional weighted pick keeps the statistics of the others fresh.
+            pick = random.choices(ranked, weights=[ep.weight for ep in ranked])[0]
+            ranked.remove(pick)
+            ranked.insert(0, pick)
+        return ranked
+
+    def _record(self, ep: Endpoint, elapsed_ms: float, failed: bool) -> None:
+        with self._lock:
+            ep.requests += 1
+            ep.error_rate = (1 - self.alpha) * ep.error_rate + self.alpha * (1.0 if failed else 0.0)
+            if failed:
+                ep.errors += 1
+                if ep.error_rate >= self.max_error_rate:
+                    ep.down_until = time.monotonic() + self.cooldown_sec
+                return
+            ep.ewma_ms = elapsed_ms if ep.ewma_ms is None else (1 - self.alpha) * ep.ewma_ms + self.alpha * elapsed_ms
+            ep._latencies.append(elapsed_ms)
+
+    def _call(self, ep: Endpoint, req: LLMRequest) -> LLMResponse:
+        started = time.perf_counter()
+        try:
+            resp = ep.client.generate(req)
+        except Exception:
+            self._record(ep, (time.perf_counter() - started) * 1000, failed=True)
+            raise
+        self._record(ep, (time.perf_counter() - started) * 1000, failed=False)
+        return resp
+
+    def _hedge_delay_sec(self, ep: Endpoint) -> float | None:
+        if not self.hedge:
+            return None
+        p95 = ep.p95_ms()
+        if p95 is None:
+            return None
+        return max(p95, self.hedge_min_ms) / 1000
+
+    def generate(self, req: LLMRequest) -> LLMResponse:
+        with self._lock:
+            self._active += 1
+        try:
+            return self._generate(req)
+        finally:
+            with self._lock:
+                self._active -= 1
+                drained = self._closing and self._active == 0
+            if drained:
+                self._executor.shutdown(wait=False)
+
+    def _generate(self, req: LLMRequest) -> LLMResponse:
+        ranked = self._ranked()
+        tried: set[str] = set()
+        last_exc: Exception | None = None
+        running: dict[Future, Endpoint] = {}
+
+        def launch(ep: Endpoint) -> None:
+            tried.add(ep.name)
+            running[self._executor.submit(self._call, ep, req)] = ep
+
+        def next_endpoint() -> Endpoint | None:
+            for ep in ranked:
+                if ep.name not in tried:
+                    return ep
+            return None
+
+        launch(ranked[0])
+        delay = self._hedge_delay_sec(ranked[0])
+        hedged = False
+        deadline = time.monotonic() + req.timeout_sec if req.timeout_sec else None
+        while running:
+            timeout = delay if not hedged and delay is not None else None
+            if deadline is not None:
+                left = max(deadline - time.monotonic(), 0.0)
+                timeout = left if timeout is None else min(timeout, left)
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done and deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"LLM sem resposta em {req.timeout_sec:.1f}s")
+            if not done:
+                spare = next_endpoint()
+                hedged = True
+                if spare is not None:
+                    metrics.incr("llm_hedged")
+                    launch(spare)
+                continue
+            for future in done:
+                ep = running.pop(future)
+                exc = future.exception()
+                if exc is None:
+                    if hedged and ep.name != ranked[0].name:
+                        metrics.incr("llm_hedge_won")
+                    return future.result()
+                last_exc = exc
+            if not running:
+                spare = next_endpoint()
+                if spare is not None:
+                    metrics.incr("llm_failover")
+                    launch(spare)
+        assert last_exc is not None
+        raise last_exc
+
+    def stream(self, req: LLMRequest) -> Iterator[str]:
+        # No hedging: pieces already delivered cannot be taken back. An
+        # endpoint that fails before its first piece fails over to the next,
+        # with whatever is left of req.timeout_sec.
+        last_exc: Exception | None = None
+        deadline = time.monotonic() + req.timeout_sec if req.timeout_sec else None
+        for ep in self._ranked():
+            attempt = req
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise TimeoutError(f"LLM sem resposta em {req.timeout_sec:.1f}s")
+                attempt = replace(req, timeout_sec=left)
+            started = time.perf_counter()
+            delivered = False
+            try:
+                for delta in ep.client.stream(attempt):
+                    delivered = True
+                    yield delta
+            except Exception as exc:
+                self._record(ep, (time.perf_counter() - started) * 1000, failed=True)
+                if delivered:
+                    raise
+                last_exc = exc
+                metrics.incr("llm_failover")
+                continue
+            self._record(ep, (time.perf_counter() - started) * 1000, failed=False)
+            return
+        assert last_exc is not None
+        raise last_exc
+
+    def stats(self) -> list[dict]:
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "name": ep.name,
+                    "weight": ep.weight,
+                    "ewma_ms": round(ep.ewma_ms, 1) if ep.ewma_ms is not None else None,
+                    "p95_ms": round(ep.p95_ms(), 1) if ep.p95_ms() is not None else None,
+                    "error_rate": round(ep.error_rate, 4),
+                    "requests": ep.requests,
+                    "errors": ep.errors,
+                    "healthy": ep.down_until <= now,
+                }
+                for ep in self.endpoints
+            ]
+
+    def close(self) -> None:
+        # A settings reload can close the pool mid-turn; submit() after
+        # shutdown raises, so in-flight calls (and their hedges or failovers)
+        # finish first and the last one shuts the executor down.
+        with self._lock:
+            self._closing = True
+            drained = self._active == 0
+        if drained:
+            self._executor.shutdown(wait=False)
+
+
+def find_pool(client: object) -> ProviderPool | None:
+    # The pool sits under the recording/caching wrappers, each holding .client.
+    while client is not None and not isinstance(client, ProviderPool):
+        client = getattr(client, "client", None)
+    return client
@@ -9,6 +9,17 @@ class InboundMessage:
     channel: str
     sender: str
     text: str
+    # Event log offset; set when the message must be reported done (see
+    # WhatsAppGateway.done) before the log may move past it.
+    offset: int | None = None
+
+
+@dataclass
+class PresenceEvent:
+    # The sender started typing ("composing") or recording audio.
+    channel: str
+    sender: str
+    state: str
 
 
 class Channel(ABC):
@@ -0,0 +1,206 @@
+﻿from __future__ import annotations
+
+import bisect
+import json
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, BinaryIO
+
+# Append-only log of inbound events. Each segment is a file of JSON lines named
+# after the offset of its first record; a record's offset is its position in the
+# log. Consumers commit the next offset they want, so a restart resumes there.
+
+
+class EventLog:
+    def __init__(
+        self,
+        directory: str | Path,
+        segment_bytes: int = 8 * 1024 * 1024,
+        fsync_batch: int = 64,
+        fsync_interval_sec: float = 0.05,
+        tail_size: int = 1024,
+    ) -> None:
+        self.dir = Path(directory)
+        self.segment_bytes = segment_bytes
+        self.fsync_batch = fsync_batch
+        self.fsync_interval_sec = fsync_interval_sec
+        self.tail: deque[dict[str, Any]] = deque(maxlen=tail_size)
+        (self.dir / "consumers").mkdir(parents=True, exist_ok=True)
+
+        self._cond = threading.Condition()
+        self._committed: dict[str, int] = {}
+        self._segments = sorted(int(p.stem) for p in self.dir.glob("*.log")) or [0]
+        self._next_offset = self._recover()
+        self._fh = open(self._segment_path(self._segments[-1]), "ab")
+        self._pending = 0
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def _segment_path(self, base: int) -> Path:
+        return self.dir / f"{base:020d}.log"
+
+    def _recover(self) -> int:
+        base = self._segments[-1]
+        path = self._segment_path(base)
+        if not path.exists():
+            return base
+        count = 0
+        good = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    break
+                good += len(line)
+                count += 1
+                self.tail.append(event)
+        if good < path.stat().st_size:
+            # Torn write from a crash: drop the partial record.
+            with open(path, "r+b") as f:
+                f.truncate(good)
+        return base + count
+
+    @property
+    def next_offset(self) -> int:
+        with self._cond:
+            return self._next_offset
+
+    def append(self, event: dict[str, Any]) -> int:
+        line = json.dumps(event, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+        with self._cond:
+            if self._fh.tell() > 0 and self._fh.tell() + len(line) > self.segment_bytes:
+                self._roll()
+            self._fh.write(line)
+            self._fh.flush()
+            offset = self._next_offset
+            self._next_offset += 1
+            self.tail.append(event)
+            self._pending += 1
+            if self._pending >= self.fsync_batch:
+                self._sync()
+            self._cond.notify_all()
+        return offset
+
+    def _sync(self) -> None:
+        os.fsync(self._fh.fileno())
+        self._pending = 0
+
+    def _roll(self) -> None:
+        self._sync()
+        self._fh.close()
+        self._segments.append(self._next_offset)
+        self._fh = open(self._segment_path(self._next_offset), "ab")
+        self._prune()
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(self.fsync_interval_sec)
+            with self._cond:
+                if self._closed:
+                    return
+                if self._pending:
+                    self._sync()
+
+    def committed(self, consumer: str) -> int:
+        with self._cond:
+            if consumer not in self._committed:
+                path = self.dir / "consumers" / f"{consumer}.offset"
+                try:
+                    self._committed[consumer] = int(path.read_text().strip() or "0")
+                except (FileNotFoundError, ValueError):
+                    self._committed[consumer] = self._segments[0]
+            return self._committed[consumer]
+
+    def ack(self, consumer: str, next_offset: int) -> None:
+        path = self.dir / "consumers" / f"{consumer}.offset"
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(str(next_offset))
+        os.replace(tmp, path)
+        with self._cond:
+            self._committed[consumer] = next_offset
+
+    def lag(self, consumer: str) -> int:
+        return self.next_offset - self.committed(consumer)
+
+    def _prune(self) -> None:
+        # Segments every consumer has moved past are no longer needed.
+        names = {p.stem for p in (self.dir / "consumers").glob("*.offset")}
+        if not names:
+            return
+        floor = min(self._committed.get(n, self._read_committed(n)) for n in names)
+        while len(self._segments) > 1 and self._segments[1] <= floor:
+            self._segment_path(self._segments.pop(0)).unlink(missing_ok=True)
+
+    def _read_committed(self, consumer: str) -> int:
+        try:
+            return int((self.dir / "consumers" / f"{consumer}.offset").read_text().strip() or "0")
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def reader(self, consumer: str) -> LogReader:
+        return LogReader(self, self.committed(consumer))
+
+    def close(self) -> None:
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._sync()
+            self._fh.close()
+            self._cond.notify_all()
+
+
+class LogReader:
+    def __init__(self, log: EventLog, offset: int) -> None:
+        self.log = log
+        self.offset = offset
+        self._fh: BinaryIO | None = None
+        self._base: int | None = None
+
+    def _open_for(self, offset: int) -> None:
+        segments = self.log._segments
+        idx = max(bisect.bisect_right(segments, offset) - 1, 0)
+        base = segments[idx]
+        if base == self._base and self._fh is not None:
+            return
+        if self._fh is not None:
+            self._fh.close()
+        self._fh = open(self.log._segment_path(base), "rb")
+        self._base = base
+        for _ in range(max(offset - base, 0)):
+            self._fh.readline()
+
+    def poll(self, max_records: int = 256, timeout: float = 1.0) -> list[tuple[int, dict[str, Any]]]:
+        with self.log._cond:
+            if self.log._next_offset <= self.offset and not self.log._closed:
+                self.log._cond.wait(timeout)
+            available = self.log._next_offset - self.offset
+            if available <= 0:
+                return []
+            self._open_for(self.offset)
+        records: list[tuple[int, dict[str, Any]]] = []
+        while len(records) < min(max_records, available):
+            assert self._fh is not None
+            line = self._fh.readline()
+            if not line:
+                # End of this segment; the next one starts at our offset.
+                with self.log._cond:
+                    self._open_for(self.offset)
+                line = self._fh.readline()
+                if not line:
+                    break
+            records.append((self.offset, json.loads(line)))
+            self.offset += 1
+        return records
+
+    def close(self) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
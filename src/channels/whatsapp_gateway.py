@@ -3,36 +3,82 @@
 import json
 import threading
 import time
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Callable
+from typing import Any, Callable
+from urllib.parse import urlencode
 
-import requests
-import websockets
+from channels.base import Channel, InboundMessage, PresenceEvent
+from channels.event_log import EventLog
 
-from channels.base import Channel, InboundMessage
+CONSUMER = "agent"
+# A turn that fails is delivered again this many times in total, then dropped
+# (and acked) so one bad event cannot block the log.
+MAX_ATTEMPTS = 3
 
 
 @dataclass
 class WhatsAppConfig:
     gateway_url: str
     api_key: str | None = None
+    event_log_dir: str | None = None
+    record_path: str | None = None
 
 
 class WhatsAppGateway(Channel):
-    def __init__(self, config: WhatsAppConfig, on_message: Callable[[InboundMessage], None] | None = None) -> None:
+    def __init__(
+        self,
+        config: WhatsAppConfig,
+        on_message: Callable[[InboundMessage], None] | None = None,
+        on_presence: Callable[[PresenceEvent], None] | None = None,
+    ) -> None:
         self.config = config
         self.on_message = on_message
+        # Called on the listener thread; must return quickly.
+        self.on_presence = on_presence
         self._stop = threading.Event()
         self._thread: threading.Thread | None = None
+        self._log: EventLog | None = None
+        self._consumer: threading.Thread | None = None
+        self._seen: OrderedDict[str, None] = OrderedDict()
+        self._cursor: tuple[str, int] | None = None
+        self._recorder = None
+        # With deferred_ack, on_message only hands the message off (supervisor
+        # mode) and whoever runs the turn calls done(); otherwise a return
+        # from on_message counts as done.
+        self.deferred_ack = False
+        self._done_lock = threading.Lock()
+        self._inflight: dict[int, tuple[dict[str, Any], int]] = {}
+        self._finished: list[tuple[int, bool]] = []
+        self._retry: list[int] = []
 
     def start(self) -> None:
+        if self.config.record_path:
+            from replay.recorder import Recorder
+
+            self._recorder = Recorder.for_path(self.config.record_path)
+        if self.config.event_log_dir:
+            self._log = EventLog(self.config.event_log_dir)
+            for event in self._log.tail:
+                self._remember(event)
+            self._consumer = threading.Thread(target=self._consume, daemon=True)
+            self._consumer.start()
         self._thread = threading.Thread(target=self._run, daemon=True)
         self._thread.start()
 
     def stop(self) -> None:
         self._stop.set()
+        if self._log is not None:
+            self._log.close()
+
+    def backlog(self) -> int:
+        if self._log is None:
+            return 0
+        return self._log.lag(CONSUMER)
 
     def send(self, recipient: str, text: str) -> None:
+        import requests
+
         headers = {}
         if self.config.api_key:
             headers["x-api-key"] = self.config.api_key
@@ -50,9 +96,101 @@ class WhatsAppGateway(Channel):
             except Exception:
                 time.sleep(2)
 
+    def _remember(self, event: dict[str, Any]) -> None:
+        msg_id = event.get("id")
+        if msg_id:
+            self._seen[msg_id] = None
+            if len(self._seen) > 2048:
+                self._seen.popitem(last=False)
+        if event.get("boot") and event.get("seq") is not None:
+            self._cursor = (event["boot"], int(event["seq"]))
+
+    def _handle_message(self, payload: dict[str, Any]) -> None:
+        if self._log is None:
+            if self.on_message:
+                self.on_message(self._to_inbound(payload))
+            return
+        # The gateway replays its backlog on reconnect; skip what is already logged.
+        if payload.get("id") in self._seen:
+            return
+        self._log.append(payload)
+        self._remember(payload)
+
+    def done(self, offset: int | None, ok: bool = True) -> None:
+        # Thread-safe; the consumer thread retries or acks on its next pass.
+        if offset is None:
+            return
+        with self._done_lock:
+            self._finished.append((offset, ok))
+
+    def _deliver(self, offset: int, payload: dict[str, Any]) -> None:
+        if not self.on_message:
+            self.done(offset)
+            return
+        try:
+            self.on_message(self._to_inbound(payload, offset))
+        except Exception as exc:
+            print(f"[whatsapp] erro ao processar evento {offset}: {exc}")
+            self.done(offset, ok=False)
+            return
+        if not self.deferred_ack:
+            self.done(offset)
+
+    def _settle(self, next_offset: int) -> int:
+        # Applies finished turns, queues retries, and acks up to the oldest
+        # event still in flight: the log only moves past completed turns.
+        assert self._log is not None
+        with self._done_lock:
+            finished, self._finished = self._finished, []
+        for offset, ok in finished:
+            payload, attempts = self._inflight.get(offset, (None, 0))
+            if payload is None:
+                continue
+            if not ok and attempts < MAX_ATTEMPTS:
+                self._inflight[offset] = (payload, attempts + 1)
+                self._retry.append(offset)
+                continue
+            if not ok:
+                print(f"[whatsapp] evento {offset} descartado após {attempts} tentativas")
+            del self._inflight[offset]
+        low = min(self._inflight, default=next_offset)
+        if low > self._log.committed(CONSUMER):
+            self._log.ack(CONSUMER, low)
+        return low
+
+    def _consume(self) -> None:
+        assert self._log is not None
+        reader = self._log.reader(CONSUMER)
+        next_offset = self._log.committed(CONSUMER)
+        while not self._stop.is_set():
+            retry, self._retry = self._retry, []
+            for offset in retry:
+                # A late "done" from a worker that then died can settle it first.
+                if offset in self._inflight:
+                    self._deliver(offset, self._inflight[offset][0])
+            for offset, payload in reader.poll(max_records=256, timeout=1.0):
+                self._inflight[offset] = (payload, 1)
+                next_offset = offset + 1
+                self._deliver(offset, payload)
+            self._settle(next_offset)
+        reader.close()
+
+    def _to_inbound(self, payload: dict[str, Any], offset: int | None = None) -> InboundMessage:
+        return InboundMessage(
+            channel="whatsapp",
+            sender=payload.get("from", ""),
+            text=payload.get("text", ""),
+            offset=offset,
+        )
+
     def _listen(self) -> None:
+        # Runs on the listener thread, so the import stays off startup.
+        import websockets
+
         ws_url = self.config.gateway_url.replace("http://", "ws://").replace("https://", "wss://")
         ws_url = f"{ws_url}/events"
+        if self._cursor is not None:
+            ws_url += "?" + urlencode({"boot": self._cursor[0], "since": self._cursor[1]})
         headers = {}
         if self.config.api_key:
             headers["x-api-key"] = self.config.api_key
@@ -66,18 +204,17 @@ class WhatsAppGateway(Channel):
             async with ws_cm as ws:
                 async for message in ws:
                     payload = json.loads(message)
+                    if self._recorder is not None:
+                        self._recorder.record_event(payload)
                     if payload.get("type") == "qr":
                         print("[whatsapp] QR recebido")
                         print(payload.get("data", ""))
                     if payload.get("type") == "message":
-                        if not self.on_message:
-                            continue
-                        incoming = InboundMessage(
-                            channel="whatsapp",
-                            sender=payload.get("from", ""),
-                            text=payload.get("text", ""),
+                        self._handle_message(payload)
+                    if payload.get("type") == "presence" and self.on_presence:
+                        self.on_presence(
+                            PresenceEvent(channel="whatsapp", sender=payload.get("from", ""), state=payload.get("state", ""))
                         )
-                        self.on_message(incoming)
 
         import asyncio
 
@@ -1,18 +1,29 @@
 ﻿from __future__ import annotations
 
 import argparse
+import json
 import os
 import shutil
+import socket
 import subprocess
 import sys
+import time
 from dataclasses import dataclass
-from typing import Iterable
-
-import psycopg2
-import requests
+from typing import TYPE_CHECKING, Callable, Iterable
 
 from config.settings import Settings
-from setup import run_setup
+
+if TYPE_CHECKING:
+    import psycopg2
+
+
+SOCKET_PATH = "/var/run/bot-ai.sock"
+# Latency multiplier of the slow endpoint in `turion replay --pool`.
+POOL_SLOW_FACTOR = 4
+
+# Cumulative import time of each entry point in a fresh interpreter
+# (`python -X importtime`). Heavy modules belong behind lazy imports.
+IMPORT_BUDGETS_MS = {"cli": 150, "main": 250, "daemon_main": 250}
 
 
 @dataclass
@@ -22,8 +33,8 @@ class CheckResult:
     detail: str
 
 
-def _run(cmd: list[str]) -> subprocess.CompletedProcess[str]:
-    return subprocess.run(cmd, text=True, capture_output=True)
+def _run(cmd: list[str], timeout: float = 10) -> subprocess.CompletedProcess[str]:
+    return subprocess.run(cmd, text=True, capture_output=True, timeout=timeout)
 
 
 def _which(name: str) -> bool:
@@ -40,7 +51,7 @@ def _systemctl_is_active(service: str) -> tuple[bool, str]:
 def _systemctl_restart(service: str) -> tuple[bool, str]:
     if not _which("systemctl"):
         return False, "systemctl não encontrado"
-    result = _run(["systemctl", "restart", service])
+    result = _run(["systemctl", "restart", service], timeout=45)
     ok = result.returncode == 0
     return ok, result.stdout.strip() or result.stderr.strip()
 
@@ -51,6 +62,8 @@ def _systemctl_logs(service: str, lines: int = 100) -> str:
     return result.stdout.strip() or result.stderr.strip()
 
 def _check_gateway(url: str) -> tuple[bool, str]:
+    import requests
+
     try:
         resp = requests.get(f"{url}/health", timeout=5)
         if resp.ok:
@@ -61,6 +74,8 @@ def _check_gateway(url: str) -> tuple[bool, str]:
 
 
 def _check_gateway_qr(url: str) -> tuple[bool, str]:
+    import requests
+
     try:
         resp = requests.get(f"{url}/qr", timeout=5)
         if not resp.ok:
@@ -73,18 +88,24 @@ def _check_gateway_qr(url: str) -> tuple[bool, str]:
         return False, str(exc)
 
 
+def _db_connect(settings: Settings) -> psycopg2.extensions.connection:
+    import psycopg2
+
+    return psycopg2.connect(
+        host=settings.db_host,
+        port=settings.db_port,
+        dbname=settings.db_name,
+        user=settings.db_user,
+        password=settings.db_password,
+        connect_timeout=5,
+    )
+
+
 def _check_db(settings: Settings) -> tuple[bool, str]:
     if not settings.db_password:
         return False, "DB_PASSWORD vazio"
     try:
-        conn = psycopg2.connect(
-            host=settings.db_host,
-            port=settings.db_port,
-            dbname=settings.db_name,
-            user=settings.db_user,
-            password=settings.db_password,
-            connect_timeout=5,
-        )
+        conn = _db_connect(settings)
         with conn.cursor() as cur:
             cur.execute("select to_regclass('public.memory_items')")
             has_memory = cur.fetchone()[0] is not None
@@ -98,75 +119,327 @@ def _check_db(settings: Settings) -> tuple[bool, str]:
         return False, str(exc)
 
 
-def doctor_all() -> int:
-    settings = Settings.load()
-    results: list[CheckResult] = []
-
-    py_ok = sys.version_info >= (3, 10)
-    results.append(CheckResult("python >= 3.10", py_ok, sys.version.split()[0]))
-
-    if _which("node"):
-        node_v = _run(["node", "-v"]).stdout.strip()
-        results.append(CheckResult("node", True, node_v))
-    else:
-        results.append(CheckResult("node", False, "não encontrado"))
+# A cold import far slower than this is a failure in itself.
+IMPORT_TIME_TIMEOUT_SEC = 30
+
+
+def _import_time(module: str) -> tuple[float, list[tuple[float, str]]]:
+    # Returns the module's cumulative ms and its slowest direct imports.
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    env = {**os.environ, "PYTHONPATH": src_dir}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=src_dir,
+        env=env,
+        text=True,
+        capture_output=True,
+        timeout=IMPORT_TIME_TIMEOUT_SEC,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "falhou")
+    total = 0.0
+    children: list[tuple[float, str]] = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        # Children are listed before their parent, indented two spaces per level.
+        name = parts[2][1:]
+        cumulative = int(parts[1]) / 1000
+        if not name.startswith(" "):
+            if name == module:
+                total = cumulative
+                break
+            children = []
+        elif not name.startswith("   "):
+            children.append((cumulative, name.strip()))
+    return total, sorted(children, reverse=True)[:3]
+
+
+def _check_import_budget(module: str, budget: float) -> CheckResult:
+    total, slowest = _import_time(module)
+    detail = f"{total:.0f}ms (limite {budget}ms)"
+    if slowest:
+        detail += "; mais lentos: " + ", ".join(f"{name} {ms:.0f}ms" for ms, name in slowest)
+    return CheckResult(f"import {module}", total <= budget, detail)
+
+
+def _control(cmd: str, args: dict | None = None, timeout: float = 5.0) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(SOCKET_PATH)
+        s.sendall((json.dumps({"cmd": cmd, "args": args or {}}) + "\n").encode("utf-8"))
+        buf = b""
+        while not buf.endswith(b"\n"):
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            buf += chunk
+    return json.loads(buf.decode("utf-8"))
+
+
+def control_cmd(cmd: str, args: dict | None = None) -> int:
+    try:
+        resp = _control(cmd, args)
+    except OSError as exc:
+        print(f"[FAIL] daemon: {exc}")
+        return 1
+    if not resp.get("ok"):
+        print(f"[FAIL] {cmd}: {resp.get('error')}")
+        return 1
+    print(json.dumps(resp.get("data"), indent=2, ensure_ascii=False))
+    return 0
 
-    if _which("npm"):
-        npm_v = _run(["npm", "-v"]).stdout.strip()
-        results.append(CheckResult("npm", True, npm_v))
-    else:
-        results.append(CheckResult("npm", False, "não encontrado"))
 
-    if _which("psql"):
-        psql_v = _run(["psql", "-V"]).stdout.strip()
-        results.append(CheckResult("psql", True, psql_v))
+def replay_cmd(args: argparse.Namespace) -> int:
+    from replay.fake_llm import FakeLLM
+    from replay.harness import recorded_traffic, run_replay, synthetic_traffic
+
+    llm = FakeLLM(latency_ms=args.llm_latency_ms, jitter_ms=args.llm_jitter_ms)
+    pool = None
+    if args.pool:
+        # Listed first so the pool tries it before anything is measured: a
+        # failover is guaranteed. The jitter on the normal one pushes some
+        # turns past its p95, which is what triggers a hedge to the slow one.
+        pool = [
+            FakeLLM(latency_ms=20.0, fail_rate=1.0),
+            FakeLLM(latency_ms=args.llm_latency_ms, jitter_ms=args.llm_jitter_ms or args.llm_latency_ms / 2),
+            FakeLLM(latency_ms=args.llm_latency_ms * POOL_SLOW_FACTOR),
+        ]
+    if args.file:
+        loaded = llm.load(args.file)
+        for endpoint in pool or ():
+            endpoint.load(args.file)
+        print(f"{loaded} respostas do LLM carregadas da gravação")
+        traffic = recorded_traffic(args.file)
+    elif args.synthetic > 0:
+        traffic = synthetic_traffic(args.synthetic, args.rate, args.users)
     else:
-        results.append(CheckResult("psql", False, "não encontrado"))
-
-    venv_ok = os.path.exists("/opt/bot-ai/.venv/bin/python")
-    results.append(CheckResult("venv", venv_ok, "/opt/bot-ai/.venv/bin/python"))
+        print("Informe --file ou --synthetic N")
+        return 1
 
-    daemon_ok, daemon_detail = _systemctl_is_active("bot-ai.service")
-    results.append(CheckResult("bot-ai.service", daemon_ok, daemon_detail))
+    report = run_replay(Settings.load(), traffic, speed=args.speed, llm=llm, use_db=args.with_db, pool=pool)
+    for line in report.lines():
+        print(line)
+    ok = report.replied >= report.pushed
+    if pool:
+        for name in ("llm_failover", "llm_hedged"):
+            if not report.pool_counters.get(name):
+                print(f"[FAIL] pool: nenhum {name}")
+                ok = False
+    return 0 if ok else 1
+
+
+def partitions_cmd(conn: psycopg2.extensions.connection, args: argparse.Namespace, settings: Settings) -> int:
+    from memory import partitions
+
+    hash_partitions = getattr(args, "hash", None)
+    if hash_partitions is None:
+        hash_partitions = settings.memory_partition_hash
+    months_ahead = getattr(args, "months_ahead", None)
+    if months_ahead is None:
+        months_ahead = settings.memory_partition_months_ahead
+    if args.partitions_cmd == "list":
+        with conn.cursor() as cur:
+            if not partitions.is_partitioned(cur):
+                print("memory_items não é particionada (use: turion memory partitions migrate)")
+                return 1
+            for month, name in sorted(partitions.list_partitions(cur).items()):
+                print(f"{month:%Y-%m}  {name}")
+        return 0
+    if args.partitions_cmd == "ensure":
+        created = partitions.ensure_partitions(conn, months_ahead, hash_partitions)
+        print(f"[OK] partições criadas: {', '.join(created) or 'nenhuma'}")
+        return 0
+    if args.partitions_cmd == "retention":
+        archive_dir = args.archive_dir or settings.memory_archive_dir
+        keep = args.keep_months or settings.memory_retention_months
+        if keep <= 0:
+            print("Informe --keep-months (ou MEMORY_RETENTION_MONTHS)")
+            return 1
+        report = partitions.apply_retention(conn, keep, archive_dir, drop=args.drop)
+        print(
+            f"[OK] desanexadas: {', '.join(report.detached) or 'nenhuma'}; "
+            f"arquivadas: {len(report.archived)}; removidas: {len(report.dropped)}"
+        )
+        return 0
+    report = partitions.migrate(conn, months_ahead, hash_partitions, drop_legacy=args.drop_legacy)
+    print(f"[OK] migração: {report.migrated_rows} linhas copiadas, {len(report.created)} partições criadas")
+    if not args.drop_legacy:
+        print(f"Tabela antiga mantida como {partitions.LEGACY}; remova com --drop-legacy após conferir.")
+    return 0
 
-    gw_ok, gw_detail = _systemctl_is_active("bot-ai-gateway.service")
-    results.append(CheckResult("bot-ai-gateway.service", gw_ok, gw_detail))
 
-    if settings.whatsapp_gateway_url:
-        health_ok, health_detail = _check_gateway(settings.whatsapp_gateway_url)
-        results.append(CheckResult("gateway health", health_ok, health_detail))
-        qr_ok, qr_detail = _check_gateway_qr(settings.whatsapp_gateway_url)
-        results.append(CheckResult("gateway qr", qr_ok, qr_detail))
+def memory_cmd(args: argparse.Namespace) -> int:
+    from memory.transfer import export_memory, import_memory
 
-    db_ok, db_detail = _check_db(settings)
-    results.append(CheckResult("db", db_ok, db_detail))
+    settings = Settings.load()
+    if not settings.db_password:
+        print("[FAIL] db: DB_PASSWORD vazio")
+        return 1
 
-    # attempt basic fixes
-    if not daemon_ok:
-        _systemctl_restart("bot-ai.service")
-    if not gw_ok:
-        _systemctl_restart("bot-ai-gateway.service")
+    def progress(kind: str, count: int) -> None:
+        print(f"  {kind}: {count}", file=sys.stderr, flush=True)
 
-    # recheck after restart
-    daemon_ok2, daemon_detail2 = _systemctl_is_active("bot-ai.service")
-    gw_ok2, gw_detail2 = _systemctl_is_active("bot-ai-gateway.service")
-    if daemon_ok != daemon_ok2:
-        results.append(CheckResult("bot-ai.service (recheck)", daemon_ok2, daemon_detail2))
-    if gw_ok != gw_ok2:
-        results.append(CheckResult("bot-ai-gateway.service (recheck)", gw_ok2, gw_detail2))
+    try:
+        conn = _db_connect(settings)
+    except Exception as exc:
+        print(f"[FAIL] db: {exc}")
+        return 1
+    try:
+        if args.memory_cmd == "partitions":
+            return partitions_cmd(conn, args, settings)
+        if args.memory_cmd == "export":
+            stats = export_memory(conn, args.file, users=args.user, progress=progress)
+            print(f"[OK] export: {stats.profiles} perfis, {stats.items} mensagens em {stats.elapsed_sec:.1f}s -> {args.file}")
+        else:
+            stats = import_memory(conn, args.file, chunk_rows=args.chunk_rows, progress=progress)
+            print(
+                f"[OK] import: {stats.profiles} perfis, {stats.items} mensagens, "
+                f"{stats.skipped} já existentes em {stats.elapsed_sec:.1f}s"
+            )
+    except Exception as exc:
+        print(f"[FAIL] {args.memory_cmd}: {exc}")
+        return 1
+    finally:
+        conn.close()
+    return 0
 
-    if not daemon_ok2:
-        results.append(CheckResult("bot-ai.service logs", False, _systemctl_logs("bot-ai.service", 80)))
-    if not gw_ok2:
-        results.append(CheckResult("bot-ai-gateway.service logs", False, _systemctl_logs("bot-ai-gateway.service", 80)))
 
+@dataclass
+class DoctorCheck:
+    name: str
+    run: Callable[[], list[CheckResult]]
+    timeout_sec: float = 10.0
+
+
+def _check_tool(name: str, cmd: list[str]) -> list[CheckResult]:
+    if not _which(name):
+        return [CheckResult(name, False, "não encontrado")]
+    return [CheckResult(name, True, _run(cmd).stdout.strip())]
+
+
+def _check_service(service: str) -> list[CheckResult]:
+    # Restart and recheck belong to the same task: they only make sense in
+    # sequence, but are independent of every other check.
+    ok, detail = _systemctl_is_active(service)
+    results = [CheckResult(service, ok, detail)]
+    if ok:
+        return results
+    _systemctl_restart(service)
+    ok2, detail2 = _systemctl_is_active(service)
+    if ok2 != ok:
+        results.append(CheckResult(f"{service} (recheck)", ok2, detail2))
+    if not ok2:
+        results.append(CheckResult(f"{service} logs", False, _systemctl_logs(service, 80)))
+    return results
+
+
+def _doctor_checks(settings: Settings, scope: str) -> list[DoctorCheck]:
+    db = DoctorCheck("db", lambda: [CheckResult("db", *_check_db(settings))])
+    if scope == "db":
+        return [db]
+    if scope == "startup":
+        # One task, measured one at a time: timings taken while other checks
+        # compete for the CPU would be meaningless.
+        return [
+            DoctorCheck(
+                "startup",
+                lambda: [_check_import_budget(m, b) for m, b in IMPORT_BUDGETS_MS.items()],
+                timeout_sec=60,
+            )
+        ]
+
+    venv = "/opt/bot-ai/.venv/bin/python"
+    checks = [
+        DoctorCheck(
+            "python",
+            lambda: [CheckResult("python >= 3.10", sys.version_info >= (3, 10), sys.version.split()[0])],
+        ),
+        DoctorCheck("node", lambda: _check_tool("node", ["node", "-v"])),
+        DoctorCheck("npm", lambda: _check_tool("npm", ["npm", "-v"])),
+        DoctorCheck("psql", lambda: _check_tool("psql", ["psql", "-V"])),
+        DoctorCheck("venv", lambda: [CheckResult("venv", os.path.exists(venv), venv)]),
+        DoctorCheck("bot-ai.service", lambda: _check_service("bot-ai.service"), timeout_sec=75),
+        DoctorCheck("bot-ai-gateway.service", lambda: _check_service("bot-ai-gateway.service"), timeout_sec=75),
+    ]
+    url = settings.whatsapp_gateway_url
+    if url:
+        checks.append(DoctorCheck("gateway health", lambda: [CheckResult("gateway health", *_check_gateway(url))]))
+        checks.append(DoctorCheck("gateway qr", lambda: [CheckResult("gateway qr", *_check_gateway_qr(url))]))
+    checks.append(db)
+    return checks
+
+
+def _guarded(check: DoctorCheck) -> list[CheckResult]:
+    try:
+        return check.run()
+    except Exception as exc:
+        return [CheckResult(check.name, False, f"{type(exc).__name__}: {exc}")]
+
+
+def run_checks(
+    checks: list[DoctorCheck],
+    deadline_sec: float,
+    emit: Callable[[CheckResult, float], None],
+) -> bool:
+    # Every check starts at once on its own thread; results are emitted as
+    # they finish. A check past its own timeout (or the overall deadline) is
+    # reported as failed and no longer waited for. The threads are daemons:
+    # a hung check must not hold the process open past the deadline.
+    import queue
+    import threading
+
+    started = time.monotonic()
     ok_all = True
-    for r in results:
-        status = "OK" if r.ok else "FAIL"
-        print(f"[{status}] {r.name}: {r.detail}")
-        if not r.ok:
-            ok_all = False
-
+    finished: queue.Queue[tuple[int, list[CheckResult]]] = queue.Queue()
+    pending: dict[int, DoctorCheck] = dict(enumerate(checks))
+    for index, check in pending.items():
+        threading.Thread(
+            target=lambda i=index, c=check: finished.put((i, _guarded(c))),
+            name=f"doctor-{index}",
+            daemon=True,
+        ).start()
+    while pending:
+        now = time.monotonic()
+        limit = min(min(c.timeout_sec for c in pending.values()), deadline_sec)
+        try:
+            index, results = finished.get(timeout=max(started + limit - now, 0))
+        except queue.Empty:
+            index, results = None, []
+        elapsed_ms = (time.monotonic() - started) * 1000
+        if pending.pop(index, None) is not None:
+            for result in results:
+                ok_all = ok_all and result.ok
+                emit(result, elapsed_ms)
+        elapsed = time.monotonic() - started
+        for key, check in list(pending.items()):
+            timeout = min(check.timeout_sec, deadline_sec)
+            if elapsed >= timeout:
+                pending.pop(key)
+                ok_all = False
+                emit(CheckResult(check.name, False, f"sem resposta em {timeout:g}s"), elapsed * 1000)
+    return ok_all
+
+
+def doctor_cmd(scope: str, as_json: bool = False, deadline_sec: float = 60.0) -> int:
+    settings = Settings.load()
+    started = time.monotonic()
+
+    def emit(result: CheckResult, elapsed_ms: float) -> None:
+        if as_json:
+            line = {"name": result.name, "ok": result.ok, "detail": result.detail, "ms": round(elapsed_ms)}
+            print(json.dumps(line, ensure_ascii=False), flush=True)
+        else:
+            status = "OK" if result.ok else "FAIL"
+            print(f"[{status}] {result.name}: {result.detail}", flush=True)
+
+    ok_all = run_checks(_doctor_checks(settings, scope), deadline_sec, emit)
+    if as_json:
+        summary = {"summary": True, "ok": ok_all, "ms": round((time.monotonic() - started) * 1000)}
+        print(json.dumps(summary), flush=True)
     return 0 if ok_all else 1
 
 
@@ -177,25 +450,113 @@ def main(argv: Iterable[str] | None = None) -> int:
 
     doctor_parser = sub.add_parser("doctor", help="diagnóstico do sistema")
     doctor_sub = doctor_parser.add_subparsers(dest="doctor_cmd")
-    doctor_sub.add_parser("all", help="verifica tudo")
-    doctor_sub.add_parser("db", help="verifica banco de dados")
+    doctor_scopes = [
+        doctor_parser,
+        doctor_sub.add_parser("all", help="verifica tudo"),
+        doctor_sub.add_parser("db", help="verifica banco de dados"),
+        doctor_sub.add_parser("startup", help="tempo de import dos pontos de entrada"),
+    ]
+    for p in doctor_scopes:
+        # Accepted before or after the scope; only the top-level parser sets
+        # defaults so a subcommand never resets a value given before it.
+        top = p is doctor_parser
+        p.add_argument(
+            "--json",
+            action="store_true",
+            default=False if top else argparse.SUPPRESS,
+            help="uma linha JSON por verificação",
+        )
+        p.add_argument(
+            "--timeout",
+            type=float,
+            default=60.0 if top else argparse.SUPPRESS,
+            help="prazo total em segundos",
+        )
 
     sub.add_parser("setup", help="wizard de configuração inicial")
+    sub.add_parser("status", help="métricas do agente em execução")
+
+    profile_parser = sub.add_parser("profile", help="profiler do agente em execução")
+    profile_sub = profile_parser.add_subparsers(dest="profile_cmd")
+    profile_sub.required = True
+    sample_parser = profile_sub.add_parser("sample", help="amostra pilhas (formato flamegraph)")
+    sample_parser.add_argument("--seconds", type=float, default=30)
+    sample_parser.add_argument("--interval-ms", type=float, default=5)
+    trace_parser = profile_sub.add_parser("trace", help="grava spans dos próximos turnos")
+    trace_parser.add_argument("--turns", type=int, default=20)
+    profile_sub.add_parser("stop", help="interrompe amostragem e trace")
+    profile_sub.add_parser("status", help="estado do profiler")
+
+    replay_parser = sub.add_parser("replay", help="carga local com gateway e LLM falsos")
+    replay_parser.add_argument("--file", help="gravação (RECORD_PATH) a reproduzir")
+    replay_parser.add_argument("--synthetic", type=int, default=0, help="N mensagens sintéticas")
+    replay_parser.add_argument("--rate", type=float, default=10.0, help="msg/s do tráfego sintético")
+    replay_parser.add_argument("--users", type=int, default=10, help="remetentes sintéticos")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="multiplicador de velocidade")
+    replay_parser.add_argument("--llm-latency-ms", type=float, default=200.0)
+    replay_parser.add_argument("--llm-jitter-ms", type=float, default=0.0)
+    replay_parser.add_argument("--with-db", action="store_true", help="usa o banco configurado")
+    replay_parser.add_argument(
+        "--pool", action="store_true", help="três endpoints falsos (falhando, normal, lento); exige failover e hedge"
+    )
+
+    memory_parser = sub.add_parser("memory", help="exporta/importa a memória (COPY)")
+    memory_sub = memory_parser.add_subparsers(dest="memory_cmd")
+    memory_sub.required = True
+    export_parser = memory_sub.add_parser("export", help="grava perfis e mensagens em NDJSON gzip")
+    export_parser.add_argument("--file", required=True, help="destino, ex: memoria.ndjson.gz")
+    export_parser.add_argument("--user", action="append", help="só este user_id (repetível)")
+    import_parser = memory_sub.add_parser("import", help="carrega um export (idempotente)")
+    import_parser.add_argument("--file", required=True)
+    import_parser.add_argument("--chunk-rows", type=int, default=20_000)
+    partitions_parser = memory_sub.add_parser("partitions", help="partições mensais de memory_items")
+    partitions_sub = partitions_parser.add_subparsers(dest="partitions_cmd")
+    partitions_sub.required = True
+    partitions_sub.add_parser("list", help="lista as partições")
+    for name, help_text in (("ensure", "cria as partições dos próximos meses"), ("migrate", "converte a tabela antiga")):
+        p = partitions_sub.add_parser(name, help=help_text)
+        p.add_argument("--months-ahead", type=int, help="padrão MEMORY_PARTITION_MONTHS_AHEAD")
+        p.add_argument("--hash", type=int, help="subpartições hash por user_id (padrão MEMORY_PARTITION_HASH)")
+        if name == "migrate":
+            p.add_argument("--drop-legacy", action="store_true", help="remove memory_items_legacy ao final")
+    retention_parser = partitions_sub.add_parser("retention", help="arquiva e desanexa partições antigas")
+    retention_parser.add_argument("--keep-months", type=int, default=0)
+    retention_parser.add_argument("--archive-dir", help="padrão MEMORY_ARCHIVE_DIR")
+    retention_parser.add_argument("--drop", action="store_true", help="remove a tabela após desanexar")
+
+    ctl_parser = sub.add_parser("ctl", help="comando de controle para o daemon")
+    ctl_parser.add_argument("command", help="ex: stats, cache.flush, settings.reload")
+    ctl_parser.add_argument("--user", help="user_id (cache.flush)")
 
     args = parser.parse_args(argv)
     if args.cmd == "doctor":
-        if args.doctor_cmd is None or args.doctor_cmd == "all":
-            return doctor_all()
-        if args.doctor_cmd == "db":
-            ok, detail = _check_db(Settings.load())
-            status = "OK" if ok else "FAIL"
-            print(f"[{status}] db: {detail}")
-            return 0 if ok else 1
-        return 1
+        return doctor_cmd(args.doctor_cmd or "all", as_json=args.json, deadline_sec=args.timeout)
 
     if args.cmd == "setup":
+        from setup import run_setup
+
         return run_setup()
 
+    if args.cmd == "status":
+        return control_cmd("stats")
+
+    if args.cmd == "profile":
+        if args.profile_cmd == "sample":
+            return control_cmd("profile.sample", {"seconds": args.seconds, "interval_ms": args.interval_ms})
+        if args.profile_cmd == "trace":
+            return control_cmd("profile.trace", {"turns": args.turns})
+        return control_cmd(f"profile.{args.profile_cmd}")
+
+    if args.cmd == "replay":
+        return replay_cmd(args)
+
+    if args.cmd == "memory":
+        return memory_cmd(args)
+
+    if args.cmd == "ctl":
+        ctl_args = {"user_id": args.user} if args.user else {}
+        return control_cmd(args.command, ctl_args)
+
     return 0
 
 
@@ -1,10 +1,13 @@
 ﻿from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 
 from dotenv import dotenv_values
 
+ROOT = Path(__file__).resolve().parents[2]
+ENV_PATH = ROOT / ".env"
+
 
 def _env_get(env: dict[str, str | None], key: str, default: str | None = None) -> str | None:
     value = env.get(key)
@@ -13,6 +16,39 @@ def _env_get(env: dict[str, str | None], key: str, default: str | None = None) -
     return value
 
 
+def _env_path(env: dict[str, str | None], key: str, root: Path) -> str | None:
+    raw = env.get(key)
+    if not raw:
+        return None
+    path = Path(raw)
+    if not path.is_absolute():
+        path = root / path
+    return str(path)
+
+
+def _env_weights(env: dict[str, str | None], key: str) -> dict[str, float]:
+    # "user:0.05,system:0.1" -> {"user": 0.05, "system": 0.1}
+    weights: dict[str, float] = {}
+    for part in (env.get(key) or "").split(","):
+        name, sep, value = part.partition(":")
+        if sep and name.strip():
+            weights[name.strip()] = float(value)
+    return weights
+
+
+def _env_endpoints(env: dict[str, str | None], key: str) -> tuple[tuple[str, float, str | None], ...]:
+    # "https://a/v1|1.0,https://b/v1|0.5|modelo" -> ((url, weight, model), ...)
+    endpoints = []
+    for part in (env.get(key) or "").split(","):
+        fields = [f.strip() for f in part.split("|")]
+        if not fields[0]:
+            continue
+        weight = float(fields[1]) if len(fields) > 1 and fields[1] else 1.0
+        model = fields[2] if len(fields) > 2 and fields[2] else None
+        endpoints.append((fields[0], weight, model))
+    return tuple(endpoints)
+
+
 def _env_bool(env: dict[str, str | None], key: str, default: bool = False) -> bool:
     raw = env.get(key)
     if raw is None:
@@ -23,13 +59,31 @@ def _env_bool(env: dict[str, str | None], key: str, default: bool = False) -> bo
 @dataclass(frozen=True)
 class Settings:
     mode: str = "dev"
+    agent_workers: int = 1
     llm_provider: str | None = None
     llm_api_key: str | None = None
     llm_api_base: str | None = None
+    llm_endpoints: tuple[tuple[str, float, str | None], ...] = ()
+    llm_hedge: bool = True
+    llm_hedge_min_ms: int = 150
     llm_max_tokens: int = 20000
+    llm_cache_path: str | None = None
+    reply_streaming: bool = False
+    turn_deadline_ms: int = 0
+    turn_budgets_ms: dict[str, float] = field(default_factory=dict)
+    scheduler_concurrency: dict[str, float] = field(default_factory=dict)
+    scheduler_tokens_per_min: dict[str, float] = field(default_factory=dict)
+    scheduler_target_ms: int = 2000
+    prefetch_ttl_sec: int = 30
+    prefetch_max_concurrent: int = 4
+    reply_chunk_min_chars: int = 120
+    reply_chunk_interval_ms: int = 1000
+    llm_cache_ttl_sec: int = 259200
+    llm_cache_max_entries: int = 5000
 
     whatsapp_gateway_url: str | None = None
     whatsapp_api_key: str | None = None
+    event_log_dir: str | None = None
 
     db_host: str = "127.0.0.1"
     db_port: int = 5432
@@ -38,41 +92,139 @@ class Settings:
     db_password: str | None = None
 
     memory_user_id: str = "default"
+    memory_per_sender: bool = False
     memory_use_embeddings: bool = False
     memory_cache_ttl_sec: int = 3600
     memory_max_context_items: int = 12
     memory_min_relevance: float = 0.25
+    memory_stemming: bool = True
+    memory_notify: bool = False
+    memory_partition_months_ahead: int = 2
+    memory_partition_hash: int = 0
+    memory_retention_months: int = 0
+    memory_archive_dir: str | None = None
+
+    retrieval_bm25_weight: float = 1.0
+    retrieval_semantic_weight: float = 0.0
+    retrieval_recency_weight: float = 0.3
+    retrieval_half_life_hours: float = 72.0
+    retrieval_role_boosts: dict[str, float] = field(default_factory=dict)
+    retrieval_tag_boosts: dict[str, float] = field(default_factory=dict)
 
     routing_confidence_threshold: float = 0.78
     routing_shortcut_similarity: float = 0.90
 
+    lang_min_confidence: float = 0.85
+    lang_switch_turns: int = 3
+
     grok_warmup_messages: int = 50
     grok_maintenance_every: int = 20
 
+    profile_dir: str | None = None
+    record_path: str | None = None
+    snapshot_path: str | None = None
+    snapshot_every_sec: int = 300
+    control_group: str = "turion"
+
     @classmethod
     def load(cls) -> "Settings":
-        root = Path(__file__).resolve().parents[2]
-        env = dotenv_values(root / ".env")
+        root = ROOT
+        env = dotenv_values(ENV_PATH)
         return cls(
             mode=_env_get(env, "MODE", "dev") or "dev",
+            agent_workers=max(1, int(_env_get(env, "AGENT_WORKERS", "1") or "1")),
             llm_provider=_env_get(env, "LLM_PROVIDER"),
             llm_api_key=_env_get(env, "LLM_API_KEY"),
             llm_api_base=_env_get(env, "LLM_API_BASE"),
+            llm_endpoints=_env_endpoints(env, "LLM_ENDPOINTS"),
+            llm_hedge=_env_bool(env, "LLM_HEDGE", True),
+            llm_hedge_min_ms=int(_env_get(env, "LLM_HEDGE_MIN_MS", "150") or "150"),
             llm_max_tokens=int(_env_get(env, "LLM_MAX_TOKENS", "20000") or "20000"),
+            llm_cache_path=_env_path(env, "LLM_CACHE_PATH", root),
+            reply_streaming=_env_bool(env, "REPLY_STREAMING", False),
+            turn_deadline_ms=int(_env_get(env, "TURN_DEADLINE_MS", "0") or "0"),
+            turn_budgets_ms=_env_weights(env, "TURN_BUDGETS_MS"),
+            scheduler_concurrency=_env_weights(env, "SCHEDULER_CONCURRENCY"),
+            scheduler_tokens_per_min=_env_weights(env, "SCHEDULER_TOKENS_PER_MIN"),
+            scheduler_target_ms=int(_env_get(env, "SCHEDULER_TARGET_MS", "2000") or "2000"),
+            prefetch_ttl_sec=int(_env_get(env, "PREFETCH_TTL_SEC", "30") or "30"),
+            prefetch_max_concurrent=int(_env_get(env, "PREFETCH_MAX_CONCURRENT", "4") or "4"),
+            reply_chunk_min_chars=int(_env_get(env, "REPLY_CHUNK_MIN_CHARS", "120") or "120"),
+            reply_chunk_interval_ms=int(_env_get(env, "REPLY_CHUNK_INTERVAL_MS", "1000") or "1000"),
+            llm_cache_ttl_sec=int(_env_get(env, "LLM_CACHE_TTL_SEC", "259200") or "259200"),
+            llm_cache_max_entries=int(_env_get(env, "LLM_CACHE_MAX_ENTRIES", "5000") or "5000"),
             whatsapp_gateway_url=_env_get(env, "WHATSAPP_GATEWAY_URL"),
             whatsapp_api_key=_env_get(env, "WHATSAPP_API_KEY"),
+            event_log_dir=_env_path(env, "EVENT_LOG_DIR", root),
             db_host=_env_get(env, "DB_HOST", "127.0.0.1") or "127.0.0.1",
             db_port=int(_env_get(env, "DB_PORT", "5432") or "5432"),
             db_name=_env_get(env, "DB_NAME", "turion") or "turion",
             db_user=_env_get(env, "DB_USER", "turion") or "turion",
             db_password=_env_get(env, "DB_PASSWORD"),
             memory_user_id=_env_get(env, "MEMORY_USER_ID", "default") or "default",
+            memory_per_sender=_env_bool(env, "MEMORY_PER_SENDER", False),
             memory_use_embeddings=_env_bool(env, "MEMORY_USE_EMBEDDINGS", False),
             memory_cache_ttl_sec=int(_env_get(env, "MEMORY_CACHE_TTL_SEC", "3600") or "3600"),
             memory_max_context_items=int(_env_get(env, "MEMORY_MAX_CONTEXT_ITEMS", "12") or "12"),
             memory_min_relevance=float(_env_get(env, "MEMORY_MIN_RELEVANCE", "0.25") or "0.25"),
+            memory_stemming=_env_bool(env, "MEMORY_STEMMING", True),
+            memory_notify=_env_bool(env, "MEMORY_NOTIFY", False),
+            memory_partition_months_ahead=int(_env_get(env, "MEMORY_PARTITION_MONTHS_AHEAD", "2") or "2"),
+            memory_partition_hash=int(_env_get(env, "MEMORY_PARTITION_HASH", "0") or "0"),
+            memory_retention_months=int(_env_get(env, "MEMORY_RETENTION_MONTHS", "0") or "0"),
+            memory_archive_dir=_env_path(env, "MEMORY_ARCHIVE_DIR", root),
+            retrieval_bm25_weight=float(_env_get(env, "RETRIEVAL_BM25_WEIGHT", "1.0") or "1.0"),
+            retrieval_semantic_weight=float(_env_get(env, "RETRIEVAL_SEMANTIC_WEIGHT", "0.0") or "0.0"),
+            retrieval_recency_weight=float(_env_get(env, "RETRIEVAL_RECENCY_WEIGHT", "0.3") or "0.3"),
+            retrieval_half_life_hours=float(_env_get(env, "RETRIEVAL_HALF_LIFE_HOURS", "72") or "72"),
+            retrieval_role_boosts=_env_weights(env, "RETRIEVAL_ROLE_BOOSTS"),
+            retrieval_tag_boosts=_env_weights(env, "RETRIEVAL_TAG_BOOSTS"),
             routing_confidence_threshold=float(_env_get(env, "ROUTING_CONF_THRESHOLD", "0.78") or "0.78"),
             routing_shortcut_similarity=float(_env_get(env, "ROUTING_SHORTCUT_SIM", "0.90") or "0.90"),
+            lang_min_confidence=float(_env_get(env, "LANG_MIN_CONFIDENCE", "0.85") or "0.85"),
+            lang_switch_turns=int(_env_get(env, "LANG_SWITCH_TURNS", "3") or "3"),
             grok_warmup_messages=int(_env_get(env, "GROK_WARMUP_MESSAGES", "50") or "50"),
             grok_maintenance_every=int(_env_get(env, "GROK_MAINTENANCE_EVERY", "20") or "20"),
+            profile_dir=_env_path(env, "PROFILE_DIR", root),
+            record_path=_env_path(env, "RECORD_PATH", root),
+            snapshot_path=_env_path(env, "SNAPSHOT_PATH", root),
+            snapshot_every_sec=int(_env_get(env, "SNAPSHOT_EVERY_SEC", "300") or "300"),
+            control_group=_env_get(env, "CONTROL_GROUP", "turion") or "turion",
         )
+
+    def validate(self) -> list[str]:
+        # Checked before a reloaded .env replaces the running settings.
+        errors = []
+        for name in ("memory_max_context_items", "llm_max_tokens", "grok_maintenance_every", "lang_switch_turns"):
+            if getattr(self, name) < 1:
+                errors.append(f"{name} deve ser >= 1")
+        for name in ("memory_cache_ttl_sec", "llm_cache_ttl_sec", "llm_cache_max_entries", "snapshot_every_sec"):
+            if getattr(self, name) < 0:
+                errors.append(f"{name} deve ser >= 0")
+        for name in ("memory_min_relevance", "routing_shortcut_similarity", "routing_confidence_threshold", "lang_min_confidence"):
+            if not 0.0 <= getattr(self, name) <= 1.0:
+                errors.append(f"{name} deve estar entre 0 e 1")
+        if self.agent_workers > 1 and not self.memory_per_sender:
+            # Every turn would shard onto the one MEMORY_USER_ID worker.
+            errors.append("AGENT_WORKERS > 1 exige MEMORY_PER_SENDER=true")
+        if self.prefetch_ttl_sec < 0:
+            errors.append("prefetch_ttl_sec deve ser >= 0")
+        if self.prefetch_max_concurrent < 1:
+            errors.append("prefetch_max_concurrent deve ser >= 1")
+        if self.scheduler_target_ms < 1:
+            errors.append("scheduler_target_ms deve ser >= 1")
+        if self.turn_deadline_ms < 0:
+            errors.append("turn_deadline_ms deve ser >= 0")
+        if self.reply_chunk_min_chars < 1:
+            errors.append("reply_chunk_min_chars deve ser >= 1")
+        if self.reply_chunk_interval_ms < 0:
+            errors.append("reply_chunk_interval_ms deve ser >= 0")
+        if self.llm_hedge_min_ms < 0:
+            errors.append("llm_hedge_min_ms deve ser >= 0")
+        if any(weight <= 0 for _, weight, _ in self.llm_endpoints):
+            errors.append("LLM_ENDPOINTS: pesos devem ser > 0")
+        if self.retrieval_half_life_hours <= 0:
+            errors.append("retrieval_half_life_hours deve ser > 0")
+        if self.retrieval_bm25_weight + self.retrieval_semantic_weight <= 0:
+            errors.append("retrieval_bm25_weight + retrieval_semantic_weight deve ser > 0")
+        return errors
@@ -0,0 +1,77 @@
+﻿from __future__ import annotations
+
+import os
+import time
+from dataclasses import fields
+from pathlib import Path
+
+from config.settings import ENV_PATH, Settings
+
+# Only read when a process starts; a change is reported, not applied.
+RESTART_FIELDS = frozenset(
+    {
+        "mode",
+        "agent_workers",
+        "whatsapp_gateway_url",
+        "whatsapp_api_key",
+        "event_log_dir",
+        "profile_dir",
+        "snapshot_path",
+        "memory_notify",
+        "control_group",
+    }
+)
+
+
+def changed_fields(old: Settings, new: Settings) -> list[str]:
+    return [f.name for f in fields(Settings) if getattr(new, f.name) != getattr(old, f.name)]
+
+
+class SettingsWatcher:
+    # Polls the .env mtime (a stat per call, rate-limited) and returns a new,
+    # validated Settings when the file changed. A file that fails to parse or
+    # validate is reported once and the running settings stay in place.
+    def __init__(self, current: Settings, path: Path = ENV_PATH, min_interval_sec: float = 1.0) -> None:
+        self.current = current
+        self.path = path
+        self.min_interval_sec = min_interval_sec
+        self.last_error: str | None = None
+        self._checked_at = 0.0
+        self._stamp = self._stat()
+
+    def _stat(self) -> tuple[int, int] | None:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def poll(self) -> Settings | None:
+        now = time.monotonic()
+        if now - self._checked_at < self.min_interval_sec:
+            return None
+        self._checked_at = now
+        stamp = self._stat()
+        if stamp == self._stamp:
+            return None
+        self._stamp = stamp
+        return self.load()
+
+    def load(self) -> Settings | None:
+        try:
+            new = Settings.load()
+        except ValueError as exc:
+            return self._reject(str(exc))
+        errors = new.validate()
+        if errors:
+            return self._reject("; ".join(errors))
+        self.last_error = None
+        if new == self.current:
+            return None
+        self.current = new
+        return new
+
+    def _reject(self, error: str) -> None:
+        self.last_error = error
+        print(f"[settings] .env ignorado: {error}")
+        return None
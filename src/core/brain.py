@@ -1,19 +1,145 @@
 ﻿from __future__ import annotations
 
-from dataclasses import dataclass
+import hashlib
+import json
+import threading
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass, field, replace
+from datetime import datetime
+from typing import Callable
 
-from adapters.grok import GrokClient, LLMRequest
+from adapters.cache import CachedLLM, ResponseCache
+from adapters.grok import GrokClient, LLMClient, LLMRequest
 from config.settings import Settings
+from core import langid
+from core.chunker import ReplyChunker
+from core.deadline import Deadline
+from core.metrics import metrics
+from core.profiler import profiler
+from core.scheduler import Priority, Scheduler
+from memory.history import HistoryBuffer
 from memory.pipeline import MemoryPipeline
 from memory.retriever import Retriever
+from memory import text
 from memory.store import MemoryConfig, MemoryService
 from memory.summarizer import LocalSummarizer
 from memory.types import MemoryItem, UserProfile
 
-try:
-    from rapidfuzz import fuzz
-except Exception:  # pragma: no cover - optional
-    fuzz = None
+# Settings whose change makes cached state wrong, not merely stale.
+MEMORY_FIELDS = frozenset({"db_host", "db_port", "db_name", "db_user", "db_password"})
+LLM_FIELDS = frozenset(
+    {
+        "llm_provider",
+        "llm_api_base",
+        "llm_api_key",
+        "llm_endpoints",
+        "llm_hedge",
+        "llm_hedge_min_ms",
+        "llm_cache_path",
+        "llm_cache_ttl_sec",
+        "llm_cache_max_entries",
+        "record_path",
+    }
+)
+# Profile fields maintenance reads and updates.
+PROFILE_FIELDS = ("persona", "style", "preferences", "language")
+# Most messages a single maintenance run sends, newest first.
+PROFILE_UPDATE_MAX_MESSAGES = 20
+
+# A different model answers differently; cached responses are dropped.
+LLM_ANSWER_FIELDS = frozenset({"llm_provider", "llm_api_base", "llm_endpoints"})
+
+
+class DeliveryError(Exception):
+    # Sending part of a reply failed. Not an OSError, so the LLM fallbacks
+    # do not catch it: the turn fails and the caller decides on a retry.
+    pass
+
+
+def _delivering(on_chunk: Callable[[str], None]) -> Callable[[str], None]:
+    def send(part: str) -> None:
+        try:
+            on_chunk(part)
+        except Exception as exc:
+            raise DeliveryError(str(exc)) from exc
+
+    return send
+
+
+def build_retriever(settings: Settings) -> Retriever:
+    return Retriever(
+        min_score=settings.memory_min_relevance,
+        stemming=settings.memory_stemming,
+        bm25_weight=settings.retrieval_bm25_weight,
+        semantic_weight=settings.retrieval_semantic_weight,
+        recency_weight=settings.retrieval_recency_weight,
+        recency_half_life_sec=settings.retrieval_half_life_hours * 3600,
+        role_boosts=dict(settings.retrieval_role_boosts),
+        tag_boosts=dict(settings.retrieval_tag_boosts),
+    )
+
+
+def memory_config(settings: Settings) -> MemoryConfig:
+    return MemoryConfig(
+        host=settings.db_host,
+        port=settings.db_port,
+        dbname=settings.db_name,
+        user=settings.db_user,
+        password=settings.db_password,
+        cache_ttl_sec=settings.memory_cache_ttl_sec,
+        notify=settings.memory_notify,
+    )
+
+
+def build_llm(settings: Settings) -> LLMClient | None:
+    grok = None
+    if settings.llm_provider and settings.llm_provider.lower() == "grok":
+        if settings.llm_endpoints and settings.llm_api_key:
+            from adapters.pool import Endpoint, ProviderPool
+
+            grok = ProviderPool(
+                [
+                    Endpoint(name=f"{url}#{model}" if model else url, client=GrokClient(url, settings.llm_api_key, model), weight=weight)
+                    for url, weight, model in settings.llm_endpoints
+                ],
+                hedge=settings.llm_hedge,
+                hedge_min_ms=settings.llm_hedge_min_ms,
+            )
+        elif settings.llm_api_base and settings.llm_api_key:
+            grok = GrokClient(settings.llm_api_base, settings.llm_api_key)
+    if grok and settings.record_path:
+        from replay.recorder import RecordingLLM, Recorder
+
+        grok = RecordingLLM(client=grok, recorder=Recorder.for_path(settings.record_path))
+    if grok and settings.llm_cache_path:
+        grok = CachedLLM(
+            client=grok,
+            cache=ResponseCache(
+                settings.llm_cache_path,
+                ttl_sec=settings.llm_cache_ttl_sec,
+                max_entries=settings.llm_cache_max_entries,
+            ),
+        )
+    return grok
+
+
+def invalidated_caches(changed: list[str]) -> list[str]:
+    caches = []
+    if MEMORY_FIELDS.intersection(changed):
+        caches.append("memory")
+    if LLM_ANSWER_FIELDS.intersection(changed):
+        caches.append("llm_responses")
+    return caches
+
+
+@dataclass(frozen=True)
+class PromptPrefix:
+    # The per-user system prompt. Rendered once per profile version so the
+    # bytes sent to the provider stay identical turn after turn.
+    version: tuple
+    text: str
+    key: str
 
 
 @dataclass
@@ -21,64 +147,242 @@ class Brain:
     settings: Settings
     memory: MemoryService
     pipeline: MemoryPipeline
-    grok: GrokClient | None = None
+    grok: LLMClient | None = None
+    # Set by the runtime; without one, maintenance runs inline in the turn.
+    scheduler: Scheduler | None = None
+    _lang_streaks: dict[str, tuple[str, int]] = field(default_factory=dict, init=False, repr=False)
+    _pending: Settings | None = field(default=None, init=False, repr=False)
+    _prefixes: dict[str, PromptPrefix] = field(default_factory=dict, init=False, repr=False)
+    # One lock per user: a turn waits for a prefetch of the same user instead
+    # of loading everything a second time, and a prefetch never runs mid-turn.
+    _user_locks: dict[str, threading.Lock] = field(default_factory=dict, init=False, repr=False)
+    _user_locks_guard: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
 
     @classmethod
     def build(cls, settings: Settings) -> "Brain":
-        memory = MemoryService(
-            MemoryConfig(
-                host=settings.db_host,
-                port=settings.db_port,
-                dbname=settings.db_name,
-                user=settings.db_user,
-                password=settings.db_password,
-                cache_ttl_sec=settings.memory_cache_ttl_sec,
-            )
-        )
+        memory = MemoryService(memory_config(settings))
         pipeline = MemoryPipeline(
             memory=memory,
-            retriever=Retriever(min_score=settings.memory_min_relevance),
+            retriever=build_retriever(settings),
             summarizer=LocalSummarizer(),
             max_context_items=settings.memory_max_context_items,
         )
-        grok = None
-        if settings.llm_provider and settings.llm_provider.lower() == "grok":
-            if settings.llm_api_base and settings.llm_api_key:
-                grok = GrokClient(settings.llm_api_base, settings.llm_api_key)
-        return cls(settings=settings, memory=memory, pipeline=pipeline, grok=grok)
+        return cls(settings=settings, memory=memory, pipeline=pipeline, grok=build_llm(settings))
 
-    def handle(self, user_id: str, message: str) -> str:
-        self.memory.add_message(user_id, "user", message)
+    def reconfigure(self, settings: Settings) -> None:
+        # Swapped in at the start of the next turn, so a turn never sees a
+        # mix of old and new values.
+        self._pending = settings
 
-        recent, relevant, summary = self.pipeline.build_context(user_id, message)
-        profile = self.memory.get_profile(user_id)
-        language = self._resolve_language(message, profile)
-        if profile and language and profile.language != language:
-            profile.language = language
-            self.memory.upsert_profile(profile)
-        elif profile is None and language:
-            self.memory.upsert_profile(UserProfile(user_id=user_id, language=language))
-
-        shortcut = self._shortcut_reply(message, recent)
+    def _apply_pending(self) -> None:
+        new, self._pending = self._pending, None
+        if new is None:
+            return
+        old = self.settings
+        changed = [name for name in MEMORY_FIELDS | LLM_FIELDS if getattr(old, name) != getattr(new, name)]
+        self.pipeline.retriever = build_retriever(new)
+        self.pipeline.max_context_items = new.memory_max_context_items
+        if MEMORY_FIELDS.intersection(changed):
+            self.memory.close()
+            self.memory.flush_cache()
+            self.memory.config = memory_config(new)
+        else:
+            self.memory.config.cache_ttl_sec = new.memory_cache_ttl_sec
+        if LLM_FIELDS.intersection(changed):
+            old_llm = self.grok
+            self.grok = build_llm(new)
+            if isinstance(old_llm, CachedLLM):
+                if LLM_ANSWER_FIELDS.intersection(changed) and isinstance(self.grok, CachedLLM):
+                    self.grok.cache.clear()
+                old_llm.cache.close()
+            from adapters.pool import find_pool
+
+            old_pool = find_pool(old_llm)
+            if old_pool is not None:
+                old_pool.close()
+        self.settings = new
+
+    def handle(self, user_id: str, message: str, on_chunk: Callable[[str], None] | None = None) -> str:
+        # With on_chunk, the reply is delivered through it (in pieces when the
+        # LLM streams) and the caller must not send the return value again.
+        self._apply_pending()
+        if on_chunk is not None:
+            on_chunk = _delivering(on_chunk)
+        started = time.perf_counter()
+        deadline = Deadline(self.settings.turn_deadline_ms, self.settings.turn_budgets_ms)
+        slot = self.scheduler.interactive() if self.scheduler is not None else nullcontext()
+        try:
+            with slot, self._user_lock(user_id), profiler.turn(user_id):
+                return self._handle(user_id, message, deadline, on_chunk)
+        finally:
+            metrics.observe("turn_ms", (time.perf_counter() - started) * 1000)
+            if deadline.degraded:
+                metrics.incr("degraded_turns")
+
+    def _user_lock(self, user_id: str) -> threading.Lock:
+        with self._user_locks_guard:
+            lock = self._user_locks.get(user_id)
+            if lock is None:
+                lock = self._user_locks[user_id] = threading.Lock()
+            return lock
+
+    def warm(self, user_id: str) -> bool:
+        # Loads what the next turn of user_id reads first: history with its
+        # BM25 index, profile and prompt prefix. False if a turn is running.
+        lock = self._user_lock(user_id)
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            recent = self.pipeline.recent(user_id)
+            if len(recent):
+                recent.bm25(self.pipeline.retriever.stemming)
+            self._prefix(user_id, self.memory.get_profile(user_id))
+        finally:
+            lock.release()
+        return True
+
+    def _handle(
+        self,
+        user_id: str,
+        message: str,
+        deadline: Deadline,
+        on_chunk: Callable[[str], None] | None = None,
+    ) -> str:
+        with profiler.span("store_user"):
+            self.memory.add_message(user_id, "user", message)
+
+        with profiler.span("build_context"):
+            stale_ok = not deadline.allows("context")
+            if stale_ok:
+                deadline.degrade("cached_context")
+            recent = self.pipeline.recent(user_id, stale_ok=stale_ok)
+            if deadline.allows("retrieval"):
+                relevant, summary = self.pipeline.relevant(message, recent)
+            else:
+                deadline.degrade("skip_retrieval")
+                relevant, summary = [], ""
+        with profiler.span("profile"):
+            profile = self.memory.get_profile(user_id)
+            language, persist = self._resolve_language(user_id, message, profile)
+            if persist and profile:
+                profile.language = language
+                self.memory.upsert_profile(profile)
+            elif persist:
+                self.memory.upsert_profile(UserProfile(user_id=user_id, language=language))
+
+        with profiler.span("shortcut"):
+            shortcut = self._shortcut_reply(message, recent)
         if shortcut:
-            self.memory.add_message(user_id, "assistant", shortcut)
-            return shortcut
+            metrics.incr("shortcut_replies")
+            return self._local_reply(user_id, shortcut, on_chunk)
 
         if not self.grok:
-            reply = self._fallback_reply(summary)
+            return self._local_reply(user_id, self._fallback_reply(summary), on_chunk)
+
+        if not deadline.allows("llm"):
+            # Too late for the LLM: a looser shortcut, else the local fallback.
+            loose = self._shortcut_reply(message, recent, self.settings.routing_shortcut_similarity - 0.1)
+            deadline.degrade("shortcut" if loose else "fallback")
+            return self._local_reply(user_id, loose or self._fallback_reply(summary), on_chunk)
+
+        prompt = self._build_prompt(user_id, message, summary, profile, relevant, language)
+        if not deadline.allows("llm_full"):
+            prompt.max_tokens = max(256, int(prompt.max_tokens * deadline.fraction("llm_full")))
+            deadline.degrade("small_reply")
+        prompt.timeout_sec = deadline.timeout_sec()
+        try:
+            if on_chunk is not None and hasattr(self.grok, "stream"):
+                reply = self._stream_reply(prompt, on_chunk, deadline)
+            else:
+                reply = self._generate(prompt)
+                if on_chunk is not None:
+                    on_chunk(reply)
+        except OSError as exc:
+            # Timeouts and connection errors (requests raises OSError subclasses).
+            print(f"[brain] LLM indisponível: {exc}")
+            deadline.degrade("llm_unavailable")
+            return self._local_reply(user_id, self._fallback_reply(summary), on_chunk)
+        with profiler.span("store_reply"):
             self.memory.add_message(user_id, "assistant", reply)
-            return reply
 
-        prompt = self._build_prompt(message, summary, profile, relevant, language)
-        response = self.grok.generate(prompt)
+        if deadline.remaining_ms() <= 0:
+            deadline.degrade("skip_maintenance")
+        else:
+            with profiler.span("maintenance"):
+                self._maybe_maintenance(user_id, recent)
+        return reply
 
-        reply = response.text.strip() or "Ok."
+    def _local_reply(self, user_id: str, reply: str, on_chunk: Callable[[str], None] | None) -> str:
         self.memory.add_message(user_id, "assistant", reply)
-
-        self._maybe_maintenance(user_id, recent)
+        if on_chunk is not None:
+            on_chunk(reply)
         return reply
 
-    def _maybe_maintenance(self, user_id: str, recent: list[MemoryItem]) -> None:
+    def _generate(self, prompt: LLMRequest) -> str:
+        llm_started = time.perf_counter()
+        with profiler.span("llm"):
+            response = self.grok.generate(prompt)
+        llm_ms = (time.perf_counter() - llm_started) * 1000
+        metrics.observe("llm_ms", llm_ms)
+        if self.scheduler is not None:
+            self.scheduler.exclude(llm_ms)
+        if response.prompt_tokens:
+            # Split by whether the provider served the prefix from its cache,
+            # so the latency and token savings can be compared directly.
+            metrics.observe("llm_ms_prefix_cached" if response.cached_tokens else "llm_ms_prefix_cold", llm_ms)
+            metrics.incr("llm_prompt_tokens", response.prompt_tokens)
+            metrics.incr("llm_cached_tokens", response.cached_tokens)
+            if self.scheduler is not None:
+                self.scheduler.charge(Priority.INTERACTIVE, response.prompt_tokens)
+        return response.text.strip() or "Ok."
+
+    def _stream_reply(self, prompt: LLMRequest, on_chunk: Callable[[str], None], deadline: Deadline) -> str:
+        chunker = ReplyChunker(
+            on_chunk,
+            min_chars=self.settings.reply_chunk_min_chars,
+            min_interval_sec=self.settings.reply_chunk_interval_ms / 1000,
+        )
+        llm_started = time.perf_counter()
+        first = True
+        try:
+            with profiler.span("llm"):
+                for delta in self.grok.stream(prompt):
+                    if first:
+                        first = False
+                        metrics.observe("llm_first_chunk_ms", (time.perf_counter() - llm_started) * 1000)
+                    chunker.feed(delta)
+        except DeliveryError:
+            raise
+        except Exception as exc:
+            if not chunker.sent and self.scheduler is not None:
+                # Leaving below; the interrupted case is counted at the end.
+                self.scheduler.exclude((time.perf_counter() - llm_started) * 1000)
+            if isinstance(exc, TimeoutError) and not chunker.sent:
+                # The turn's deadline is spent; a second call would overrun it.
+                raise
+            if not chunker.sent:
+                # Nothing reached the user yet, so answer in one piece instead,
+                # with what is left of the deadline (the ladder's local reply
+                # when that is too little).
+                if not deadline.allows("llm"):
+                    raise TimeoutError("sem tempo para repetir sem streaming") from exc
+                metrics.incr("llm_stream_fallback")
+                prompt.timeout_sec = deadline.timeout_sec()
+                reply = self._generate(prompt)
+                on_chunk(reply)
+                return reply
+            print(f"[brain] stream interrompido: {exc}")
+        chunker.close()
+        llm_ms = (time.perf_counter() - llm_started) * 1000
+        metrics.observe("llm_ms", llm_ms)
+        if self.scheduler is not None:
+            self.scheduler.exclude(llm_ms)
+        metrics.incr("reply_chunks", len(chunker.sent))
+        if not chunker.sent:
+            on_chunk("Ok.")
+        return chunker.text or "Ok."
+
+    def _maybe_maintenance(self, user_id: str, recent: HistoryBuffer) -> None:
         if not self.grok:
             return
         count = self.memory.count_messages(user_id)
@@ -88,23 +392,68 @@ class Brain:
         if count % self.settings.grok_maintenance_every == 0:
             self._update_profile(user_id, recent)
 
-    def _update_profile(self, user_id: str, recent: list[MemoryItem]) -> None:
+    def _update_profile(self, user_id: str, recent: HistoryBuffer) -> None:
+        # Incremental: only messages after the profile's watermark are sent,
+        # with the current profile as compact JSON, and the reply is a delta.
         if not self.grok:
             return
-        snippet = "\n".join([f"{i.role}: {i.text}" for i in recent[:20]])
+        profile = self.memory.get_profile(user_id)
+        if profile is not None and profile.watermark_at is not None:
+            new = recent.newer_than(profile.watermark_at, profile.watermark_id)
+        else:
+            new = len(recent)
+        new = min(new, PROFILE_UPDATE_MAX_MESSAGES)
+        if new == 0:
+            metrics.incr("profile_update_skipped")
+            return
+        metrics.incr("profile_update_messages", new)
+        current = {name: getattr(profile, name) for name in PROFILE_FIELDS if profile and getattr(profile, name)}
+        lines = [f"{recent.role(i)}: {recent.texts[i]}" for i in reversed(range(new))]
         req = LLMRequest(
             system=(
                 "Extraia estilo, preferências e persona do usuário. "
-                "Responda em texto curto com quatro linhas: persona=..., style=..., preferences=..., language=..."
+                "Você recebe o perfil atual em JSON e só as mensagens novas. "
+                "Responda apenas com as linhas dos campos que mudaram, no formato "
+                "persona=..., style=..., preferences=..., language=...; se nada mudou, não responda nada."
             ),
             user="Atualize o perfil do usuário.",
-            context=snippet,
+            context="perfil: " + json.dumps(current, ensure_ascii=False, separators=(",", ":")) + "\n" + "\n".join(lines),
             max_tokens=300,
+            cache=False,
         )
-        resp = self.grok.generate(req).text
-        profile = self._parse_profile(user_id, resp)
-        if profile:
-            self.memory.upsert_profile(profile)
+        mark = (recent.created_at(0), recent.item_id(0))
+        if self.scheduler is None:
+            self._run_profile_update(user_id, req, mark)
+            return
+        # Rough token estimate (4 characters per token) for the class budget.
+        tokens = (len(req.system) + len(req.context)) // 4 + req.max_tokens
+        self.scheduler.submit(
+            Priority.MAINTENANCE,
+            f"profile:{user_id}",
+            lambda: self._run_profile_update(user_id, req, mark),
+            tokens=tokens,
+            key=f"profile:{user_id}",
+        )
+
+    def _run_profile_update(self, user_id: str, req: LLMRequest, mark: tuple[datetime, str]) -> None:
+        if not self.grok:
+            return
+        resp = self.grok.generate(req)
+        metrics.incr("profile_update_prompt_tokens", resp.prompt_tokens)
+        delta = self._parse_profile(user_id, resp.text)
+        # Merged into the profile as it is now (a turn may have changed the
+        # language since the request was built); fields not returned stay.
+        current = self.memory.get_profile(user_id) or UserProfile(user_id=user_id)
+        changes = {
+            name: getattr(delta, name)
+            for name in PROFILE_FIELDS
+            if delta and getattr(delta, name) and getattr(delta, name) != getattr(current, name)
+        }
+        if not changes:
+            self.memory.advance_watermark(user_id, mark[0], mark[1])
+            return
+        metrics.incr("profile_updates")
+        self.memory.upsert_profile(replace(current, **changes, watermark_at=mark[0], watermark_id=mark[1]))
 
     def _parse_profile(self, user_id: str, text: str) -> UserProfile | None:
         persona = None
@@ -130,43 +479,73 @@ class Brain:
             language=language,
         )
 
-    def _shortcut_reply(self, message: str, recent: list[MemoryItem]) -> str | None:
-        if fuzz is None:
+    def _shortcut_reply(self, message: str, recent: HistoryBuffer, min_similarity: float | None = None) -> str | None:
+        try:
+            from rapidfuzz import fuzz
+        except Exception:  # pragma: no cover - optional
             return None
         best_score = 0.0
         best_reply: str | None = None
+        query = text.normalize(message)
 
-        for i in range(len(recent) - 1):
-            if recent[i].role != "user":
+        # recent is newest first, so the answer to the user message at i sits
+        # at i - 1. The message being handled is already stored at 0; skip it.
+        start = 1 if len(recent) and recent.role(0) == "user" and recent.texts[0] == message else 0
+        for i in range(start + 1, len(recent)):
+            if recent.role(i) != "user":
                 continue
-            if recent[i + 1].role != "assistant":
+            if recent.role(i - 1) != "assistant":
                 continue
-            score = fuzz.ratio(message, recent[i].text) / 100.0
+            score = fuzz.ratio(query, text.normalize(recent.texts[i])) / 100.0
             if score > best_score:
                 best_score = score
-                best_reply = recent[i + 1].text
+                best_reply = recent.texts[i - 1]
 
-        if best_score >= self.settings.routing_shortcut_similarity:
+        threshold = self.settings.routing_shortcut_similarity if min_similarity is None else min_similarity
+        if best_score >= threshold:
             return best_reply
         return None
 
+    def _prefix(self, user_id: str, profile: UserProfile | None) -> PromptPrefix:
+        version = (profile.persona, profile.style, profile.preferences, profile.language) if profile else ()
+        cached = self._prefixes.get(user_id)
+        if cached is not None and cached.version == version:
+            metrics.incr("prompt_prefix_reused")
+            return cached
+        metrics.incr("prompt_prefix_rendered")
+        persona = (
+            "Você é um assistente útil e humano, adaptando-se ao usuário."
+            if not profile or not profile.persona
+            else profile.persona
+        )
+        style = profile.style if profile and profile.style else "Responda de forma clara e objetiva."
+        language = profile.language if profile else None
+        lang_rule = f"Responda sempre em {language}." if language else "Responda no idioma do usuário."
+        lines = [persona, style, lang_rule]
+        if profile and profile.preferences:
+            lines.append(f"Preferências do usuário: {profile.preferences}")
+        text = "\n".join(lines)
+        prefix = PromptPrefix(version, text, hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest())
+        self._prefixes[user_id] = prefix
+        return prefix
+
     def _build_prompt(
         self,
+        user_id: str,
         message: str,
         summary: str,
         profile: UserProfile | None,
         relevant: list[MemoryItem],
         language: str | None,
     ) -> LLMRequest:
-        persona = (
-            "Você é um assistente útil e humano, adaptando-se ao usuário."
-            if not profile or not profile.persona
-            else profile.persona
-        )
-        style = profile.style if profile and profile.style else "Responda de forma clara e objetiva."
-        lang_rule = f"Responda sempre em {language}." if language else "Responda no idioma do usuário."
+        # Stable prefix (system, from the profile) first; everything that
+        # changes per turn goes after it, in context and user.
+        prefix = self._prefix(user_id, profile)
 
         context_lines = []
+        if language and language != (profile.language if profile else None):
+            # Detected for this turn but not (yet) persisted to the profile.
+            context_lines.append(f"Responda esta mensagem em {language}.")
         if summary:
             context_lines.append("Resumo relevante: " + summary)
         for item in relevant:
@@ -175,10 +554,11 @@ class Brain:
         context = "\n".join(context_lines)
 
         return LLMRequest(
-            system=f"{persona}\n{style}\n{lang_rule}",
+            system=prefix.text,
             user=message,
             context=context,
             max_tokens=self.settings.llm_max_tokens,
+            prefix_key=prefix.key,
         )
 
     def _fallback_reply(self, summary: str) -> str:
@@ -186,25 +566,23 @@ class Brain:
             return f"Entendi. Resumo do contexto: {summary}"
         return "Entendi."
 
-    def _resolve_language(self, message: str, profile: UserProfile | None) -> str | None:
-        if profile and profile.language:
-            if self._looks_like_portuguese(message):
-                return "Portuguese"
-            if self._looks_like_english(message):
-                return "English"
-            return profile.language
-        if self._looks_like_portuguese(message):
-            return "Portuguese"
-        if self._looks_like_english(message):
-            return "English"
-        return None
-
-    def _looks_like_portuguese(self, text: str) -> bool:
-        markers = ["não", "que", "para", "você", "obrigado", "por favor", "preciso"]
-        t = text.lower()
-        return any(m in t for m in markers)
-
-    def _looks_like_english(self, text: str) -> bool:
-        markers = ["the", "and", "please", "thanks", "need", "help"]
-        t = text.lower()
-        return any(m in t for m in markers)
+    def _resolve_language(self, user_id: str, message: str, profile: UserProfile | None) -> tuple[str | None, bool]:
+        # Returns the language to answer in and whether the profile should be
+        # updated. A switch is only persisted once it is confident and stable.
+        current = profile.language if profile else None
+        detection = langid.detect(message)
+        if detection.language is None or detection.confidence < self.settings.lang_min_confidence:
+            return current, False
+        language = detection.language
+        if language == current:
+            self._lang_streaks.pop(user_id, None)
+            return language, False
+        if current is None:
+            return language, True
+        previous, count = self._lang_streaks.get(user_id, (language, 0))
+        count = count + 1 if previous == language else 1
+        if count >= self.settings.lang_switch_turns:
+            self._lang_streaks.pop(user_id, None)
+            return language, True
+        self._lang_streaks[user_id] = (language, count)
+        return language, False
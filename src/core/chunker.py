@@ -0,0 +1,69 @@
+﻿from __future__ import annotations
+
+import re
+import time
+from typing import Callable
+
+# A sentence ends at . ! ? or … followed by whitespace; a blank line ends a
+# paragraph. Both are places where a message can be cut without splitting a
+# thought in half.
+_PARAGRAPH = re.compile(r"\n\s*\n")
+_SENTENCE = re.compile(r"[.!?…][\"')\]]*\s")
+
+
+class ReplyChunker:
+    # Groups streamed text into messages of at least min_chars, cut at the
+    # last paragraph (or else sentence) boundary, and sends at most one every
+    # min_interval_sec; text arriving faster just makes the next one longer.
+    def __init__(self, emit: Callable[[str], None], min_chars: int = 120, min_interval_sec: float = 1.0) -> None:
+        self.emit = emit
+        self.min_chars = min_chars
+        self.min_interval_sec = min_interval_sec
+        self.sent: list[str] = []
+        self._received: list[str] = []
+        self._buffer = ""
+        self._sent_at: float | None = None
+
+    def _cut(self) -> int:
+        if len(self._buffer) < self.min_chars:
+            return 0
+        for pattern in (_PARAGRAPH, _SENTENCE):
+            cut = 0
+            for match in pattern.finditer(self._buffer, self.min_chars - 1):
+                cut = match.end()
+            if cut:
+                return cut
+        return 0
+
+    def _send(self, part: str) -> None:
+        part = part.strip()
+        if not part:
+            return
+        self.emit(part)
+        self.sent.append(part)
+        self._sent_at = time.monotonic()
+
+    def feed(self, delta: str) -> None:
+        self._received.append(delta)
+        self._buffer += delta
+        if self._sent_at is not None and time.monotonic() - self._sent_at < self.min_interval_sec:
+            return
+        cut = self._cut()
+        if cut:
+            part, self._buffer = self._buffer[:cut], self._buffer[cut:]
+            self._send(part)
+
+    def close(self) -> None:
+        if not self._buffer.strip():
+            return
+        if self._sent_at is not None:
+            wait = self.min_interval_sec - (time.monotonic() - self._sent_at)
+            if wait > 0:
+                time.sleep(wait)
+        part, self._buffer = self._buffer, ""
+        self._send(part)
+
+    @property
+    def text(self) -> str:
+        # The whole reply as generated, stored as one memory item.
+        return "".join(self._received).strip()
@@ -0,0 +1,52 @@
+﻿from __future__ import annotations
+
+import time
+
+from core.metrics import metrics
+
+# Time a stage needs left on the clock to run in full; below it the turn
+# takes the next rung down instead. llm_full is what a reply of the
+# configured max_tokens needs, llm the least worth calling the LLM for.
+DEFAULT_BUDGETS_MS = {
+    "context": 300.0,
+    "retrieval": 200.0,
+    "llm": 1500.0,
+    "llm_full": 6000.0,
+}
+
+
+class Deadline:
+    # Per-turn time budget. A total of 0 disables it: everything is allowed
+    # and nothing is recorded.
+    def __init__(self, total_ms: float, budgets_ms: dict[str, float] | None = None) -> None:
+        self.total_ms = total_ms if total_ms > 0 else float("inf")
+        self.budgets_ms = {**DEFAULT_BUDGETS_MS, **(budgets_ms or {})}
+        self.started = time.perf_counter()
+        self.degraded: list[str] = []
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def remaining_ms(self) -> float:
+        return self.total_ms - self.elapsed_ms()
+
+    def allows(self, stage: str) -> bool:
+        return self.remaining_ms() >= self.budgets_ms.get(stage, 0.0)
+
+    def fraction(self, stage: str) -> float:
+        # Share of the stage budget still available, capped at 1.
+        budget = self.budgets_ms.get(stage, 0.0)
+        if budget <= 0:
+            return 1.0
+        return max(0.0, min(1.0, self.remaining_ms() / budget))
+
+    def timeout_sec(self) -> float | None:
+        remaining = self.remaining_ms()
+        if remaining == float("inf"):
+            return None
+        # At least a second, so a late call still gets a real chance.
+        return max(remaining, 1000.0) / 1000
+
+    def degrade(self, step: str) -> None:
+        self.degraded.append(step)
+        metrics.incr(f"degraded_{step}")
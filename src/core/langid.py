@@ -0,0 +1,98 @@
+﻿from __future__ import annotations
+
+import math
+from collections import Counter
+from dataclasses import dataclass
+
+# Character-trigram naive Bayes over the languages we answer in. The seed
+# text is short chat-style prose; profiles are built once at import.
+
+_SEED = {
+    "Portuguese": """
+        oi tudo bem com você? não sei se entendi o que você quis dizer.
+        preciso de ajuda para organizar minha semana, por favor.
+        obrigado pela resposta, foi muito útil. pode me lembrar amanhã de manhã?
+        qual é o horário de funcionamento da loja? eu queria saber quanto custa.
+        estou cansado hoje, mas ainda tenho que terminar o trabalho.
+        vamos marcar uma reunião na quinta-feira às três horas da tarde.
+        você consegue resumir esse texto para mim? não precisa ser longo.
+        minha mãe está chegando e eu preciso arrumar a casa antes disso.
+        acho que isso não está certo, pode verificar de novo?
+        bom dia! hoje o tempo está ótimo para caminhar no parque.
+        quero aprender a cozinhar pratos simples e saudáveis durante a semana.
+        me manda a lista de compras que fizemos ontem, por gentileza.
+        a gente se fala depois, agora estou no ônibus indo para o trabalho.
+        então, o que você acha dessa ideia? eles também gostaram muito.
+        não consigo acessar minha conta, a senha não funciona mais.
+        também quero saber se vocês entregam no sábado ou só durante a semana.
+        muito obrigada, você me ajudou bastante com essa dúvida.
+        está tudo certo com o pedido? ainda não recebi a confirmação.
+        """,
+    "English": """
+        hi how are you doing today? i am not sure i understood what you meant.
+        i need help organizing my week, please.
+        thanks for the answer, that was really useful. can you remind me tomorrow morning?
+        what time does the store open? i wanted to know how much it costs.
+        i am tired today but i still have to finish the work.
+        let's schedule a meeting on thursday at three in the afternoon.
+        could you summarize this text for me? it does not need to be long.
+        my mother is coming over and i need to clean the house before that.
+        i think this is not right, can you check it again?
+        good morning! the weather is great for a walk in the park today.
+        i want to learn how to cook simple and healthy meals during the week.
+        send me the shopping list we made yesterday, if you would.
+        talk to you later, right now i am on the bus going to work.
+        so what do you think about this idea? they liked it a lot too.
+        i can't access my account, the password doesn't work anymore.
+        i also want to know whether you deliver on saturday or only on weekdays.
+        thank you so much, you helped me a lot with that question.
+        is everything fine with the order? i have not received the confirmation yet.
+        """,
+}
+
+
+def _trigrams(text: str) -> list[str]:
+    padded = " " + " ".join(text.lower().split()) + " "
+    return [padded[i : i + 3] for i in range(len(padded) - 2)]
+
+
+def _build_profile(seed: str, alpha: float = 0.5) -> tuple[dict[str, float], float]:
+    counts = Counter(_trigrams(seed))
+    total = sum(counts.values()) + alpha * (len(counts) + 1)
+    table = {gram: math.log((c + alpha) / total) for gram, c in counts.items()}
+    return table, math.log(alpha / total)
+
+
+PROFILES: dict[str, tuple[dict[str, float], float]] = {lang: _build_profile(seed) for lang, seed in _SEED.items()}
+
+
+@dataclass(frozen=True)
+class Detection:
+    language: str | None
+    confidence: float
+
+
+def detect(text: str, min_trigrams: int = 4) -> Detection:
+    grams = _trigrams(text)
+    scores = dict.fromkeys(PROFILES, 0.0)
+    informative = 0
+    for gram in grams:
+        if gram.strip() == "":
+            continue
+        hit = False
+        for lang, (table, floor) in PROFILES.items():
+            logp = table.get(gram)
+            if logp is None:
+                logp = floor
+            else:
+                hit = True
+            scores[lang] += logp
+        informative += hit
+    if informative < min_trigrams:
+        return Detection(None, 0.0)
+    best = max(scores, key=scores.__getitem__)
+    # Posterior over the candidate languages, averaged per trigram so long
+    # messages are not automatically certain.
+    scale = min(1.0, informative / 12) * 3.0 / informative
+    weights = {lang: math.exp((s - scores[best]) * scale) for lang, s in scores.items()}
+    return Detection(best, weights[best] / sum(weights.values()))
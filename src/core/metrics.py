@@ -0,0 +1,95 @@
+﻿from __future__ import annotations
+
+import bisect
+import threading
+from dataclasses import dataclass, field
+
+# Upper bounds in milliseconds; the last bucket catches everything above.
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, float("inf"))
+
+
+@dataclass
+class Histogram:
+    counts: list[int] = field(default_factory=lambda: [0] * len(BUCKETS_MS))
+    total: int = 0
+    sum_ms: float = 0.0
+    max_ms: float = 0.0
+
+    def observe(self, value_ms: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS_MS, value_ms)] += 1
+        self.total += 1
+        self.sum_ms += value_ms
+        self.max_ms = max(self.max_ms, value_ms)
+
+    def quantile(self, q: float) -> float:
+        if not self.total:
+            return 0.0
+        rank = q * self.total
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.total,
+            "mean_ms": round(self.sum_ms / self.total, 2) if self.total else 0.0,
+            "p50_ms": self.quantile(0.50),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "max_ms": round(self.max_ms, 2),
+            "buckets": {str(b): c for b, c in zip(BUCKETS_MS, self.counts) if c},
+        }
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._histograms: dict[str, Histogram] = {}
+        self._counters: dict[str, int] = {}
+
+    def observe(self, name: str, value_ms: float) -> None:
+        with self._lock:
+            hist = self._histograms.get(name)
+            if hist is None:
+                hist = self._histograms[name] = Histogram()
+            hist.observe(value_ms)
+
+    def incr(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "latency": {name: h.snapshot() for name, h in self._histograms.items()},
+                "counters": dict(self._counters),
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+def merge_snapshots(snapshots: list[dict]) -> dict:
+    # Combines Metrics.snapshot() from several processes (supervisor
+    # workers). Every process uses BUCKETS_MS, so histograms merge exactly.
+    counters: dict[str, int] = {}
+    histograms: dict[str, Histogram] = {}
+    for snap in snapshots:
+        for name, value in snap.get("counters", {}).items():
+            counters[name] = counters.get(name, 0) + value
+        for name, hist in snap.get("latency", {}).items():
+            merged = histograms.setdefault(name, Histogram())
+            for bound, count in hist["buckets"].items():
+                merged.counts[BUCKETS_MS.index(float(bound))] += count
+            merged.total += hist["count"]
+            merged.sum_ms += hist["mean_ms"] * hist["count"]
+            merged.max_ms = max(merged.max_ms, hist["max_ms"])
+    return {"latency": {name: h.snapshot() for name, h in histograms.items()}, "counters": counters}
+
+
+metrics = Metrics()
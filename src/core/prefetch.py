@@ -0,0 +1,60 @@
+﻿from __future__ import annotations
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from core.brain import Brain
+from core.metrics import metrics
+
+# Presence states that usually mean a message is on its way.
+WARM_STATES = frozenset({"composing", "recording"})
+
+
+class Prefetcher:
+    # Warms a user's turn context when the gateway reports them typing. A user
+    # is warmed at most once per ttl_sec (typing repeats every few seconds),
+    # and at most max_concurrent warms run at a time; beyond that the event is
+    # dropped rather than queued, since a late warm-up is worth nothing.
+    def __init__(self, brain: Brain, ttl_sec: float = 30.0, max_concurrent: int = 4) -> None:
+        self.brain = brain
+        self.ttl_sec = ttl_sec
+        self.max_concurrent = max_concurrent
+        self._lock = threading.Lock()
+        self._warmed: dict[str, float] = {}
+        self._inflight: set[str] = set()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="prefetch")
+
+    def on_presence(self, user_id: str, state: str) -> bool:
+        if state not in WARM_STATES:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if user_id in self._inflight or now - self._warmed.get(user_id, float("-inf")) < self.ttl_sec:
+                metrics.incr("prefetch_skipped")
+                return False
+            if len(self._inflight) >= self.max_concurrent:
+                metrics.incr("prefetch_dropped")
+                return False
+            self._inflight.add(user_id)
+            self._warmed[user_id] = now
+            if len(self._warmed) > 4096:
+                cutoff = now - self.ttl_sec
+                self._warmed = {user: at for user, at in self._warmed.items() if at >= cutoff}
+        self._executor.submit(self._warm, user_id)
+        return True
+
+    def _warm(self, user_id: str) -> None:
+        started = time.perf_counter()
+        try:
+            if self.brain.warm(user_id):
+                metrics.incr("prefetch_warmed")
+                metrics.observe("prefetch_ms", (time.perf_counter() - started) * 1000)
+        except Exception as exc:
+            print(f"[prefetch] erro para {user_id}: {exc}")
+        finally:
+            with self._lock:
+                self._inflight.discard(user_id)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,192 @@
+﻿from __future__ import annotations
+
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Iterator
+
+_NOOP = nullcontext()
+
+
+def _frame_label(frame) -> str:
+    # No line number: samples of the same function must fold into one frame.
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name})"
+
+
+class StackSampler:
+    # Samples every thread's stack at a fixed interval and aggregates them in
+    # the folded format read by flamegraph.pl and speedscope.
+    def __init__(self, interval_sec: float = 0.005) -> None:
+        self.interval_sec = interval_sec
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self, seconds: float, on_done) -> None:
+        self._thread = threading.Thread(target=self._run, args=(seconds, on_done), daemon=True, name="turion-sampler")
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self, seconds: float, on_done) -> None:
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        deadline = time.monotonic() + seconds
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                parts = []
+                while frame is not None:
+                    parts.append(_frame_label(frame))
+                    frame = frame.f_back
+                parts.append(names.get(ident) or str(ident))
+                self.stacks[";".join(reversed(parts))] += 1
+            self.samples += 1
+            time.sleep(self.interval_sec)
+        on_done(self)
+
+
+class TurnTrace:
+    def __init__(self, user_id: str) -> None:
+        self.user_id = user_id
+        self.started = time.perf_counter()
+        self.spans: list[tuple[str, float, float]] = []
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.spans.append((name, (start - self.started) * 1000, (end - start) * 1000))
+
+
+class Profiler:
+    def __init__(self, output_dir: str | Path = "data/profiles") -> None:
+        self.output_dir = Path(output_dir)
+        # Appended to file names; workers set "-w<N>" so their files differ.
+        self.tag = ""
+        self._lock = threading.Lock()
+        self._sampler: StackSampler | None = None
+        self._trace_left = 0
+        self._trace_path: Path | None = None
+        self._active_turns = 0
+        self._local = threading.local()
+
+    # -- stack sampling ---------------------------------------------------
+
+    def start_sampling(self, seconds: float = 30.0, interval_sec: float = 0.005) -> Path:
+        with self._lock:
+            if self._sampler is not None:
+                raise RuntimeError("amostragem já em andamento")
+            path = self._new_path("stacks", "folded")
+            self._sampler = StackSampler(interval_sec)
+            self._sampler.start(seconds, lambda s: self._write_stacks(s, path))
+            return path
+
+    def stop_sampling(self) -> None:
+        with self._lock:
+            if self._sampler is not None:
+                self._sampler.stop()
+
+    def _write_stacks(self, sampler: StackSampler, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sampler.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        with self._lock:
+            self._sampler = None
+        print(f"[profiler] {sampler.samples} amostras em {path}")
+
+    # -- per-turn spans -----------------------------------------------------
+
+    def trace_turns(self, turns: int) -> Path:
+        with self._lock:
+            self._trace_path = self._new_path("turns", "jsonl")
+            self._trace_left = turns
+            return self._trace_path
+
+    def stop_tracing(self) -> None:
+        with self._lock:
+            self._trace_left = 0
+
+    @contextmanager
+    def _turn(self, user_id: str) -> Iterator[None]:
+        trace = TurnTrace(user_id)
+        self._local.trace = trace
+        try:
+            yield
+        finally:
+            self._local.trace = None
+            self._write_turn(trace)
+            with self._lock:
+                self._active_turns -= 1
+
+    def turn(self, user_id: str):
+        # Only an int comparison when tracing is off.
+        if self._trace_left <= 0:
+            return _NOOP
+        with self._lock:
+            if self._trace_left <= 0:
+                return _NOOP
+            self._trace_left -= 1
+            self._active_turns += 1
+        return self._turn(user_id)
+
+    def span(self, name: str):
+        if not self._active_turns:
+            return _NOOP
+        trace = getattr(self._local, "trace", None)
+        if trace is None:
+            return _NOOP
+        return trace.span(name)
+
+    def _write_turn(self, trace: TurnTrace) -> None:
+        record = {
+            "user_id": trace.user_id,
+            "at": time.time(),
+            "total_ms": round((time.perf_counter() - trace.started) * 1000, 3),
+            "spans": [{"name": n, "start_ms": round(s, 3), "dur_ms": round(d, 3)} for n, s, d in trace.spans],
+        }
+        with self._lock:
+            path = self._trace_path
+            if path is None:
+                return
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def command(self, cmd: str, args: dict) -> dict:
+        # Control socket commands; workers run the same ones from their inbox.
+        if cmd == "sample":
+            path = self.start_sampling(float(args.get("seconds", 30)), float(args.get("interval_ms", 5)) / 1000)
+            return {"path": str(path)}
+        if cmd == "trace":
+            return {"path": str(self.trace_turns(int(args.get("turns", 20))))}
+        if cmd == "stop":
+            self.stop_sampling()
+            self.stop_tracing()
+        return self.status()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "sampling": self._sampler is not None,
+                "trace_turns_left": self._trace_left,
+                "trace_path": str(self._trace_path) if self._trace_path else None,
+            }
+
+    def _new_path(self, kind: str, ext: str) -> Path:
+        return self.output_dir / f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}{self.tag}.{ext}"
+
+
+profiler = Profiler()
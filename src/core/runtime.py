@@ -0,0 +1,277 @@
+﻿from __future__ import annotations
+
+import importlib
+import threading
+import time
+from pathlib import Path
+from dataclasses import dataclass, field
+
+from adapters.cache import CachedLLM
+from channels.base import InboundMessage, PresenceEvent
+from channels.whatsapp_gateway import WhatsAppGateway
+from config.settings import Settings
+from config.watcher import RESTART_FIELDS, SettingsWatcher, changed_fields
+from core.brain import Brain, invalidated_caches
+from core.metrics import merge_snapshots, metrics
+from core.prefetch import Prefetcher
+from core.profiler import profiler
+from core.scheduler import Priority, Scheduler, build_scheduler
+from core.supervisor import Supervisor, gateway_config, memory_user
+from memory.notify import CacheListener
+
+PARTITION_CHECK_SEC = 6 * 3600
+
+# Heavy modules first needed on the first turn; imported off the startup path
+# so the gateway and control socket come up without waiting for them.
+PRELOAD = ("requests", "numpy", "rapidfuzz", "psycopg2", "psycopg2.extras")
+
+
+def _preload() -> None:
+    for name in PRELOAD:
+        try:
+            importlib.import_module(name)
+        except Exception:  # pragma: no cover - optional
+            pass
+
+
+def local_stats(brain: Brain | None, listener: CacheListener | None, scheduler: Scheduler | None) -> dict:
+    # What one process can report. Supervisor workers answer "stats" with
+    # this and the supervisor merges their replies.
+    data = metrics.snapshot()
+    caches: dict = {}
+    if brain is not None:
+        caches["memory_users"] = brain.memory.cache_size()
+        if listener is not None:
+            caches["notify"] = listener.stats()
+        if isinstance(brain.grok, CachedLLM):
+            stats = brain.grok.cache.stats
+            caches["llm_responses"] = {
+                "size": stats.size,
+                "hits": stats.hits,
+                "misses": stats.misses,
+                "evictions": stats.evictions,
+                "hit_rate": round(stats.hit_rate, 4),
+            }
+        from adapters.pool import find_pool
+
+        pool = find_pool(brain.grok)
+        if pool is not None:
+            data["llm_endpoints"] = pool.stats()
+    data["caches"] = caches
+    if scheduler is not None:
+        data["scheduler"] = scheduler.stats()
+    return data
+
+
+@dataclass
+class AgentRuntime:
+    settings: Settings
+    gateway: WhatsAppGateway
+    brain: Brain | None = None
+    supervisor: Supervisor | None = None
+    scheduler: Scheduler | None = None
+    prefetcher: Prefetcher | None = None
+    listener: CacheListener | None = None
+    started_at: float = field(default_factory=time.time)
+    _partitions_at: float = field(default=0.0, init=False, repr=False)
+    _snapshot_at: float = field(default_factory=time.monotonic, init=False, repr=False)
+    _watcher: SettingsWatcher | None = field(default=None, init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self._watcher = SettingsWatcher(self.settings)
+
+    @classmethod
+    def start(cls, settings: Settings) -> "AgentRuntime":
+        if settings.profile_dir:
+            profiler.output_dir = Path(settings.profile_dir)
+        multi = settings.agent_workers > 1
+        if multi and not settings.memory_per_sender:
+            # One shared memory user shards every turn onto one worker, which
+            # is slower than a single process.
+            print("[supervisor] AGENT_WORKERS > 1 exige MEMORY_PER_SENDER=true; usando um processo")
+            multi = False
+        if multi:
+            print(f"Supervisor iniciado com {settings.agent_workers} workers. Modo:", settings.mode)
+            supervisor = Supervisor(settings=settings, workers=settings.agent_workers)
+            supervisor.start()
+            gateway = WhatsAppGateway(
+                gateway_config(settings),
+                on_message=supervisor.dispatch,
+                on_presence=supervisor.dispatch_presence,
+            )
+            # dispatch() only queues the turn; ack once a worker reports it done.
+            gateway.deferred_ack = True
+            supervisor.on_done = gateway.done
+            runtime = cls(settings=settings, gateway=gateway, supervisor=supervisor)
+        else:
+            print("Agent iniciado. Modo:", settings.mode)
+            brain = Brain.build(settings)
+            if settings.snapshot_path:
+                warm = brain.memory.load_snapshot(settings.snapshot_path)
+                if warm:
+                    print(f"[snapshot] {warm} usuários em {settings.snapshot_path}")
+            runtime = cls(settings=settings, gateway=WhatsAppGateway(gateway_config(settings)), brain=brain)
+            runtime.gateway.on_message = runtime._on_message
+            runtime.prefetcher = Prefetcher(brain, settings.prefetch_ttl_sec, settings.prefetch_max_concurrent)
+            runtime.gateway.on_presence = runtime._on_presence
+            if settings.memory_notify and settings.db_password:
+                runtime.listener = CacheListener(brain.memory)
+                runtime.listener.start()
+        runtime.scheduler = build_scheduler(settings)
+        runtime.scheduler.start()
+        if runtime.brain is not None:
+            runtime.brain.scheduler = runtime.scheduler
+        runtime.gateway.start()
+        threading.Thread(target=_preload, name="preload", daemon=True).start()
+        return runtime
+
+    def _on_message(self, msg: InboundMessage) -> None:
+        assert self.brain is not None
+        if self.settings.reply_streaming:
+            self.brain.handle(memory_user(self.settings, msg.sender), msg.text, on_chunk=lambda part: self.gateway.send(msg.sender, part))
+            return
+        reply = self.brain.handle(memory_user(self.settings, msg.sender), msg.text)
+        self.gateway.send(msg.sender, reply)
+
+    def _on_presence(self, event: PresenceEvent) -> None:
+        if self.prefetcher is not None and self.settings.prefetch_ttl_sec > 0:
+            self.prefetcher.on_presence(memory_user(self.settings, event.sender), event.state)
+
+    def tick(self) -> None:
+        if self.supervisor is not None:
+            self.supervisor.check_workers()
+        new = self._watcher.poll()
+        if new is not None:
+            report = self._apply_settings(new)
+            print(f"[settings] .env recarregado: {', '.join(report['changed'])}")
+            if report["restart_required"]:
+                print(f"[settings] exige reinício: {', '.join(report['restart_required'])}")
+        every = self.settings.snapshot_every_sec
+        if every > 0 and time.monotonic() - self._snapshot_at >= every:
+            self._snapshot_at = time.monotonic()
+            self._background("snapshot", self.save_snapshot)
+        if self.settings.db_password and time.time() - self._partitions_at >= PARTITION_CHECK_SEC:
+            self._partitions_at = time.time()
+            self._background("partitions", self._maintain_partitions)
+
+    def _background(self, name: str, run) -> None:
+        if self.scheduler is not None:
+            self.scheduler.submit(Priority.BATCH, name, run, key=name)
+        else:
+            threading.Thread(target=run, name=name, daemon=True).start()
+
+    def _maintain_partitions(self) -> None:
+        # Upcoming months are created ahead of time and, with
+        # MEMORY_RETENTION_MONTHS, old ones archived and detached.
+        import psycopg2
+
+        from memory.partitions import maintain
+
+        settings = self.settings
+        try:
+            conn = psycopg2.connect(
+                host=settings.db_host,
+                port=settings.db_port,
+                dbname=settings.db_name,
+                user=settings.db_user,
+                password=settings.db_password,
+                connect_timeout=5,
+            )
+        except Exception as exc:
+            print(f"[partições] sem conexão com o banco: {exc}")
+            return
+        try:
+            maintain(
+                conn,
+                months_ahead=settings.memory_partition_months_ahead,
+                hash_partitions=settings.memory_partition_hash,
+                retention_months=settings.memory_retention_months,
+                archive_dir=settings.memory_archive_dir,
+            )
+        except Exception as exc:
+            print(f"[partições] erro: {exc}")
+        finally:
+            conn.close()
+
+    def stats(self) -> dict:
+        data = local_stats(self.brain, self.listener, self.scheduler)
+        data["uptime_sec"] = round(time.time() - self.started_at, 1)
+        data["queues"] = {"event_log_backlog": self.gateway.backlog()}
+        caches = data["caches"]
+        if self.supervisor is not None:
+            # Turns, caches and the LLM clients live in the workers: latency
+            # and counters are merged, the rest is listed per worker.
+            data["queues"]["workers"] = self.supervisor.queue_depths()
+            replies = self.supervisor.control("stats")
+            answered = [r for r in replies if r is not None and "error" not in r]
+            data.update(merge_snapshots([data, *answered]))
+            caches["memory_users"] = sum(r["caches"].get("memory_users", 0) for r in answered)
+            data["workers"] = [
+                {key: r.get(key) for key in ("caches", "scheduler", "llm_endpoints")} if r is not None else None
+                for r in replies
+            ]
+        counters = data.get("counters", {})
+        if counters.get("llm_prompt_tokens"):
+            caches["llm_prefix"] = {
+                "rendered": counters.get("prompt_prefix_rendered", 0),
+                "reused": counters.get("prompt_prefix_reused", 0),
+                "cached_token_ratio": round(counters.get("llm_cached_tokens", 0) / counters["llm_prompt_tokens"], 4),
+            }
+        return data
+
+    def flush_cache(self, user_id: str | None = None) -> int:
+        if self.supervisor is not None:
+            replies = self.supervisor.control("cache.flush", {"user_id": user_id})
+            return sum(r.get("dropped", 0) for r in replies if r is not None)
+        if self.brain is None:
+            return 0
+        return self.brain.memory.flush_cache(user_id)
+
+    def reload_settings(self) -> dict:
+        new = self._watcher.load()
+        if self._watcher.last_error:
+            raise ValueError(self._watcher.last_error)
+        if new is None:
+            return {"changed": [], "restart_required": [], "invalidated": []}
+        return self._apply_settings(new)
+
+    def _apply_settings(self, new: Settings) -> dict:
+        # The brain swaps at its next turn; workers run their own watcher
+        # (see supervisor), and respawned ones start from the new settings.
+        changed = changed_fields(self.settings, new)
+        self.settings = new
+        if self.brain is not None:
+            self.brain.reconfigure(new)
+        if self.supervisor is not None:
+            self.supervisor.settings = new
+        if self.scheduler is not None:
+            self.scheduler.configure(new.scheduler_concurrency, new.scheduler_tokens_per_min)
+            self.scheduler.target_ms = new.scheduler_target_ms
+        if self.prefetcher is not None:
+            self.prefetcher.ttl_sec = new.prefetch_ttl_sec
+        return {
+            "changed": changed,
+            "restart_required": [name for name in changed if name in RESTART_FIELDS],
+            "invalidated": invalidated_caches(changed),
+        }
+
+    def save_snapshot(self) -> int:
+        if self.brain is None or not self.settings.snapshot_path:
+            return 0
+        try:
+            return self.brain.memory.save_snapshot(self.settings.snapshot_path)
+        except OSError as exc:
+            print(f"[snapshot] erro ao gravar: {exc}")
+            return 0
+
+    def stop(self) -> None:
+        self.gateway.stop()
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        if self.listener is not None:
+            self.listener.stop()
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        self.save_snapshot()
+        if self.supervisor is not None:
+            self.supervisor.stop()
@@ -0,0 +1,254 @@
+﻿from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Callable, Iterator
+
+from config.settings import Settings
+from core.metrics import metrics
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    MAINTENANCE = 1
+    BATCH = 2
+
+
+DEFAULT_CONCURRENCY = {"interactive": 4, "maintenance": 1, "batch": 1}
+
+
+@dataclass
+class Job:
+    priority: Priority
+    name: str
+    run: Callable[[], None]
+    tokens: int = 0
+    key: str | None = None
+    queued_at: float = field(default_factory=time.monotonic)
+    deferred: bool = False
+
+
+@dataclass
+class _Bucket:
+    # Token bucket refilled continuously at tokens_per_min; 0 is unlimited.
+    tokens_per_min: float
+    level: float = 0.0
+    updated: float = field(default_factory=time.monotonic)
+    used: int = 0
+
+    def __post_init__(self) -> None:
+        self.level = self.tokens_per_min
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.tokens_per_min, self.level + (now - self.updated) * self.tokens_per_min / 60)
+        self.updated = now
+
+    def allows(self, tokens: int) -> bool:
+        # A job bigger than the whole bucket runs once the bucket is full.
+        return self.tokens_per_min <= 0 or self.level >= min(tokens, self.tokens_per_min)
+
+
+class Scheduler:
+    # Interactive turns run on the caller's thread and only pass through
+    # interactive(), which caps their concurrency and tracks their latency:
+    # the wait for a slot plus the turn's own work, minus time the turn
+    # reports through exclude() (the LLM call, which background jobs do not
+    # slow down and which alone often exceeds target_ms).
+    # Maintenance and batch jobs queue here and run on the scheduler's own
+    # threads, highest class first, within each class's concurrency and token
+    # budget. While interactive latency is above target_ms they are deferred
+    # (a running job is never interrupted), up to max_defer_sec.
+    def __init__(
+        self,
+        concurrency: dict[str, float] | None = None,
+        tokens_per_min: dict[str, float] | None = None,
+        target_ms: float = 2000.0,
+        max_defer_sec: float = 60.0,
+        quiet_sec: float = 2.0,
+        alpha: float = 0.2,
+    ) -> None:
+        self.target_ms = target_ms
+        self.max_defer_sec = max_defer_sec
+        self.quiet_sec = quiet_sec
+        self.alpha = alpha
+        self._cond = threading.Condition()
+        self._queues: dict[Priority, deque[Job]] = {p: deque() for p in Priority}
+        self._running: dict[Priority, int] = {p: 0 for p in Priority}
+        self._limits: dict[Priority, int] = {}
+        self._buckets: dict[Priority, _Bucket] = {}
+        self._interactive_ms: float | None = None
+        self._interactive_done = 0.0
+        self._deferred = 0
+        self._threads: list[threading.Thread] = []
+        self._started = False
+        self._stopped = False
+        self._local = threading.local()
+        self.configure(concurrency or {}, tokens_per_min or {})
+
+    def configure(self, concurrency: dict[str, float], tokens_per_min: dict[str, float]) -> None:
+        with self._cond:
+            for p in Priority:
+                name = p.name.lower()
+                self._limits[p] = max(1, int(concurrency.get(name, DEFAULT_CONCURRENCY[name])))
+                budget = float(tokens_per_min.get(name, 0))
+                bucket = self._buckets.get(p)
+                if bucket is None or bucket.tokens_per_min != budget:
+                    self._buckets[p] = _Bucket(budget)
+            if self._started:
+                self._spawn()
+            self._cond.notify_all()
+
+    def start(self) -> None:
+        with self._cond:
+            self._started = True
+            self._spawn()
+
+    def _spawn(self) -> None:
+        # Enough threads for the current limits; a raised limit (hot reload)
+        # adds threads, a lowered one leaves the extras idle.
+        workers = self._limits[Priority.MAINTENANCE] + self._limits[Priority.BATCH]
+        for index in range(len(self._threads), workers):
+            thread = threading.Thread(target=self._work, name=f"scheduler-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    @contextmanager
+    def interactive(self) -> Iterator[None]:
+        started = time.monotonic()
+        with self._cond:
+            while self._running[Priority.INTERACTIVE] >= self._limits[Priority.INTERACTIVE]:
+                self._cond.wait()
+            self._running[Priority.INTERACTIVE] += 1
+        self._local.excluded_ms = 0.0
+        try:
+            yield
+        finally:
+            now = time.monotonic()
+            elapsed = max((now - started) * 1000 - self._local.excluded_ms, 0.0)
+            self._local.excluded_ms = None
+            with self._cond:
+                self._running[Priority.INTERACTIVE] -= 1
+                self._interactive_done = now
+                previous = self._interactive_ms
+                self._interactive_ms = elapsed if previous is None else (1 - self.alpha) * previous + self.alpha * elapsed
+                self._cond.notify_all()
+
+    def exclude(self, ms: float) -> None:
+        # Time the current thread's turn spent waiting on the LLM; a no-op
+        # outside interactive() (e.g. maintenance calling the LLM).
+        if getattr(self._local, "excluded_ms", None) is not None:
+            self._local.excluded_ms += ms
+
+    def charge(self, priority: Priority, tokens: int) -> None:
+        # Tokens actually spent (e.g. by an interactive turn), against its class.
+        with self._cond:
+            bucket = self._buckets[priority]
+            bucket.refill(time.monotonic())
+            bucket.level -= tokens
+            bucket.used += tokens
+
+    def submit(self, priority: Priority, name: str, run: Callable[[], None], tokens: int = 0, key: str | None = None) -> bool:
+        # A job whose key is already queued takes its place (and keeps its
+        # position), so a user's pending maintenance runs once, on the newest
+        # input. Returns False when it replaced one.
+        if priority == Priority.INTERACTIVE:
+            raise ValueError("turnos interativos usam interactive(), não submit()")
+        with self._cond:
+            queue = self._queues[priority]
+            for index, job in enumerate(queue):
+                if key is not None and job.key == key:
+                    queue[index] = Job(priority, name, run, tokens, key, queued_at=job.queued_at, deferred=job.deferred)
+                    return False
+            queue.append(Job(priority, name, run, tokens, key))
+            self._cond.notify_all()
+        return True
+
+    def _pressured(self, now: float) -> bool:
+        if self._interactive_ms is None or self._interactive_ms <= self.target_ms:
+            return False
+        return self._running[Priority.INTERACTIVE] > 0 or now - self._interactive_done < self.quiet_sec
+
+    def _next(self) -> Job | None:
+        now = time.monotonic()
+        pressured = self._pressured(now)
+        for p in (Priority.MAINTENANCE, Priority.BATCH):
+            queue = self._queues[p]
+            if not queue or self._running[p] >= self._limits[p]:
+                continue
+            job = queue[0]
+            if pressured and now - job.queued_at < self.max_defer_sec:
+                if not job.deferred:
+                    job.deferred = True
+                    self._deferred += 1
+                continue
+            bucket = self._buckets[p]
+            bucket.refill(now)
+            if not bucket.allows(job.tokens):
+                continue
+            queue.popleft()
+            bucket.level -= job.tokens
+            bucket.used += job.tokens
+            self._running[p] += 1
+            return job
+        return None
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                job = self._next()
+                while job is None and not self._stopped:
+                    # Woken by submits and finished work; the timeout covers
+                    # token refills and pressure fading.
+                    self._cond.wait(timeout=0.25)
+                    job = self._next()
+                if self._stopped:
+                    if job is not None:
+                        self._running[job.priority] -= 1
+                    return
+            metrics.observe(f"sched_wait_ms_{job.priority.name.lower()}", (time.monotonic() - job.queued_at) * 1000)
+            try:
+                job.run()
+            except Exception as exc:
+                print(f"[scheduler] {job.name} falhou: {exc}")
+            finally:
+                with self._cond:
+                    self._running[job.priority] -= 1
+                    self._cond.notify_all()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._cond:
+            classes = {}
+            for p in Priority:
+                bucket = self._buckets[p]
+                bucket.refill(now)
+                classes[p.name.lower()] = {
+                    "queued": len(self._queues[p]),
+                    "running": self._running[p],
+                    "limit": self._limits[p],
+                    "tokens_used": bucket.used,
+                    "tokens_available": round(bucket.level) if bucket.tokens_per_min > 0 else None,
+                }
+            return {
+                "classes": classes,
+                "interactive_ms": round(self._interactive_ms, 1) if self._interactive_ms is not None else None,
+                "pressured": self._pressured(now),
+                "deferred": self._deferred,
+            }
+
+
+def build_scheduler(settings: Settings) -> Scheduler:
+    return Scheduler(
+        concurrency=dict(settings.scheduler_concurrency),
+        tokens_per_min=dict(settings.scheduler_tokens_per_min),
+        target_ms=settings.scheduler_target_ms,
+    )
@@ -0,0 +1,267 @@
+﻿from __future__ import annotations
+
+import bisect
+import hashlib
+import itertools
+import multiprocessing as mp
+import signal
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+from channels.base import InboundMessage, PresenceEvent
+from channels.whatsapp_gateway import WhatsAppConfig, WhatsAppGateway
+from config.settings import Settings
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, nodes: int, replicas: int = 64) -> None:
+        points = sorted((_hash(f"{node}:{r}"), node) for node in range(nodes) for r in range(replicas))
+        self._keys = [p[0] for p in points]
+        self._nodes = [p[1] for p in points]
+
+    def node_for(self, key: str) -> int:
+        idx = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[idx]
+
+
+def memory_user(settings: Settings, sender: str) -> str:
+    # The memory key a sender's turns read and write, and the sharding key:
+    # it must not be the raw sender when senders share one memory, or several
+    # workers would cache (and go stale on) the same user.
+    if settings.memory_per_sender and sender:
+        return sender
+    return settings.memory_user_id
+
+
+def gateway_config(settings: Settings) -> WhatsAppConfig:
+    return WhatsAppConfig(
+        gateway_url=settings.whatsapp_gateway_url or "http://127.0.0.1:3001",
+        api_key=settings.whatsapp_api_key,
+        event_log_dir=settings.event_log_dir,
+        record_path=settings.record_path,
+    )
+
+
+def _worker_main(index: int, settings: Settings, inbox: mp.Queue, control: mp.Queue, results: mp.Queue) -> None:
+    from config.watcher import SettingsWatcher
+    from core.brain import Brain
+    from core.prefetch import Prefetcher
+    from core.profiler import profiler
+    from core.runtime import local_stats
+    from core.scheduler import build_scheduler
+    from memory.notify import CacheListener
+
+    # systemd signals the whole group; shutdown is driven by the supervisor
+    # (None on the inbox) so the worker can write its snapshot first.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if settings.profile_dir:
+        profiler.output_dir = Path(settings.profile_dir)
+    profiler.tag = f"-w{index}"
+    brain = Brain.build(settings)
+    brain.scheduler = build_scheduler(settings)
+    brain.scheduler.start()
+    wa = WhatsAppGateway(gateway_config(settings))
+    prefetcher = Prefetcher(brain, settings.prefetch_ttl_sec, settings.prefetch_max_concurrent)
+    listener = None
+    if settings.memory_notify and settings.db_password:
+        # Workers own disjoint users but the setup wizard and other hosts do
+        # not, so each worker listens for its own caches.
+        listener = CacheListener(brain.memory)
+        listener.start()
+    # Users hash to a fixed worker, so each one keeps its own snapshot.
+    snapshot_path = f"{settings.snapshot_path}.{index}" if settings.snapshot_path else None
+    if snapshot_path:
+        brain.memory.load_snapshot(snapshot_path)
+
+    def serve_control() -> None:
+        # Control commands run here, not behind queued turns on the inbox.
+        while True:
+            item = control.get()
+            if item is None:
+                return
+            request, cmd, args = item
+            try:
+                if cmd == "stats":
+                    data: Any = local_stats(brain, listener, brain.scheduler)
+                elif cmd == "cache.flush":
+                    data = {"dropped": brain.memory.flush_cache(args.get("user_id"))}
+                elif cmd.startswith("profile."):
+                    data = profiler.command(cmd.split(".", 1)[1], args)
+                else:
+                    data = {"error": f"comando desconhecido: {cmd}"}
+            except Exception as exc:
+                data = {"error": str(exc)}
+            results.put(("reply", index, request, data))
+
+    threading.Thread(target=serve_control, name="worker-control", daemon=True).start()
+    saved_at = time.monotonic()
+    watcher = SettingsWatcher(settings)
+    print(f"[worker {index}] pronto")
+    while True:
+        msg = inbox.get()
+        if isinstance(msg, PresenceEvent):
+            if settings.prefetch_ttl_sec > 0:
+                prefetcher.on_presence(memory_user(settings, msg.sender), msg.state)
+            continue
+        if msg is None:
+            if listener is not None:
+                listener.stop()
+            prefetcher.close()
+            brain.scheduler.stop()
+            if snapshot_path:
+                brain.memory.save_snapshot(snapshot_path)
+            return
+        new = watcher.poll()
+        if new is not None:
+            brain.reconfigure(new)
+            brain.scheduler.configure(new.scheduler_concurrency, new.scheduler_tokens_per_min)
+            brain.scheduler.target_ms = new.scheduler_target_ms
+            prefetcher.ttl_sec = new.prefetch_ttl_sec
+            settings = new
+        # The supervisor acks the event log only after "done"; a "start"
+        # without one means this worker died mid-turn.
+        results.put(("start", index, msg.offset))
+        ok = True
+        try:
+            if settings.reply_streaming:
+                brain.handle(memory_user(settings, msg.sender), msg.text, on_chunk=lambda part: wa.send(msg.sender, part))
+            else:
+                reply = brain.handle(memory_user(settings, msg.sender), msg.text)
+                wa.send(msg.sender, reply)
+        except Exception as exc:
+            ok = False
+            print(f"[worker {index}] erro: {exc}")
+        results.put(("done", index, msg.offset, ok))
+        if snapshot_path and settings.snapshot_every_sec > 0 and time.monotonic() - saved_at >= settings.snapshot_every_sec:
+            saved_at = time.monotonic()
+            brain.memory.save_snapshot(snapshot_path)
+
+
+@dataclass
+class Supervisor:
+    settings: Settings
+    workers: int
+    _ring: HashRing = field(init=False)
+    _queues: list[mp.Queue] = field(default_factory=list, init=False)
+    _procs: list[mp.Process] = field(default_factory=list, init=False)
+    # Called with (offset, ok) when a worker finishes or loses a turn.
+    on_done: Callable[[int | None, bool], None] | None = None
+    _results: mp.Queue = field(default_factory=mp.Queue, init=False)
+    _running: dict[int, int | None] = field(default_factory=dict, init=False)
+    _running_lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+    _controls: list[mp.Queue] = field(default_factory=list, init=False)
+    # request id -> {worker index: reply}
+    _replies: dict[int, dict[int, Any]] = field(default_factory=dict, init=False)
+    _replies_cond: threading.Condition = field(default_factory=threading.Condition, init=False)
+    _request_ids: Iterator[int] = field(default_factory=itertools.count, init=False)
+    _collector: threading.Thread | None = field(default=None, init=False)
+
+    def __post_init__(self) -> None:
+        self._ring = HashRing(self.workers)
+
+    def start(self) -> None:
+        for index in range(self.workers):
+            self._queues.append(mp.Queue())
+            self._controls.append(mp.Queue())
+            self._procs.append(self._spawn(index))
+        self._collector = threading.Thread(target=self._collect, name="supervisor-results", daemon=True)
+        self._collector.start()
+
+    def _collect(self) -> None:
+        while True:
+            item = self._results.get()
+            if item is None:
+                return
+            if item[0] == "reply":
+                _, index, request, data = item
+                with self._replies_cond:
+                    if request in self._replies:
+                        self._replies[request][index] = data
+                        self._replies_cond.notify_all()
+                continue
+            if item[0] == "start":
+                _, index, offset = item
+                with self._running_lock:
+                    self._running[index] = offset
+                continue
+            _, index, offset, ok = item
+            with self._running_lock:
+                self._running[index] = None
+            if self.on_done is not None:
+                self.on_done(offset, ok)
+
+    def _spawn(self, index: int) -> mp.Process:
+        proc = mp.Process(
+            target=_worker_main,
+            args=(index, self.settings, self._queues[index], self._controls[index], self._results),
+            name=f"turion-worker-{index}",
+            daemon=True,
+        )
+        proc.start()
+        return proc
+
+    def dispatch(self, msg: InboundMessage) -> None:
+        # Same memory user always lands on the same worker, so its caches
+        # live in exactly one process.
+        self._queues[self._ring.node_for(memory_user(self.settings, msg.sender))].put(msg)
+
+    def dispatch_presence(self, event: PresenceEvent) -> None:
+        # Routed like messages, so the worker that will get the turn warms up.
+        self._queues[self._ring.node_for(memory_user(self.settings, event.sender))].put(event)
+
+    def control(self, cmd: str, args: dict | None = None, timeout: float = 5.0) -> list[Any]:
+        # Runs a control command in every worker and returns the replies by
+        # worker index; None for a worker that did not answer in time.
+        request = next(self._request_ids)
+        with self._replies_cond:
+            self._replies[request] = {}
+        for q in self._controls:
+            q.put((request, cmd, args or {}))
+        deadline = time.monotonic() + timeout
+        with self._replies_cond:
+            while len(self._replies[request]) < self.workers:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._replies_cond.wait(left)
+            replies = self._replies.pop(request)
+        return [replies.get(index) for index in range(self.workers)]
+
+    def queue_depths(self) -> list[int]:
+        depths = []
+        for q in self._queues:
+            try:
+                depths.append(q.qsize())
+            except NotImplementedError:  # pragma: no cover - macOS
+                depths.append(-1)
+        return depths
+
+    def check_workers(self) -> None:
+        for index, proc in enumerate(self._procs):
+            if not proc.is_alive():
+                print(f"[supervisor] worker {index} saiu ({proc.exitcode}), reiniciando")
+                with self._running_lock:
+                    offset = self._running.pop(index, None)
+                if offset is not None and self.on_done is not None:
+                    self.on_done(offset, False)
+                self._procs[index] = self._spawn(index)
+
+    def stop(self) -> None:
+        for q in self._queues:
+            q.put(None)
+        for q in self._controls:
+            q.put(None)
+        for proc in self._procs:
+            proc.join(timeout=5)
+        self._results.put(None)
+        if self._collector is not None:
+            # Done before interpreter teardown, which would break its get().
+            self._collector.join(timeout=2)
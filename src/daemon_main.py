@@ -1,44 +1,173 @@
 ﻿from __future__ import annotations
 
+import asyncio
+import grp
+import json
 import os
-import socket
-import threading
-import time
+import signal
+from functools import partial
+from typing import Any, Callable
+
+from config.settings import Settings
+from core.profiler import profiler
+from core.runtime import AgentRuntime
 
 SOCKET_PATH = "/var/run/bot-ai.sock"
 
+# Protocol: one JSON object per line in each direction.
+#   -> {"cmd": "stats"}
+#   <- {"ok": true, "data": {...}}
+# A bare "ping" line is still answered with "pong" for older clients.
+Command = Callable[[AgentRuntime, dict[str, Any]], Any]
+COMMANDS: dict[str, Command] = {}
+
+
+def command(name: str) -> Callable[[Command], Command]:
+    def register(fn: Command) -> Command:
+        COMMANDS[name] = fn
+        return fn
+
+    return register
+
+
+@command("ping")
+def _ping(runtime: AgentRuntime, args: dict[str, Any]) -> str:
+    return "pong"
+
+
+@command("stats")
+def _stats(runtime: AgentRuntime, args: dict[str, Any]) -> dict:
+    return runtime.stats()
+
+
+@command("cache.flush")
+def _cache_flush(runtime: AgentRuntime, args: dict[str, Any]) -> dict:
+    return {"dropped": runtime.flush_cache(args.get("user_id"))}
+
+
+@command("settings.reload")
+def _settings_reload(runtime: AgentRuntime, args: dict[str, Any]) -> dict:
+    return runtime.reload_settings()
+
+
+@command("snapshot.save")
+def _snapshot_save(runtime: AgentRuntime, args: dict[str, Any]) -> dict:
+    return {"users": runtime.save_snapshot(), "path": runtime.settings.snapshot_path}
+
+
+def _profile(runtime: AgentRuntime, cmd: str, args: dict[str, Any]) -> dict:
+    if runtime.supervisor is None:
+        return profiler.command(cmd, args)
+    # Turns run in the workers, so each one samples or traces itself and
+    # writes files tagged -w<N>.
+    return {"workers": runtime.supervisor.control(f"profile.{cmd}", args)}
+
+
+@command("profile.sample")
+def _profile_sample(runtime: AgentRuntime, args: dict[str, Any]) -> dict:
+    return _profile(runtime, "sample", args)
+
+
+@command("profile.trace")
+def _profile_trace(runtime: AgentRuntime, args: dict[str, Any]) -> dict:
+    return _profile(runtime, "trace", args)
+
 
-def _handle_client(conn: socket.socket) -> None:
+@command("profile.stop")
+def _profile_stop(runtime: AgentRuntime, args: dict[str, Any]) -> dict:
+    return _profile(runtime, "stop", args)
+
+
+@command("profile.status")
+def _profile_status(runtime: AgentRuntime, args: dict[str, Any]) -> dict:
+    return _profile(runtime, "status", args)
+
+
+def _on_sigusr1(runtime: AgentRuntime) -> None:
     try:
-        data = conn.recv(4096).decode("utf-8", errors="ignore").strip()
-        if not data:
-            return
-        if data == "ping":
-            conn.sendall(b"pong\n")
-        else:
-            conn.sendall(b"ok\n")
+        data = _profile(runtime, "sample", {})
+        paths = [w.get("path") for w in data.get("workers", []) if w] or [data.get("path")]
+        print(f"[profiler] SIGUSR1: amostrando em {', '.join(str(p) for p in paths)}")
+    except RuntimeError as exc:
+        print(f"[profiler] {exc}")
+
+
+def dispatch(runtime: AgentRuntime, line: str) -> bytes:
+    line = line.strip()
+    if line == "ping":
+        return b"pong\n"
+    try:
+        req = json.loads(line)
+        handler = COMMANDS[req["cmd"]]
+    except (ValueError, KeyError, TypeError):
+        return _reply({"ok": False, "error": "comando inválido", "commands": sorted(COMMANDS)})
+    try:
+        return _reply({"ok": True, "data": handler(runtime, req.get("args") or {})})
+    except Exception as exc:
+        return _reply({"ok": False, "error": str(exc)})
+
+
+def _reply(payload: dict[str, Any]) -> bytes:
+    return (json.dumps(payload, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+
+async def _serve_client(runtime: AgentRuntime, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        while True:
+            try:
+                line = await reader.readline()
+            except (ValueError, ConnectionError):
+                break
+            if not line:
+                break
+            writer.write(dispatch(runtime, line.decode("utf-8", errors="ignore")))
+            await writer.drain()
     finally:
-        conn.close()
+        writer.close()
+
+
+def _restrict_socket(group: str) -> None:
+    try:
+        os.chown(SOCKET_PATH, -1, grp.getgrnam(group).gr_gid)
+    except KeyError:
+        print(f"[daemon] grupo {group} não existe; socket restrito ao dono")
+    os.chmod(SOCKET_PATH, 0o660)
 
 
-def run_server() -> None:
+async def serve(runtime: AgentRuntime) -> None:
     if os.path.exists(SOCKET_PATH):
         os.remove(SOCKET_PATH)
 
-    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    server.bind(SOCKET_PATH)
-    os.chmod(SOCKET_PATH, 0o666)
-    server.listen(5)
+    # The socket accepts mutating commands, so only root and CONTROL_GROUP may
+    # connect. The umask closes the window between bind() and chmod().
+    old_umask = os.umask(0o117)
+    try:
+        server = await asyncio.start_unix_server(partial(_serve_client, runtime), path=SOCKET_PATH, backlog=1024)
+    finally:
+        os.umask(old_umask)
+    _restrict_socket(runtime.settings.control_group)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    loop.add_signal_handler(signal.SIGUSR1, _on_sigusr1, runtime)
 
-    while True:
-        conn, _ = server.accept()
-        t = threading.Thread(target=_handle_client, args=(conn,), daemon=True)
-        t.start()
+    async with server:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=2)
+            except asyncio.TimeoutError:
+                runtime.tick()
 
 
 def main() -> None:
     print("Daemon iniciado")
-    run_server()
+    runtime = AgentRuntime.start(Settings.load())
+    try:
+        asyncio.run(serve(runtime))
+    finally:
+        runtime.stop()
 
 
 if __name__ == "__main__":
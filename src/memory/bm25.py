@@ -0,0 +1,103 @@
+﻿from __future__ import annotations
+
+import math
+from array import array
+from collections import Counter
+from typing import TYPE_CHECKING, Iterable
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+class BM25Index:
+    # Okapi BM25 over a HistoryBuffer that grows at the newest end and is
+    # trimmed at the oldest. Documents are numbered in arrival order (k); the
+    # live ones are [base, count). Postings keep trimmed entries until the dead
+    # prefix outgrows the live set, then the index is compacted.
+    __slots__ = ("stemmed", "k1", "b", "_offset", "_base", "_count", "_doc_len", "_doc_terms", "_postings", "_df", "_total_len")
+
+    def __init__(self, stemmed: bool, k1: float = 1.5, b: float = 0.75) -> None:
+        self.stemmed = stemmed
+        self.k1 = k1
+        self.b = b
+        self._reset()
+
+    def _reset(self) -> None:
+        self._offset = 0
+        self._base = 0
+        self._count = 0
+        self._doc_len = array("I")
+        self._doc_terms: list[tuple[str, ...]] = []
+        self._postings: dict[str, tuple[array, array]] = {}
+        self._df: Counter[str] = Counter()
+        self._total_len = 0
+
+    def __len__(self) -> int:
+        return self._count - self._base
+
+    def add(self, terms: Iterable[str]) -> None:
+        terms = tuple(terms)
+        k = self._count
+        self._count += 1
+        freqs = Counter(terms)
+        for term, tf in freqs.items():
+            post = self._postings.get(term)
+            if post is None:
+                post = self._postings[term] = (array("I"), array("I"))
+            post[0].append(k)
+            post[1].append(tf)
+            self._df[term] += 1
+        self._doc_len.append(len(terms))
+        self._doc_terms.append(tuple(freqs))
+        self._total_len += len(terms)
+
+    def drop_oldest(self, n: int) -> None:
+        for _ in range(min(n, len(self))):
+            j = self._base - self._offset
+            for term in self._doc_terms[j]:
+                self._df[term] -= 1
+            self._total_len -= self._doc_len[j]
+            self._base += 1
+        if self._base - self._offset > len(self):
+            self._compact()
+
+    def _compact(self) -> None:
+        start = self._base - self._offset
+        doc_terms = self._doc_terms[start:]
+        live = {term for terms in doc_terms for term in terms}
+        for term in list(self._postings):
+            if term not in live:
+                del self._postings[term]
+                self._df.pop(term, None)
+                continue
+            ks, tfs = self._postings[term]
+            keep = [(k, tf) for k, tf in zip(ks, tfs) if k >= self._base]
+            self._postings[term] = (array("I", [k for k, _ in keep]), array("I", [tf for _, tf in keep]))
+        self._doc_len = self._doc_len[start:]
+        self._doc_terms = doc_terms
+        self._offset = self._base
+
+    def scores(self, query_terms: Iterable[str]) -> "np.ndarray":
+        # Returned newest first, the HistoryBuffer order.
+        import numpy as np
+
+        n = len(self)
+        out = np.zeros(n, dtype=np.float64)
+        if n == 0 or self._total_len == 0:
+            return out
+        avgdl = self._total_len / n
+        doc_len = np.frombuffer(self._doc_len, dtype=np.uint32)[self._base - self._offset :]
+        for term in set(query_terms):
+            post = self._postings.get(term)
+            df = self._df.get(term, 0)
+            if post is None or df <= 0:
+                continue
+            idf = math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+            ks = np.frombuffer(post[0], dtype=np.uint32)
+            tfs = np.frombuffer(post[1], dtype=np.uint32).astype(np.float64)
+            live = ks >= self._base
+            pos = ks[live].astype(np.int64) - self._base
+            tf = tfs[live]
+            denom = tf + self.k1 * (1.0 - self.b + self.b * doc_len[pos] / avgdl)
+            out[pos] += idf * tf * (self.k1 + 1.0) / denom
+        return out[::-1]
@@ -0,0 +1,186 @@
+﻿from __future__ import annotations
+
+import threading
+import uuid
+from array import array
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, overload
+
+from memory.bm25 import BM25Index
+from memory.text import stems, tokens
+from memory.types import MemoryItem
+
+# Roles are few and repeat on every row, so each one is stored as a one-byte
+# code into this shared table.
+ROLES: list[str] = []
+_ROLE_CODES: dict[str, int] = {}
+
+
+def role_code(role: str) -> int:
+    code = _ROLE_CODES.get(role)
+    if code is None:
+        code = len(ROLES)
+        ROLES.append(role)
+        _ROLE_CODES[role] = code
+    return code
+
+
+def known_role_code(role: str) -> int | None:
+    # Lookup only: config (e.g. role boosts) must not add roles to the table.
+    return _ROLE_CODES.get(role)
+
+
+class HistoryBuffer:
+    # Columnar per-user history, newest first (the order get_recent returns).
+    # Indexing builds a MemoryItem on demand; retrieval and summarisation read
+    # the columns directly. Tokens are computed once, when a row enters.
+    __slots__ = ("user_id", "timestamps", "roles", "texts", "tokens", "_ids", "_tags", "_index", "_lock")
+
+    def __init__(self, user_id: str) -> None:
+        self.user_id = user_id
+        self.timestamps = array("d")
+        self.roles = array("B")
+        self.texts: list[str] = []
+        self.tokens: list[tuple[str, ...]] = []
+        self._ids = bytearray()
+        self._tags: list[list[str] | None] = []
+        self._index: BM25Index | None = None
+        # Held by writers and by columns(), so a snapshot taken while turns
+        # prepend sees every column at the same length and head.
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_rows(cls, user_id: str, rows: Iterable[tuple]) -> "HistoryBuffer":
+        # rows: (id, role, text, tags, created_at), newest first
+        buf = cls(user_id)
+        for row_id, role, text, tags, created_at in rows:
+            buf.timestamps.append(created_at.timestamp())
+            buf.roles.append(role_code(role))
+            buf.texts.append(text)
+            buf.tokens.append(tokens(text))
+            buf._ids += uuid.UUID(str(row_id)).bytes
+            buf._tags.append(list(tags) if tags else None)
+        return buf
+
+    @classmethod
+    def from_items(cls, user_id: str, items: Iterable[MemoryItem]) -> "HistoryBuffer":
+        return cls.from_rows(user_id, ((i.id, i.role, i.text, i.tags, i.created_at) for i in items))
+
+    @classmethod
+    def from_columns(
+        cls,
+        user_id: str,
+        timestamps: array,
+        roles: array,
+        texts: list[str],
+        ids: bytes,
+        tags: list[list[str] | None],
+    ) -> "HistoryBuffer":
+        # Inverse of columns(); roles must already be codes of this process.
+        buf = cls(user_id)
+        buf.timestamps = timestamps
+        buf.roles = roles
+        buf.texts = texts
+        buf.tokens = [tokens(t) for t in texts]
+        buf._ids = bytearray(ids)
+        buf._tags = tags
+        return buf
+
+    def columns(self) -> tuple[array, array, list[str], bytes, list[list[str] | None]]:
+        # Copies, taken together: the buffer keeps changing under the caller.
+        with self._lock:
+            return (
+                array(self.timestamps.typecode, self.timestamps),
+                array(self.roles.typecode, self.roles),
+                list(self.texts),
+                bytes(self._ids),
+                list(self._tags),
+            )
+
+    def prepend(self, item: MemoryItem, limit: int | None = None) -> None:
+        toks = tokens(item.text)
+        with self._lock:
+            self.timestamps.insert(0, item.created_at.timestamp())
+            self.roles.insert(0, role_code(item.role))
+            self.texts.insert(0, item.text)
+            self.tokens.insert(0, toks)
+            self._ids[0:0] = uuid.UUID(item.id).bytes
+            self._tags.insert(0, list(item.tags) if item.tags else None)
+            if self._index is not None:
+                self._index.add(stems(toks) if self._index.stemmed else toks)
+            if limit is not None and len(self.texts) > limit:
+                self.truncate(limit)
+
+    def truncate(self, size: int) -> None:
+        with self._lock:
+            if self._index is not None and len(self.texts) > size:
+                self._index.drop_oldest(len(self.texts) - size)
+            del self.timestamps[size:]
+            del self.roles[size:]
+            del self.texts[size:]
+            del self.tokens[size:]
+            del self._ids[size * 16 :]
+            del self._tags[size:]
+
+    def bm25(self, stemmed: bool) -> BM25Index:
+        # Built on first use, then kept in step with prepend/truncate.
+        if self._index is None or self._index.stemmed != stemmed:
+            index = BM25Index(stemmed)
+            for toks in reversed(self.tokens):
+                index.add(stems(toks) if stemmed else toks)
+            self._index = index
+        return self._index
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def role(self, index: int) -> str:
+        return ROLES[self.roles[index]]
+
+    def item_id(self, index: int) -> str:
+        start = index * 16
+        return str(uuid.UUID(bytes=bytes(self._ids[start : start + 16])))
+
+    def newer_than(self, created_at: datetime, item_id: str | None) -> int:
+        # How many leading (newest) rows sort after (created_at, item_id), the
+        # same keyset order as get_recent and iter_history.
+        mark = (created_at.timestamp(), uuid.UUID(item_id).bytes if item_id else b"")
+        count = 0
+        while count < len(self) and (self.timestamps[count], bytes(self._ids[count * 16 : count * 16 + 16])) > mark:
+            count += 1
+        return count
+
+    def tags(self, index: int) -> list[str]:
+        return self._tags[index] or []
+
+    def created_at(self, index: int) -> datetime:
+        return datetime.fromtimestamp(self.timestamps[index], timezone.utc)
+
+    def _item(self, index: int) -> MemoryItem:
+        return MemoryItem(
+            id=self.item_id(index),
+            user_id=self.user_id,
+            role=self.role(index),
+            text=self.texts[index],
+            created_at=self.created_at(index),
+            tags=list(self._tags[index] or []),
+        )
+
+    @overload
+    def __getitem__(self, index: int) -> MemoryItem: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> list[MemoryItem]: ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._item(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._item(index)
+
+    def __iter__(self) -> Iterator[MemoryItem]:
+        for i in range(len(self)):
+            yield self._item(i)
@@ -0,0 +1,75 @@
+﻿from __future__ import annotations
+
+import json
+import threading
+from collections import Counter
+
+from memory.store import NOTIFY_CHANNEL, MemoryService
+
+
+class CacheListener:
+    # LISTENs on NOTIFY_CHANNEL over its own connection and applies other
+    # processes' writes to this process's caches. Notifications sent while
+    # disconnected are lost, so after a reconnect every cache is dropped.
+    def __init__(self, memory: MemoryService, poll_sec: float = 5.0, retry_sec: float = 5.0) -> None:
+        self.memory = memory
+        self.poll_sec = poll_sec
+        self.retry_sec = retry_sec
+        self.counts: Counter[str] = Counter()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._listened = False
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="memory-listen", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self._listen()
+            except Exception as exc:
+                print(f"[memória] LISTEN caiu: {exc}")
+                self.counts["reconnects"] += 1
+                self._stop.wait(self.retry_sec)
+
+    def _listen(self) -> None:
+        import select
+
+        import psycopg2
+
+        config = self.memory.config
+        conn = psycopg2.connect(
+            host=config.host,
+            port=config.port,
+            dbname=config.dbname,
+            user=config.user,
+            password=config.password,
+        )
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"listen {NOTIFY_CHANNEL}")
+            if self._listened:
+                self.memory.flush_cache()
+            self._listened = True
+            while not self._stop.is_set():
+                if select.select([conn], [], [], self.poll_sec) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    note = conn.notifies.pop(0)
+                    try:
+                        action = self.memory.apply_notification(json.loads(note.payload))
+                    except (ValueError, TypeError) as exc:
+                        print(f"[memória] NOTIFY inválido: {exc}")
+                        action = "invalid"
+                    self.counts[action] += 1
+        finally:
+            conn.close()
+
+    def stats(self) -> dict:
+        return dict(self.counts)
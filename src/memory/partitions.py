@@ -0,0 +1,269 @@
+﻿from __future__ import annotations
+
+import gzip
+import re
+import time
+from dataclasses import dataclass, field
+from datetime import date, datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from memory.transfer import copy_ndjson, write_meta
+
+if TYPE_CHECKING:
+    import psycopg2
+
+PARENT = "memory_items"
+DEFAULT = "memory_items_default"
+LEGACY = "memory_items_legacy"
+
+_NAME = re.compile(r"^memory_items_p(\d{4})_(\d{2})$")
+
+# Kept in step with docs/postgres.sql.
+SCHEMA = f"""
+create table if not exists {PARENT} (
+  id uuid not null,
+  user_id text not null,
+  role text not null,
+  text text not null,
+  tags text[] default '{{}}',
+  created_at timestamptz not null default now(),
+  primary key (id, created_at)
+) partition by range (created_at);
+
+create table if not exists {DEFAULT} partition of {PARENT} default;
+
+create index if not exists memory_items_user_created_id
+  on {PARENT} (user_id, created_at desc, id desc);
+"""
+
+
+@dataclass
+class PartitionReport:
+    created: list[str] = field(default_factory=list)
+    detached: list[str] = field(default_factory=list)
+    archived: list[str] = field(default_factory=list)
+    dropped: list[str] = field(default_factory=list)
+    migrated_rows: int = 0
+
+
+def month_start(value: date | datetime) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, n: int) -> date:
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{PARENT}_p{month.year:04d}_{month.month:02d}"
+
+
+def is_partitioned(cur) -> bool:
+    cur.execute("select relkind from pg_class where oid = to_regclass(%s)", (PARENT,))
+    row = cur.fetchone()
+    return bool(row) and row[0] == "p"
+
+
+def list_partitions(cur) -> dict[date, str]:
+    cur.execute(
+        """
+        select c.relname
+        from pg_inherits i
+        join pg_class c on c.oid = i.inhrelid
+        where i.inhparent = to_regclass(%s)
+        """,
+        (PARENT,),
+    )
+    months = {}
+    for (name,) in cur.fetchall():
+        match = _NAME.match(name)
+        if match:
+            months[date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return months
+
+
+def _create_month(cur, month: date, hash_partitions: int) -> str:
+    # Built detached and attached afterwards: rows that already landed in the
+    # default partition for this month are moved over first, otherwise the
+    # attach would fail its range check.
+    name = partition_name(month)
+    lo, hi = month, add_months(month, 1)
+    suffix = " partition by hash (user_id)" if hash_partitions > 1 else ""
+    cur.execute(f"create table {name} (like {PARENT} including defaults including constraints){suffix}")
+    for remainder in range(hash_partitions if hash_partitions > 1 else 0):
+        cur.execute(
+            f"create table {name}_h{remainder} partition of {name} "
+            f"for values with (modulus {hash_partitions}, remainder {remainder})"
+        )
+    cur.execute(
+        f"""
+        with moved as (
+            delete from {DEFAULT} where created_at >= %s and created_at < %s returning *
+        )
+        insert into {name} select * from moved
+        """,
+        (lo, hi),
+    )
+    cur.execute(f"alter table {PARENT} attach partition {name} for values from (%s) to (%s)", (lo, hi))
+    return name
+
+
+def ensure_partitions(
+    conn: psycopg2.extensions.connection,
+    months_ahead: int = 2,
+    hash_partitions: int = 0,
+    since: date | None = None,
+) -> list[str]:
+    # Creates the monthly partitions from `since` (default: this month) up to
+    # months_ahead in the future. No-op on the old unpartitioned table.
+    created = []
+    with conn.cursor() as cur:
+        if not is_partitioned(cur):
+            return created
+        existing = list_partitions(cur)
+        month = month_start(since or datetime.now(timezone.utc))
+        last = add_months(month_start(datetime.now(timezone.utc)), months_ahead)
+        while month <= last:
+            if month not in existing:
+                with conn:
+                    created.append(_create_month(cur, month, hash_partitions))
+            month = add_months(month, 1)
+    return created
+
+
+def _archive(cur, name: str, archive_dir: Path) -> Path:
+    # Same format as `turion memory export`, so an archive can be brought
+    # back with `turion memory import`.
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    path = archive_dir / f"{name}.ndjson.gz"
+    tmp = path.with_suffix(".tmp")
+    with gzip.open(tmp, "wb", compresslevel=6) as out:
+        write_meta(out)
+        copy_ndjson(
+            cur,
+            f"select row_to_json(t) from (select 'item' as kind, id, user_id, role, text, tags, created_at from {name}) t",
+            out,
+            name,
+        )
+    tmp.replace(path)
+    return path
+
+
+def apply_retention(
+    conn: psycopg2.extensions.connection,
+    keep_months: int,
+    archive_dir: str | None = None,
+    drop: bool = False,
+) -> PartitionReport:
+    # Partitions entirely older than keep_months are detached. With
+    # archive_dir they are written out first, while still attached, so a
+    # failed archive is simply retried next run. With drop the detached table
+    # is removed, otherwise it stays behind as a plain table.
+    report = PartitionReport()
+    if keep_months <= 0:
+        return report
+    cutoff = add_months(month_start(datetime.now(timezone.utc)), -keep_months)
+    with conn.cursor() as cur:
+        if not is_partitioned(cur):
+            return report
+        for month, name in sorted(list_partitions(cur).items()):
+            if add_months(month, 1) > cutoff:
+                continue
+            if archive_dir:
+                _archive(cur, name, Path(archive_dir))
+                report.archived.append(name)
+            with conn:
+                cur.execute(f"alter table {PARENT} detach partition {name}")
+            report.detached.append(name)
+            if drop:
+                with conn:
+                    cur.execute(f"drop table {name}")
+                report.dropped.append(name)
+    return report
+
+
+def migrate(
+    conn: psycopg2.extensions.connection,
+    months_ahead: int = 2,
+    hash_partitions: int = 0,
+    drop_legacy: bool = False,
+) -> PartitionReport:
+    # Renames the unpartitioned table to memory_items_legacy, creates the
+    # partitioned one in its place and copies rows month by month, committing
+    # each. Writes during the copy go straight to the new table. Re-running
+    # resumes an interrupted migration.
+    report = PartitionReport()
+    with conn.cursor() as cur:
+        if not is_partitioned(cur):
+            with conn:
+                cur.execute(f"alter table {PARENT} rename to {LEGACY}")
+                cur.execute(f"alter table {LEGACY} rename constraint {PARENT}_pkey to {LEGACY}_pkey")
+                cur.execute(f"alter index if exists memory_items_user_id_created_at rename to {LEGACY}_user_created")
+                cur.execute(f"alter index if exists memory_items_user_created_id rename to {LEGACY}_user_created_id")
+                cur.execute(SCHEMA)
+        cur.execute("select to_regclass(%s)", (LEGACY,))
+        if cur.fetchone()[0] is None:
+            return report
+
+        cur.execute(f"select min(created_at) from {LEGACY}")
+        oldest = cur.fetchone()[0]
+        since = month_start(oldest) if oldest else None
+        report.created = ensure_partitions(conn, months_ahead, hash_partitions, since=since)
+
+        month = since
+        last = add_months(month_start(datetime.now(timezone.utc)), months_ahead)
+        while month is not None and month <= last:
+            with conn:
+                cur.execute(
+                    f"""
+                    insert into {PARENT} (id, user_id, role, text, tags, created_at)
+                    select id, user_id, role, text, coalesce(tags, '{{}}'), created_at
+                    from {LEGACY}
+                    where created_at >= %s and created_at < %s
+                    on conflict do nothing
+                    """,
+                    (month, add_months(month, 1)),
+                )
+                report.migrated_rows += cur.rowcount
+            month = add_months(month, 1)
+        with conn:
+            # Rows without a timestamp (the old column was nullable) and any
+            # beyond the partitioned horizon land in the default partition.
+            # now() differs per run, so re-runs skip ids already copied.
+            cur.execute(
+                f"""
+                insert into {PARENT} (id, user_id, role, text, tags, created_at)
+                select l.id, l.user_id, l.role, l.text, coalesce(l.tags, '{{}}'), coalesce(l.created_at, now())
+                from {LEGACY} l
+                where (l.created_at is null or l.created_at >= %s)
+                  and not exists (select 1 from {PARENT} p where p.id = l.id)
+                on conflict do nothing
+                """,
+                (add_months(last, 1),),
+            )
+            report.migrated_rows += cur.rowcount
+        if drop_legacy:
+            with conn:
+                cur.execute(f"drop table {LEGACY}")
+            report.dropped.append(LEGACY)
+    return report
+
+
+def maintain(
+    conn: psycopg2.extensions.connection,
+    months_ahead: int,
+    hash_partitions: int,
+    retention_months: int,
+    archive_dir: str | None,
+) -> PartitionReport:
+    started = time.monotonic()
+    report = apply_retention(conn, retention_months, archive_dir, drop=bool(archive_dir))
+    report.created = ensure_partitions(conn, months_ahead, hash_partitions)
+    if report.created or report.detached:
+        print(
+            f"[partições] criadas={report.created} desanexadas={report.detached} "
+            f"arquivadas={report.archived} ({time.monotonic() - started:.1f}s)"
+        )
+    return report
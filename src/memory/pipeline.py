@@ -2,6 +2,7 @@
 
 from dataclasses import dataclass
 
+from memory.history import HistoryBuffer
 from memory.retriever import Retriever
 from memory.store import MemoryService
 from memory.summarizer import LocalSummarizer
@@ -15,8 +16,15 @@ class MemoryPipeline:
     summarizer: LocalSummarizer
     max_context_items: int = 12
 
-    def build_context(self, user_id: str, query: str) -> tuple[list[MemoryItem], list[MemoryItem], str]:
-        recent = self.memory.get_recent(user_id, limit=80)
+    def recent(self, user_id: str, stale_ok: bool = False) -> HistoryBuffer:
+        return self.memory.get_recent(user_id, limit=80, stale_ok=stale_ok)
+
+    def relevant(self, query: str, recent: HistoryBuffer) -> tuple[list[MemoryItem], str]:
         relevant = self.retriever.top(query, recent, limit=self.max_context_items)
         summary = self.summarizer.summarize([item.text for item in relevant]).text
+        return relevant, summary
+
+    def build_context(self, user_id: str, query: str) -> tuple[HistoryBuffer, list[MemoryItem], str]:
+        recent = self.recent(user_id)
+        relevant, summary = self.relevant(query, recent)
         return recent, relevant, summary
@@ -1,45 +1,162 @@
 ﻿from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import Iterable
-
-try:
-    from rank_bm25 import BM25Okapi
-except Exception:  # pragma: no cover - optional
-    BM25Okapi = None
+import math
+import time
+from dataclasses import dataclass, field
+from typing import Iterable, Sequence
 
+from memory import text
+from memory.history import HistoryBuffer, known_role_code
 from memory.types import MemoryItem
 
 
-def _tokenize(text: str) -> list[str]:
-    return [t for t in text.lower().split() if t]
+def _numpy():
+    # NumPy is imported on the first ranking, not at startup.
+    try:
+        import numpy
+    except Exception:  # pragma: no cover - optional
+        return None
+    return numpy
 
 
 @dataclass
 class Retriever:
+    # final = relevance + recency_weight * recency + role/tag boosts, where
+    # relevance blends normalised BM25 and (optional) semantic scores in [0, 1]
+    # and recency halves every recency_half_life_sec. min_score gates on
+    # relevance alone so recent but unrelated items never qualify.
     min_score: float = 0.25
+    stemming: bool = True
+    bm25_weight: float = 1.0
+    semantic_weight: float = 0.0
+    recency_weight: float = 0.0
+    recency_half_life_sec: float = 72 * 3600
+    role_boosts: dict[str, float] = field(default_factory=dict)
+    tag_boosts: dict[str, float] = field(default_factory=dict)
+
+    def _terms(self, toks: tuple[str, ...]) -> tuple[str, ...]:
+        return text.stems(toks) if self.stemming else toks
+
+    def _scores(self, query: str, docs: list[tuple[str, ...]]) -> Sequence[float]:
+        # Normalised so the best match is 1.0. rank_bm25 needs NumPy, so when
+        # it is importable the result is an ndarray.
+        try:
+            from rank_bm25 import BM25Okapi
+        except Exception:  # pragma: no cover - optional
+            return [0.0] * len(docs)
+        if not docs:
+            return []
+        bm25 = BM25Okapi([self._terms(d) for d in docs])
+        scores = bm25.get_scores(self._terms(text.tokens(query)))
+        max_score = float(scores.max())
+        if max_score <= 0:
+            return [0.0] * len(docs)
+        return scores / max_score
 
     def score(self, query: str, items: Iterable[MemoryItem]) -> list[tuple[MemoryItem, float]]:
-        if BM25Okapi is None:
-            return [(item, 0.0) for item in items]
-
-        docs = [item.text for item in items]
-        tokenized = [_tokenize(d) for d in docs]
-        bm25 = BM25Okapi(tokenized)
-        scores = bm25.get_scores(_tokenize(query))
-        results: list[tuple[MemoryItem, float]] = []
-        for item, score in zip(items, scores, strict=False):
-            results.append((item, float(score)))
-
-        max_score = max(scores) if len(scores) > 0 else 0.0
-        normalized: list[tuple[MemoryItem, float]] = []
-        for item, score in results:
-            norm = score / max_score if max_score > 0 else 0.0
-            normalized.append((item, norm))
-
-        return normalized
-
-    def top(self, query: str, items: list[MemoryItem], limit: int) -> list[MemoryItem]:
-        scored = self.score(query, items)
-        scored.sort(key=lambda x: x[1], reverse=True)
-        return [item for item, score in scored if score >= self.min_score][:limit]
+        items = list(items)
+        scores = self._scores(query, [text.tokens(item.text) for item in items])
+        return [(item, float(s)) for item, s in zip(items, scores)]
+
+    def top(
+        self,
+        query: str,
+        items: HistoryBuffer | list[MemoryItem],
+        limit: int,
+        semantic: Sequence[float] | None = None,
+        now: float | None = None,
+    ) -> list[MemoryItem]:
+        if not isinstance(items, HistoryBuffer):
+            items = HistoryBuffer.from_items(items[0].user_id if items else "", items)
+        if len(items) == 0 or limit <= 0:
+            return []
+        np = _numpy()
+        if np is not None:
+            lexical = items.bm25(self.stemming).scores(self._terms(text.tokens(query)))
+            best = float(lexical.max())
+            lexical = lexical / best if best > 0 else np.zeros_like(lexical)
+        else:
+            lexical = self._scores(query, items.tokens)
+        now = time.time() if now is None else now
+        if np is None:
+            ranked = self._rank_python(items, lexical, semantic, now)
+        else:
+            ranked = self._rank_numpy(items, lexical, semantic, now, limit)
+        # MemoryItems are only built for the winners.
+        return [items[i] for i in ranked[:limit]]
+
+    def _rank_numpy(
+        self,
+        items: HistoryBuffer,
+        lexical: Sequence[float],
+        semantic: Sequence[float] | None,
+        now: float,
+        limit: int,
+    ) -> list[int]:
+        import numpy as np
+
+        relevance = np.asarray(lexical, dtype=np.float64)
+        if semantic is not None and self.semantic_weight > 0:
+            sem = np.asarray(semantic, dtype=np.float64)
+            top_sem = sem.max()
+            sem = sem / top_sem if top_sem > 0 else np.zeros_like(sem)
+            relevance = (self.bm25_weight * relevance + self.semantic_weight * sem) / (
+                self.bm25_weight + self.semantic_weight
+            )
+
+        final = relevance.copy()
+        if self.recency_weight:
+            ages = now - np.frombuffer(items.timestamps, dtype=np.float64)
+            final += self.recency_weight * np.exp2(-np.maximum(ages, 0.0) / self.recency_half_life_sec)
+        if self.role_boosts:
+            # Codes are one byte; roles no row has used yet cannot match.
+            table = np.zeros(256, dtype=np.float64)
+            for role, boost in self.role_boosts.items():
+                code = known_role_code(role)
+                if code is not None:
+                    table[code] = boost
+            final += table[np.frombuffer(items.roles, dtype=np.uint8)]
+        if self.tag_boosts:
+            for i in range(len(items)):
+                tags = items.tags(i)
+                if tags:
+                    final[i] += max((self.tag_boosts.get(t, 0.0) for t in tags), default=0.0)
+
+        candidates = np.flatnonzero(relevance >= self.min_score)
+        if candidates.size == 0:
+            return []
+        if candidates.size > limit:
+            keep = np.argpartition(-final[candidates], limit - 1)[:limit]
+            candidates = candidates[keep]
+        order = candidates[np.argsort(-final[candidates], kind="stable")]
+        return order.tolist()
+
+    def _rank_python(
+        self,
+        items: HistoryBuffer,
+        lexical: Sequence[float],
+        semantic: Sequence[float] | None,
+        now: float,
+    ) -> list[int]:
+        relevance = list(lexical)
+        if semantic is not None and self.semantic_weight > 0:
+            top_sem = max(semantic, default=0.0)
+            total = self.bm25_weight + self.semantic_weight
+            relevance = [
+                (self.bm25_weight * lex + self.semantic_weight * (sem / top_sem if top_sem > 0 else 0.0)) / total
+                for lex, sem in zip(lexical, semantic)
+            ]
+        final: dict[int, float] = {}
+        for i, rel in enumerate(relevance):
+            if rel < self.min_score:
+                continue
+            value = rel
+            if self.recency_weight:
+                age = max(now - items.timestamps[i], 0.0)
+                value += self.recency_weight * math.pow(2.0, -age / self.recency_half_life_sec)
+            value += self.role_boosts.get(items.role(i), 0.0)
+            tags = items.tags(i)
+            if tags and self.tag_boosts:
+                value += max((self.tag_boosts.get(t, 0.0) for t in tags), default=0.0)
+            final[i] = value
+        return sorted(final, key=final.__getitem__, reverse=True)
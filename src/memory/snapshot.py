@@ -0,0 +1,159 @@
+﻿from __future__ import annotations
+
+import json
+import mmap
+import os
+import struct
+import time
+import uuid
+from array import array
+from pathlib import Path
+
+from memory.history import ROLES, HistoryBuffer, role_code
+
+MAGIC = b"TURNSNAP"
+VERSION = 1
+
+# magic, version, written_at, directory offset, directory length
+_HEADER = struct.Struct("<8sIdQQ")
+# rows, limit, fetched_at, text blob length, tags blob length
+_BLOCK = struct.Struct("<IIdII")
+
+
+def _block(buf: HistoryBuffer, limit: int, fetched_at: float) -> tuple[bytes, str] | None:
+    # One consistent copy of the columns; the head id comes from the same copy.
+    timestamps, roles, texts, ids, tags = buf.columns()
+    n = len(texts)
+    if n == 0 or len(timestamps) != n or len(roles) != n or len(ids) != n * 16 or len(tags) != n:
+        return None
+    encoded = [t.encode("utf-8") for t in texts]
+    offsets = array("I", [0])
+    for raw in encoded:
+        offsets.append(offsets[-1] + len(raw))
+    text_blob = b"".join(encoded)
+    tags_blob = json.dumps(tags, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    block = b"".join(
+        (
+            _BLOCK.pack(n, limit, fetched_at, len(text_blob), len(tags_blob)),
+            timestamps.tobytes(),
+            ids,
+            roles.tobytes(),
+            offsets.tobytes(),
+            text_blob,
+            tags_blob,
+        )
+    )
+    return block, str(uuid.UUID(bytes=ids[:16]))
+
+
+def write_snapshot(path: str | Path, entries: dict[str, tuple[float, HistoryBuffer, int]]) -> int:
+    # Layout: header | per-user blocks (fixed-width columns first, 8-byte
+    # aligned, so they can be read straight out of the mapping) | JSON
+    # directory {users: {user_id: [offset, head_id]}, roles: [...]}.
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    directory: dict[str, list] = {}
+    with open(tmp, "wb") as f:
+        f.write(b"\0" * _HEADER.size)
+        for user_id, (fetched_at, buf, limit) in list(entries.items()):
+            taken = _block(buf, limit, fetched_at)
+            if taken is None:
+                continue
+            block, head_id = taken
+            offset = f.tell()
+            f.write(block)
+            f.write(b"\0" * (-f.tell() % 8))
+            directory[user_id] = [offset, head_id]
+        dir_offset = f.tell()
+        raw = json.dumps({"users": directory, "roles": ROLES}, ensure_ascii=False).encode("utf-8")
+        f.write(raw)
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, VERSION, time.time(), dir_offset, len(raw)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(directory)
+
+
+class Snapshot:
+    # Read side. The file is mapped, only the directory is parsed up front;
+    # a user's columns are copied out of the mapping the first time that user
+    # is asked for, and each entry is handed out once.
+    def __init__(self, path: Path, fd, mm: mmap.mmap, written_at: float, users: dict, roles: list[str]) -> None:
+        self.path = path
+        self.written_at = written_at
+        self._file = fd
+        self._mm = mm
+        self._users = users
+        # Role codes are per process; map the snapshot's codes onto ours.
+        self._roles = bytes(role_code(r) for r in roles).ljust(256, b"\0")
+
+    @classmethod
+    def open(cls, path: str | Path) -> "Snapshot | None":
+        path = Path(path)
+        try:
+            fd = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        try:
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            fd.close()
+            return None
+        magic, version, written_at, dir_offset, dir_len = _HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION or dir_offset + dir_len > len(mm):
+            mm.close()
+            fd.close()
+            return None
+        directory = json.loads(mm[dir_offset : dir_offset + dir_len].decode("utf-8"))
+        return cls(path, fd, mm, written_at, directory["users"], directory["roles"])
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def head_id(self, user_id: str) -> str | None:
+        entry = self._users.get(user_id)
+        return entry[1] if entry else None
+
+    def take(self, user_id: str) -> tuple[HistoryBuffer, int, float] | None:
+        entry = self._users.pop(user_id, None)
+        if entry is None or self._mm is None:
+            return None
+        offset = entry[0]
+        n, limit, fetched_at, text_len, tags_len = _BLOCK.unpack_from(self._mm, offset)
+        view = memoryview(self._mm)
+        try:
+            pos = offset + _BLOCK.size
+            timestamps = array("d")
+            timestamps.frombytes(view[pos : pos + n * 8])
+            pos += n * 8
+            ids = bytes(view[pos : pos + n * 16])
+            pos += n * 16
+            roles = array("B", bytes(view[pos : pos + n]).translate(self._roles))
+            pos += n
+            offsets = array("I")
+            offsets.frombytes(view[pos : pos + (n + 1) * 4])
+            pos += (n + 1) * 4
+            blob = bytes(view[pos : pos + text_len])
+            pos += text_len
+            tags = json.loads(bytes(view[pos : pos + tags_len]).decode("utf-8"))
+        finally:
+            view.release()
+        texts = [blob[offsets[i] : offsets[i + 1]].decode("utf-8") for i in range(n)]
+        buf = HistoryBuffer.from_columns(user_id, timestamps, roles, texts, ids, tags)
+        if not self._users:
+            self.close()
+        return buf, limit, fetched_at
+
+    def discard(self, user_id: str) -> None:
+        self._users.pop(user_id, None)
+        if not self._users:
+            self.close()
+
+    def close(self) -> None:
+        self._users = {}
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+            self._file.close()
@@ -1,15 +1,85 @@
 ﻿from __future__ import annotations
 
+import json
+import threading
 import time
 import uuid
-from dataclasses import dataclass, field
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
 from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Iterator
 
-import psycopg2
-from psycopg2.extras import RealDictCursor
-
+from memory.history import HistoryBuffer
+from memory.snapshot import Snapshot, write_snapshot
 from memory.types import MemoryItem, UserProfile
 
+if TYPE_CHECKING:
+    import psycopg2
+
+
+# Writes are announced here when MemoryConfig.notify is on (see memory.notify).
+NOTIFY_CHANNEL = "turion_memory"
+# Postgres caps a NOTIFY payload at 8000 bytes; a patch that does not fit is
+# sent as a plain invalidation.
+NOTIFY_MAX_BYTES = 7900
+
+# Hot queries, prepared once on the service's single connection (there is no
+# pool) and run with EXECUTE so the server skips parsing and planning on every
+# call.
+STATEMENTS = {
+    "memory_insert": """
+        insert into memory_items (id, user_id, role, text, tags, created_at)
+        values ($1, $2, $3, $4, $5, $6)
+    """,
+    "memory_recent": """
+        select id, role, text, tags, created_at
+        from memory_items
+        where user_id = $1
+        order by created_at desc, id desc
+        limit $2
+    """,
+    "memory_head": """
+        select id
+        from memory_items
+        where user_id = $1
+        order by created_at desc, id desc
+        limit 1
+    """,
+    "memory_count": """
+        select count(*) from memory_items where user_id = $1
+    """,
+    "profile_get": """
+        select user_id, persona, preferences, style, language, updated_at, watermark_at, watermark_id
+        from user_profiles
+        where user_id = $1
+        limit 1
+    """,
+    "profile_upsert": """
+        insert into user_profiles (user_id, persona, preferences, style, language, updated_at, watermark_at, watermark_id)
+        values ($1, $2, $3, $4, $5, $6, $7, $8)
+        on conflict (user_id)
+        do update set
+            persona = excluded.persona,
+            preferences = excluded.preferences,
+            style = excluded.style,
+            language = excluded.language,
+            updated_at = excluded.updated_at,
+            -- Only maintenance moves the watermark; other writers pass null.
+            watermark_at = coalesce(excluded.watermark_at, user_profiles.watermark_at),
+            watermark_id = coalesce(excluded.watermark_id, user_profiles.watermark_id)
+    """,
+    "profile_watermark": """
+        insert into user_profiles (user_id, watermark_at, watermark_id)
+        values ($1, $2, $3)
+        on conflict (user_id)
+        do update set watermark_at = excluded.watermark_at, watermark_id = excluded.watermark_id
+    """,
+}
+
+# Columns added to user_profiles after the first release. Installs that
+# predate them get them on first connect instead of failing every read.
+PROFILE_COLUMNS = {"watermark_at": "timestamptz", "watermark_id": "uuid"}
+
 
 @dataclass
 class MemoryConfig:
@@ -19,28 +89,138 @@ class MemoryConfig:
     user: str
     password: str | None
     cache_ttl_sec: int = 3600
+    notify: bool = False
 
 
 @dataclass
 class MemoryService:
     config: MemoryConfig
+    # Tags this instance's NOTIFYs so its own listener can skip them.
+    origin: str = field(default_factory=lambda: uuid.uuid4().hex[:12], init=False)
     _conn: psycopg2.extensions.connection | None = field(default=None, init=False)
-    _cache: dict[str, tuple[float, list[MemoryItem]]] = field(default_factory=dict, init=False)
+    # user_id -> (fetched_at, history, limit it was fetched with)
+    _cache: dict[str, tuple[float, HistoryBuffer, int]] = field(default_factory=dict, init=False)
+    # user_id -> (fetched_at, profile, None when the user has none yet)
+    _profiles: dict[str, tuple[float, UserProfile | None]] = field(default_factory=dict, init=False)
+    _prepared: set[str] = field(default_factory=set, init=False)
+    _snapshot: Snapshot | None = field(default=None, init=False)
+    # Turns, scheduler jobs and prefetches share the one connection. Holding
+    # this around each use keeps _prepared in step with the session and stops
+    # close() from pulling the connection out from under a statement.
+    _lock: threading.RLock = field(default_factory=threading.RLock, init=False, repr=False)
 
     def _conn_or_none(self) -> psycopg2.extensions.connection | None:
-        if self._conn:
+        with self._lock:
+            if self._conn:
+                return self._conn
+            if not self.config.password:
+                return None
+            # Deferred: nothing touches psycopg2 until the first query.
+            import psycopg2
+
+            self._conn = psycopg2.connect(
+                host=self.config.host,
+                port=self.config.port,
+                dbname=self.config.dbname,
+                user=self.config.user,
+                password=self.config.password,
+            )
+            self._conn.autocommit = True
+            self._prepared = set()
+            self._ensure_columns(self._conn)
             return self._conn
-        if not self.config.password:
-            return None
-        self._conn = psycopg2.connect(
-            host=self.config.host,
-            port=self.config.port,
-            dbname=self.config.dbname,
-            user=self.config.user,
-            password=self.config.password,
-        )
-        self._conn.autocommit = True
-        return self._conn
+
+    def _ensure_columns(self, conn) -> None:
+        import psycopg2
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "select column_name from information_schema.columns "
+                    "where table_schema = current_schema() and table_name = 'user_profiles'"
+                )
+                have = {row[0] for row in cur.fetchall()}
+                # No table yet: docs/postgres.sql (setup) creates it whole.
+                for name, kind in PROFILE_COLUMNS.items():
+                    if have and name not in have:
+                        cur.execute(f"alter table user_profiles add column if not exists {name} {kind}")
+                        print(f"[memória] coluna user_profiles.{name} criada")
+        except psycopg2.Error as exc:
+            print(f"[memória] não foi possível atualizar user_profiles: {exc}")
+
+    @contextmanager
+    def _cursor(self, **kwargs) -> Iterator:
+        # None when there is no database configured.
+        with self._lock:
+            conn = self._conn_or_none()
+            if conn is None:
+                yield None
+                return
+            with conn.cursor(**kwargs) as cur:
+                yield cur
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self._prepared = set()
+
+    def _execute(self, cur, name: str, params: tuple) -> None:
+        # Called with _lock held (through _cursor).
+        from psycopg2.errors import InvalidSqlStatementName
+
+        if name not in self._prepared:
+            cur.execute(f"prepare {name} as {STATEMENTS[name]}")
+            self._prepared.add(name)
+        call = f"execute {name} ({', '.join(['%s'] * len(params))})"
+        try:
+            cur.execute(call, params)
+        except InvalidSqlStatementName:
+            # The session lost it (e.g. server-side reset); prepare again.
+            cur.execute(f"prepare {name} as {STATEMENTS[name]}")
+            cur.execute(call, params)
+
+    def _notify(self, cur, kind: str, user_id: str, patch: dict | None = None) -> None:
+        if not self.config.notify:
+            return
+        payload = {"origin": self.origin, "kind": kind, "user": user_id}
+        raw = json.dumps({**payload, "patch": patch} if patch else payload, ensure_ascii=False, default=str)
+        if len(raw.encode("utf-8")) > NOTIFY_MAX_BYTES:
+            raw = json.dumps(payload, ensure_ascii=False)
+        cur.execute("select pg_notify(%s, %s)", (NOTIFY_CHANNEL, raw))
+
+    def apply_notification(self, payload: dict) -> str:
+        # Another process wrote for this user. Profiles carry the new row and
+        # are patched in place; history is dropped and refetched on next use.
+        if payload.get("origin") == self.origin:
+            return "ignored"
+        user_id = payload.get("user")
+        if not user_id:
+            return "ignored"
+        if payload.get("kind") == "profile":
+            patch = payload.get("patch")
+            if patch is None:
+                self._profiles.pop(user_id, None)
+                return "invalidated"
+            updated_at = patch.get("updated_at")
+            watermark_at = patch.get("watermark_at")
+            profile = UserProfile(
+                user_id=user_id,
+                persona=patch.get("persona"),
+                preferences=patch.get("preferences"),
+                style=patch.get("style"),
+                language=patch.get("language"),
+                updated_at=datetime.fromisoformat(updated_at) if updated_at else None,
+                watermark_at=datetime.fromisoformat(watermark_at) if watermark_at else None,
+                watermark_id=patch.get("watermark_id"),
+            )
+            self._profiles[user_id] = (time.time(), self._keep_watermark(profile))
+            return "patched"
+        if self._snapshot is not None:
+            self._snapshot.discard(user_id)
+        self._cache.pop(user_id, None)
+        return "invalidated"
 
     def add_message(self, user_id: str, role: str, text: str, tags: list[str] | None = None) -> MemoryItem:
         item = MemoryItem(
@@ -51,85 +231,165 @@ class MemoryService:
             created_at=datetime.now(timezone.utc),
             tags=tags or [],
         )
-        conn = self._conn_or_none()
-        if conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    insert into memory_items (id, user_id, role, text, tags, created_at)
-                    values (%s, %s, %s, %s, %s, %s)
-                    """,
+        with self._cursor() as cur:
+            if cur is not None:
+                if user_id not in self._cache and self._snapshot is not None:
+                    # A turn writes before it reads: check the snapshot against
+                    # the head before this insert moves it.
+                    self._from_snapshot(cur, user_id, None, time.time())
+                self._execute(
+                    cur,
+                    "memory_insert",
                     (item.id, item.user_id, item.role, item.text, item.tags, item.created_at),
                 )
-        self._cache.pop(user_id, None)
+                self._notify(cur, "item", user_id)
+        cached = self._cache.get(user_id)
+        if cached is not None:
+            # Write-through: the stored row is known, no need to refetch.
+            cached[1].prepend(item, limit=cached[2])
         return item
 
-    def get_recent(self, user_id: str, limit: int = 50) -> list[MemoryItem]:
+    def get_recent(self, user_id: str, limit: int = 50, stale_ok: bool = False) -> HistoryBuffer:
+        # stale_ok: serve whatever is cached, expired or not, and never wait
+        # on the database (an empty history when nothing is cached).
         now = time.time()
         cached = self._cache.get(user_id)
-        if cached and now - cached[0] <= self.config.cache_ttl_sec:
+        if cached and (stale_ok or now - cached[0] <= self.config.cache_ttl_sec):
             return cached[1]
+        if stale_ok:
+            return HistoryBuffer(user_id)
+
+        with self._cursor() as cur:
+            if cur is None:
+                return HistoryBuffer(user_id)
+            if cached is None and self._snapshot is not None:
+                warm = self._from_snapshot(cur, user_id, limit, now)
+                if warm is not None:
+                    return warm
+            self._execute(cur, "memory_recent", (user_id, limit))
+            buf = HistoryBuffer.from_rows(user_id, cur.fetchall())
+        self._cache[user_id] = (now, buf, limit)
+        return buf
 
+    def _from_snapshot(self, cur, user_id: str, limit: int | None, now: float) -> HistoryBuffer | None:
+        # A snapshot entry is only trusted if its newest row is still the
+        # newest row in the DB: one index probe instead of a full fetch.
+        # limit=None accepts the entry whatever limit it was saved with.
+        snapshot = self._snapshot
+        head = snapshot.head_id(user_id)
+        if head is None:
+            return None
+        self._execute(cur, "memory_head", (user_id,))
+        row = cur.fetchone()
+        if row is None or str(row[0]) != head:
+            snapshot.discard(user_id)
+            return None
+        taken = snapshot.take(user_id)
+        if taken is None or (limit is not None and taken[1] != limit):
+            return None
+        self._cache[user_id] = (now, taken[0], taken[1])
+        return taken[0]
+
+    def load_snapshot(self, path: str) -> int:
+        # Entries are validated lazily, on each user's first get_recent.
+        if self._snapshot is not None:
+            self._snapshot.close()
+        self._snapshot = Snapshot.open(path)
+        return len(self._snapshot) if self._snapshot else 0
+
+    def save_snapshot(self, path: str) -> int:
+        return write_snapshot(path, dict(self._cache))
+
+    def iter_history(
+        self,
+        user_id: str,
+        before: tuple[datetime, str] | None = None,
+        page_size: int = 1000,
+    ) -> Iterator[MemoryItem]:
+        # Newest first, resuming strictly after the (created_at, id) keyset of
+        # the last row seen. Each page streams through a named server-side
+        # cursor so memory stays flat however long the history is. Not held
+        # under _lock: a generator would keep it between pages.
         conn = self._conn_or_none()
         if not conn:
-            return []
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                """
-                select id, user_id, role, text, tags, created_at
-                from memory_items
-                where user_id = %s
-                order by created_at desc
-                limit %s
-                """,
-                (user_id, limit),
-            )
-            rows = cur.fetchall()
-        items = []
-        for row in rows:
-            items.append(
-                MemoryItem(
-                    id=row["id"],
-                    user_id=row["user_id"],
-                    role=row["role"],
-                    text=row["text"],
-                    created_at=row["created_at"],
-                    tags=row.get("tags") or [],
+            return
+        while True:
+            where = "user_id = %s"
+            params: tuple = (user_id,)
+            if before is not None:
+                where += " and (created_at, id) < (%s, %s)"
+                params += before
+            with conn.cursor(name=f"history_{uuid.uuid4().hex}", withhold=True) as cur:
+                cur.itersize = min(page_size, 2000)
+                cur.execute(
+                    f"""
+                    select id, role, text, tags, created_at
+                    from memory_items
+                    where {where}
+                    order by created_at desc, id desc
+                    limit %s
+                    """,
+                    params + (page_size,),
                 )
-            )
-        self._cache[user_id] = (now, items)
-        return items
+                count = 0
+                for row_id, role, text, tags, created_at in cur:
+                    count += 1
+                    before = (created_at, str(row_id))
+                    yield MemoryItem(
+                        id=str(row_id),
+                        user_id=user_id,
+                        role=role,
+                        text=text,
+                        created_at=created_at,
+                        tags=tags or [],
+                    )
+            if count < page_size:
+                return
+
+    def cache_size(self) -> int:
+        return len(self._cache)
+
+    def flush_cache(self, user_id: str | None = None) -> int:
+        if self._snapshot is not None:
+            if user_id is None:
+                self._snapshot.close()
+            else:
+                self._snapshot.discard(user_id)
+        if user_id is None:
+            dropped = len(self._cache)
+            self._cache.clear()
+            self._profiles.clear()
+            return dropped
+        self._profiles.pop(user_id, None)
+        return 1 if self._cache.pop(user_id, None) is not None else 0
 
     def count_messages(self, user_id: str) -> int:
-        conn = self._conn_or_none()
-        if not conn:
-            return 0
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                select count(*) from memory_items where user_id = %s
-                """,
-                (user_id,),
-            )
+        with self._cursor() as cur:
+            if cur is None:
+                return 0
+            self._execute(cur, "memory_count", (user_id,))
             return int(cur.fetchone()[0])
 
     def get_profile(self, user_id: str) -> UserProfile | None:
-        conn = self._conn_or_none()
-        if not conn:
+        # Cached like the history (same TTL); upsert_profile writes through.
+        now = time.time()
+        cached = self._profiles.get(user_id)
+        if cached and now - cached[0] <= self.config.cache_ttl_sec:
+            return cached[1]
+        if not self.config.password:
             return None
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                """
-                select user_id, persona, preferences, style, language, updated_at
-                from user_profiles
-                where user_id = %s
-                limit 1
-                """,
-                (user_id,),
-            )
+        from psycopg2.extras import RealDictCursor
+
+        with self._cursor(cursor_factory=RealDictCursor) as cur:
+            if cur is None:
+                return None
+            self._execute(cur, "profile_get", (user_id,))
             row = cur.fetchone()
-        if not row:
-            return None
+        profile = self._profile_from_row(row) if row else None
+        self._profiles[user_id] = (now, profile)
+        return profile
+
+    def _profile_from_row(self, row: dict) -> UserProfile:
         return UserProfile(
             user_id=row["user_id"],
             persona=row.get("persona"),
@@ -137,38 +397,72 @@ class MemoryService:
             style=row.get("style"),
             language=row.get("language"),
             updated_at=row.get("updated_at"),
+            watermark_at=row.get("watermark_at"),
+            watermark_id=str(row["watermark_id"]) if row.get("watermark_id") else None,
         )
 
+    def _keep_watermark(self, profile: UserProfile) -> UserProfile:
+        # Mirrors the coalesce in profile_upsert for the cached copy.
+        if profile.watermark_at is not None:
+            return profile
+        cached = self._profiles.get(profile.user_id)
+        if cached is None or cached[1] is None:
+            return profile
+        return replace(profile, watermark_at=cached[1].watermark_at, watermark_id=cached[1].watermark_id)
+
+    def advance_watermark(self, user_id: str, watermark_at: datetime, watermark_id: str) -> None:
+        # Maintenance found nothing to change: move the mark only, with no
+        # profile write and no NOTIFY.
+        with self._cursor() as cur:
+            if cur is None:
+                return
+            self._execute(cur, "profile_watermark", (user_id, watermark_at, watermark_id))
+        cached = self._profiles.get(user_id)
+        if cached is not None and cached[1] is not None:
+            profile = replace(cached[1], watermark_at=watermark_at, watermark_id=watermark_id)
+            self._profiles[user_id] = (cached[0], profile)
+        else:
+            self._profiles.pop(user_id, None)
+
     def upsert_profile(self, profile: UserProfile) -> None:
-        conn = self._conn_or_none()
-        if not conn:
-            return
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                insert into user_profiles (user_id, persona, preferences, style, language, updated_at)
-                values (%s, %s, %s, %s, %s, %s)
-                on conflict (user_id)
-                do update set
-                    persona = excluded.persona,
-                    preferences = excluded.preferences,
-                    style = excluded.style,
-                    language = excluded.language,
-                    updated_at = excluded.updated_at
-                """,
+        updated_at = datetime.now(timezone.utc)
+        with self._cursor() as cur:
+            if cur is None:
+                return
+            self._execute(
+                cur,
+                "profile_upsert",
                 (
                     profile.user_id,
                     profile.persona,
                     profile.preferences,
                     profile.style,
                     profile.language,
-                    datetime.now(timezone.utc),
+                    updated_at,
+                    profile.watermark_at,
+                    profile.watermark_id,
                 ),
             )
+            self._notify(
+                cur,
+                "profile",
+                profile.user_id,
+                {
+                    "persona": profile.persona,
+                    "preferences": profile.preferences,
+                    "style": profile.style,
+                    "language": profile.language,
+                    "updated_at": updated_at.isoformat(),
+                    "watermark_at": profile.watermark_at.isoformat() if profile.watermark_at else None,
+                    "watermark_id": profile.watermark_id,
+                },
+            )
+        # The upsert replaces every other column, so the stored row is this profile.
+        self._profiles[profile.user_id] = (time.time(), self._keep_watermark(replace(profile, updated_at=updated_at)))
 
 
 @dataclass
 class MemorySnapshot:
     user_id: str
-    recent: list[MemoryItem]
+    recent: HistoryBuffer
     profile: UserProfile | None
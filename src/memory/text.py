@@ -0,0 +1,48 @@
+﻿from __future__ import annotations
+
+import re
+import unicodedata
+from functools import lru_cache
+
+# One normalisation stage shared by retrieval, shortcut matching and language
+# detection: accents folded, case folded, punctuation dropped.
+
+_WORD = re.compile(r"[^\W_]+")
+
+# Light suffix stripping for Portuguese and English, longest suffix first.
+# Aggressive stemmers hurt more than they help on short chat messages.
+_SUFFIXES = (
+    "amentos", "imentos", "amento", "imento", "mente", "acoes", "icoes", "adora", "adores",
+    "acao", "icao", "ando", "endo", "indo", "aram", "eram", "iram", "ados", "idos", "adas", "idas",
+    "ness", "ment", "ings", "ing", "ies", "ado", "ido", "ada", "ida", "ais", "eis", "oes", "aes",
+    "ed", "es", "ly", "ar", "er", "ir", "os", "as", "s",
+)
+_MIN_STEM = 3
+
+
+def fold(text: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+@lru_cache(maxsize=16384)
+def tokens(text: str) -> tuple[str, ...]:
+    return tuple(_WORD.findall(fold(text)))
+
+
+@lru_cache(maxsize=16384)
+def normalize(text: str) -> str:
+    return " ".join(tokens(text))
+
+
+@lru_cache(maxsize=65536)
+def stem(token: str) -> str:
+    for suffix in _SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= _MIN_STEM:
+            return token[: -len(suffix)]
+    return token
+
+
+@lru_cache(maxsize=16384)
+def stems(toks: tuple[str, ...]) -> tuple[str, ...]:
+    return tuple(stem(t) for t in toks)
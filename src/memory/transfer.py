@@ -0,0 +1,213 @@
+﻿from __future__ import annotations
+
+import gzip
+import io
+import json
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Callable, Iterable
+
+if TYPE_CHECKING:
+    import psycopg2
+
+FORMAT_VERSION = 1
+
+Progress = Callable[[str, int], None]
+
+
+@dataclass
+class TransferStats:
+    profiles: int = 0
+    items: int = 0
+    skipped: int = 0
+    elapsed_sec: float = 0.0
+
+
+def _user_filter(cur, users: Iterable[str] | None) -> str:
+    users = list(users or [])
+    if not users:
+        return ""
+    return cur.mogrify(" where user_id = any(%s)", (users,)).decode("utf-8")
+
+
+class _NDJSONSink:
+    # File-like target for copy_expert. COPY's text format doubles every
+    # backslash; row_to_json never emits raw control characters, so undoing
+    # that is the only unescaping needed. Chunks are cut at line boundaries
+    # first so an escape pair is never split.
+    def __init__(self, out, kind: str, progress: Progress | None, every: int) -> None:
+        self.out = out
+        self.kind = kind
+        self.progress = progress
+        self.every = every
+        self.count = 0
+        self._partial = ""
+
+    def write(self, data: str | bytes) -> None:
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        data = self._partial + data
+        cut = data.rfind("\n") + 1
+        self._partial = data[cut:]
+        if not cut:
+            return
+        lines = data[:cut].replace("\\\\", "\\")
+        self.out.write(lines.encode("utf-8"))
+        before = self.count
+        self.count += lines.count("\n")
+        if self.progress and self.count // self.every != before // self.every:
+            self.progress(self.kind, self.count)
+
+
+def write_meta(out) -> None:
+    meta = {"kind": "meta", "version": FORMAT_VERSION, "exported_at": datetime.now(timezone.utc).isoformat()}
+    out.write((json.dumps(meta) + "\n").encode("utf-8"))
+
+
+def copy_ndjson(cur, select_sql: str, out, kind: str, progress: Progress | None = None, every: int = 100_000) -> int:
+    # select_sql must yield one json value per row.
+    sink = _NDJSONSink(out, kind, progress, every)
+    cur.copy_expert(f"copy ({select_sql}) to stdout", sink)
+    return sink.count
+
+
+def export_memory(
+    conn: psycopg2.extensions.connection,
+    path: str,
+    users: Iterable[str] | None = None,
+    progress: Progress | None = None,
+    progress_every: int = 100_000,
+) -> TransferStats:
+    # gzip NDJSON: a meta line, then one {"kind": "profile"} line per profile
+    # and one {"kind": "item"} line per message, each table streamed by COPY.
+    started = time.monotonic()
+    stats = TransferStats()
+    with conn.cursor() as cur, gzip.open(path, "wb", compresslevel=5) as out:
+        where = _user_filter(cur, users)
+        write_meta(out)
+        stats.profiles = copy_ndjson(
+            cur,
+            f"""
+            select row_to_json(t) from (
+                select 'profile' as kind, user_id, persona, preferences, style, language, updated_at,
+                       watermark_at, watermark_id
+                from user_profiles{where}
+            ) t
+            """,
+            out,
+            "profiles",
+            progress,
+            progress_every,
+        )
+        stats.items = copy_ndjson(
+            cur,
+            f"""
+            select row_to_json(t) from (
+                select 'item' as kind, id, user_id, role, text, tags, created_at
+                from memory_items{where}
+            ) t
+            """,
+            out,
+            "items",
+            progress,
+            progress_every,
+        )
+    stats.elapsed_sec = time.monotonic() - started
+    return stats
+
+
+def _copy_escape(line: str) -> str:
+    # The staging column is read in COPY text format: only backslashes need
+    # doubling, JSON lines carry no raw tabs or newlines.
+    return line.replace("\\", "\\\\")
+
+
+_MERGE_PROFILES = """
+    insert into user_profiles (user_id, persona, preferences, style, language, updated_at, watermark_at, watermark_id)
+    select doc->>'user_id', doc->>'persona', doc->>'preferences', doc->>'style', doc->>'language',
+           coalesce((doc->>'updated_at')::timestamptz, now()),
+           (doc->>'watermark_at')::timestamptz, (doc->>'watermark_id')::uuid
+    from turion_import
+    where doc->>'kind' = 'profile'
+    on conflict (user_id) do update set
+        persona = excluded.persona,
+        preferences = excluded.preferences,
+        style = excluded.style,
+        language = excluded.language,
+        updated_at = excluded.updated_at,
+        watermark_at = excluded.watermark_at,
+        watermark_id = excluded.watermark_id
+    where user_profiles.updated_at is null or user_profiles.updated_at <= excluded.updated_at
+"""
+
+# "on conflict do nothing" without a target keeps re-imports idempotent on
+# whatever unique key memory_items has.
+_MERGE_ITEMS = """
+    insert into memory_items (id, user_id, role, text, tags, created_at)
+    select (doc->>'id')::uuid, doc->>'user_id', doc->>'role', doc->>'text',
+           coalesce(array(select jsonb_array_elements_text(doc->'tags')), '{}'),
+           coalesce((doc->>'created_at')::timestamptz, now())
+    from turion_import
+    where doc->>'kind' = 'item'
+    on conflict do nothing
+"""
+
+
+def import_memory(
+    conn: psycopg2.extensions.connection,
+    path: str,
+    chunk_rows: int = 20_000,
+    progress: Progress | None = None,
+) -> TransferStats:
+    # Lines are staged chunk by chunk in a temp jsonb table via COPY and merged
+    # from there; each chunk commits on its own so an interrupted import can
+    # simply be re-run.
+    started = time.monotonic()
+    stats = TransferStats()
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("create temp table if not exists turion_import (doc jsonb not null) on commit delete rows")
+            conn.commit()
+            with gzip.open(path, "rt", encoding="utf-8") as src:
+                header = json.loads(src.readline() or "{}")
+                if header.get("kind") != "meta" or header.get("version") != FORMAT_VERSION:
+                    raise ValueError(f"{path}: formato de exportação desconhecido")
+                buf = io.StringIO()
+                rows = 0
+                for line in src:
+                    if not line.strip():
+                        continue
+                    buf.write(_copy_escape(line.rstrip("\n")) + "\n")
+                    rows += 1
+                    if rows >= chunk_rows:
+                        _merge_chunk(conn, cur, buf, rows, stats, progress)
+                        buf = io.StringIO()
+                        rows = 0
+                if rows:
+                    _merge_chunk(conn, cur, buf, rows, stats, progress)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = autocommit
+    stats.elapsed_sec = time.monotonic() - started
+    return stats
+
+
+def _merge_chunk(conn, cur, buf: io.StringIO, rows: int, stats: TransferStats, progress: Progress | None) -> None:
+    buf.seek(0)
+    cur.copy_expert("copy turion_import (doc) from stdin", buf)
+    cur.execute(_MERGE_PROFILES)
+    profiles = cur.rowcount
+    cur.execute(_MERGE_ITEMS)
+    items = cur.rowcount
+    conn.commit()
+    stats.profiles += profiles
+    stats.items += items
+    # Rows already present (or older profiles) are left alone.
+    stats.skipped += rows - profiles - items
+    if progress:
+        progress("rows", stats.profiles + stats.items)
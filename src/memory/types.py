@@ -4,7 +4,7 @@ from dataclasses import dataclass, field
 from datetime import datetime
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class MemoryItem:
     id: str
     user_id: str
@@ -22,3 +22,6 @@ class UserProfile:
     style: str | None = None
     language: str | None = None
     updated_at: datetime | None = None
+    # (created_at, id) of the newest message profile maintenance has read.
+    watermark_at: datetime | None = None
+    watermark_id: str | None = None
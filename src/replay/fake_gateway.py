@@ -0,0 +1,173 @@
+﻿from __future__ import annotations
+
+import asyncio
+import base64
+import hashlib
+import json
+import struct
+import threading
+import time
+from typing import Any, Callable
+
+# Stand-in for gateway/server.js: websocket /events plus an HTTP /send sink.
+# Only the stdlib is used so it runs anywhere the agent runs.
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def _frame(opcode: int, payload: bytes) -> bytes:
+    n = len(payload)
+    if n < 126:
+        header = struct.pack(">BB", 0x80 | opcode, n)
+    elif n < 65536:
+        header = struct.pack(">BBH", 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack(">BBQ", 0x80 | opcode, 127, n)
+    return header + payload
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> tuple[int, bytes]:
+    b1, b2 = await reader.readexactly(2)
+    n = b2 & 0x7F
+    if n == 126:
+        (n,) = struct.unpack(">H", await reader.readexactly(2))
+    elif n == 127:
+        (n,) = struct.unpack(">Q", await reader.readexactly(8))
+    mask = await reader.readexactly(4) if b2 & 0x80 else b""
+    data = await reader.readexactly(n)
+    if mask:
+        data = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+    return b1 & 0x0F, data
+
+
+class FakeGateway:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.host = host
+        self.port = port
+        self.sent: list[tuple[float, str, str]] = []
+        self.on_send: Callable[[str, str], None] | None = None
+        self.connected = threading.Event()
+        self._clients: set[asyncio.StreamWriter] = set()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._server: asyncio.base_events.Server | None = None
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self) -> None:
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,), daemon=True, name="fake-gateway")
+        self._thread.start()
+        ready.wait()
+
+    def stop(self) -> None:
+        if self._loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result(timeout=5)
+        except Exception:
+            pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    async def _shutdown(self) -> None:
+        if self._server is not None:
+            self._server.close()
+        for writer in list(self._clients):
+            writer.write(_frame(0x8, struct.pack(">H", 1001)))
+            writer.close()
+        # Let the handlers see EOF and finish before the loop stops.
+        current = asyncio.current_task()
+        tasks = [t for t in asyncio.all_tasks() if t is not current]
+        if tasks:
+            await asyncio.wait(tasks, timeout=1)
+
+    def _run(self, ready: threading.Event) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        ready.set()
+        self._loop.run_forever()
+        self._loop.close()
+
+    def push(self, event: dict[str, Any]) -> None:
+        assert self._loop is not None
+        frame = _frame(0x1, json.dumps(event).encode("utf-8"))
+        self._loop.call_soon_threadsafe(self._broadcast, frame)
+
+    def _broadcast(self, frame: bytes) -> None:
+        for writer in list(self._clients):
+            writer.write(frame)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = (await reader.readline()).decode("latin-1")
+            headers: dict[str, str] = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1")
+                if line in ("\r\n", "\n", ""):
+                    break
+                key, _, value = line.partition(":")
+                headers[key.strip().lower()] = value.strip()
+            method, target, _ = request_line.split(" ", 2)
+            path = target.split("?", 1)[0]
+            if path == "/events" and headers.get("upgrade", "").lower() == "websocket":
+                await self._websocket(reader, writer, headers)
+                return
+            body = await reader.readexactly(int(headers.get("content-length", "0") or "0"))
+            status, payload = self._route(method, path, body)
+            raw = json.dumps(payload).encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(raw)}\r\nConnection: close\r\n\r\n".encode("latin-1") + raw
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _route(self, method: str, path: str, body: bytes) -> tuple[str, dict[str, Any]]:
+        if method == "POST" and path == "/send":
+            data = json.loads(body or b"{}")
+            to, text = data.get("to", ""), data.get("text", "")
+            if not to or not text:
+                return "400 Bad Request", {"error": "missing to/text"}
+            self.sent.append((time.perf_counter(), to, text))
+            if self.on_send:
+                self.on_send(to, text)
+            return "200 OK", {"ok": True}
+        if method == "GET" and path == "/health":
+            return "200 OK", {"ok": True}
+        if method == "GET" and path == "/status":
+            return "200 OK", {"status": "connected"}
+        if method == "GET" and path == "/qr":
+            return "200 OK", {"qr": None}
+        return "404 Not Found", {"error": "not found"}
+
+    async def _websocket(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, headers: dict[str, str]) -> None:
+        digest = hashlib.sha1((headers.get("sec-websocket-key", "") + WS_GUID).encode("latin-1")).digest()
+        writer.write(
+            b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            b"Sec-WebSocket-Accept: " + base64.b64encode(digest) + b"\r\n\r\n"
+        )
+        await writer.drain()
+        self._clients.add(writer)
+        self.connected.set()
+        try:
+            while True:
+                opcode, data = await _read_frame(reader)
+                if opcode == 0x8:
+                    writer.write(_frame(0x8, data[:2]))
+                    break
+                if opcode == 0x9:
+                    writer.write(_frame(0xA, data))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._clients.discard(writer)
+            if not self._clients:
+                self.connected.clear()
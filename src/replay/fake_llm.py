@@ -0,0 +1,118 @@
+﻿from __future__ import annotations
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from adapters.cache import request_key
+from adapters.grok import LLMRequest
+from replay.recorder import read_recording
+
+
+class FakeLLM:
+    # Answers the GrokClient JSON protocol after a configurable delay. Requests
+    # seen in a recording get the recorded answer, anything else is echoed.
+    # fail_rate answers that share of requests with a 503, for failover runs.
+    def __init__(
+        self,
+        latency_ms: float = 200.0,
+        jitter_ms: float = 0.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        fail_rate: float = 0.0,
+    ) -> None:
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.fail_rate = fail_rate
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.responses: dict[str, str] = {}
+        self._prefixes: set[str] = set()
+        self._server: ThreadingHTTPServer | None = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def load(self, path: str | Path) -> int:
+        for record in read_recording(path):
+            if record.get("kind") == "llm":
+                req = LLMRequest(**record["request"])
+                self.responses[request_key(req)] = record["response"].get("text", "")
+        return len(self.responses)
+
+    def _usage(self, payload: dict) -> dict:
+        # Mimics a provider prefix cache: a system prompt seen before counts
+        # as cached tokens (whitespace-split words stand in for tokens).
+        system = payload.get("system", "")
+        system_tokens = len(system.split())
+        prompt_tokens = system_tokens + len(payload.get("context", "").split()) + len(payload.get("user", "").split())
+        key = payload.get("prompt_cache_key") or system
+        cached = system_tokens if key in self._prefixes else 0
+        self._prefixes.add(key)
+        return {"prompt_tokens": prompt_tokens, "prompt_tokens_details": {"cached_tokens": cached}}
+
+    def _answer(self, payload: dict) -> str:
+        req = LLMRequest(
+            system=payload.get("system", ""),
+            user=payload.get("user", ""),
+            context=payload.get("context", ""),
+            max_tokens=int(payload.get("max_tokens", 2000)),
+        )
+        return self.responses.get(request_key(req)) or f"eco: {req.user}"
+
+    def start(self) -> None:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                body = self.rfile.read(int(self.headers.get("content-length", "0") or "0"))
+                fake.requests += 1
+                delay = fake.latency_ms + random.uniform(-fake.jitter_ms, fake.jitter_ms)
+                time.sleep(max(delay, 0.0) / 1000)
+                if fake.fail_rate and random.random() < fake.fail_rate:
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                payload = json.loads(body or b"{}")
+                if payload.get("stream"):
+                    self._stream(payload)
+                    return
+                raw = json.dumps(
+                    {"text": fake._answer(payload), "confidence": 0.9, "usage": fake._usage(payload)}
+                ).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+            def _stream(self, payload: dict) -> None:
+                # One event per word, spread over another latency_ms.
+                words = fake._answer(payload).split(" ")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for i, word in enumerate(words):
+                    delta = word if i == 0 else " " + word
+                    self.wfile.write(f"data: {json.dumps({'text': delta})}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                    time.sleep(fake.latency_ms / 1000 / len(words))
+                self.wfile.write(b"data: [DONE]\n\n")
+
+            def log_message(self, format: str, *args) -> None:
+                return
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True, name="fake-llm").start()
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
@@ -0,0 +1,158 @@
+﻿from __future__ import annotations
+
+import dataclasses
+import itertools
+import threading
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterator
+
+from config.settings import Settings
+from replay.fake_gateway import FakeGateway
+from replay.fake_llm import FakeLLM
+from replay.recorder import read_recording
+
+
+@dataclass
+class ReplayReport:
+    pushed: int = 0
+    replied: int = 0
+    wall_sec: float = 0.0
+    latencies_ms: list[float] = field(default_factory=list)
+    # llm_failover/llm_hedged/llm_hedge_won, filled when replaying against a pool.
+    pool_counters: dict[str, int] = field(default_factory=dict)
+
+    def percentile(self, q: float) -> float:
+        if not self.latencies_ms:
+            return 0.0
+        ordered = sorted(self.latencies_ms)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def lines(self) -> list[str]:
+        throughput = self.replied / self.wall_sec if self.wall_sec else 0.0
+        return [
+            f"mensagens enviadas: {self.pushed}",
+            f"respostas recebidas: {self.replied}",
+            f"tempo total: {self.wall_sec:.2f}s",
+            f"throughput: {throughput:.2f} msg/s",
+            f"latência p50: {self.percentile(0.50):.1f}ms",
+            f"latência p95: {self.percentile(0.95):.1f}ms",
+            f"latência p99: {self.percentile(0.99):.1f}ms",
+            f"latência máx: {max(self.latencies_ms, default=0.0):.1f}ms",
+        ] + [f"{name}: {count}" for name, count in self.pool_counters.items()]
+
+
+def recorded_traffic(path: str | Path) -> Iterator[tuple[float, dict[str, Any]]]:
+    start: float | None = None
+    for record in read_recording(path):
+        if record.get("kind") != "event" or record["payload"].get("type") != "message":
+            continue
+        if start is None:
+            start = record["at"]
+        yield record["at"] - start, record["payload"]
+
+
+def synthetic_traffic(count: int, rate: float, users: int) -> Iterator[tuple[float, dict[str, Any]]]:
+    phrases = itertools.cycle(
+        [
+            "Oi, tudo bem?",
+            "Preciso de ajuda com meu pedido",
+            "What time do you open tomorrow?",
+            "Pode me lembrar da reunião amanhã?",
+            "Thanks, that helps a lot",
+        ]
+    )
+    for i in range(count):
+        yield i / rate, {
+            "type": "message",
+            "id": f"synthetic-{i}",
+            "from": f"55110000{i % users:04d}@s.whatsapp.net",
+            "text": f"{next(phrases)} #{i}",
+        }
+
+
+def run_replay(
+    settings: Settings,
+    traffic: Iterator[tuple[float, dict[str, Any]]],
+    speed: float = 1.0,
+    llm: FakeLLM | None = None,
+    use_db: bool = False,
+    timeout_sec: float = 60.0,
+    pool: list[FakeLLM] | None = None,
+) -> ReplayReport:
+    from core.runtime import AgentRuntime
+
+    llm = llm or FakeLLM()
+    llm.start()
+    for endpoint in pool or ():
+        endpoint.start()
+    gateway = FakeGateway()
+    gateway.start()
+
+    pending: dict[str, deque[float]] = defaultdict(deque)
+    report = ReplayReport()
+    done = threading.Condition()
+
+    def _on_send(to: str, text: str) -> None:
+        now = time.perf_counter()
+        with done:
+            if pending[to]:
+                report.latencies_ms.append((now - pending[to].popleft()) * 1000)
+            report.replied += 1
+            done.notify_all()
+
+    gateway.on_send = _on_send
+
+    replay_settings = dataclasses.replace(
+        settings,
+        llm_provider="grok",
+        llm_api_base=llm.url,
+        llm_api_key="replay",
+        llm_cache_path=None,
+        whatsapp_gateway_url=gateway.url,
+        whatsapp_api_key=None,
+        event_log_dir=None,
+        record_path=None,
+        db_password=settings.db_password if use_db else None,
+    )
+    if pool:
+        # Every turn goes through ProviderPool; hedging needs generate(), so
+        # no streaming, and fires as soon as the primary passes its own p95.
+        replay_settings = dataclasses.replace(
+            replay_settings,
+            llm_endpoints=tuple((endpoint.url, 1.0, None) for endpoint in pool),
+            llm_hedge=True,
+            llm_hedge_min_ms=0,
+            reply_streaming=False,
+        )
+    runtime = AgentRuntime.start(replay_settings)
+    try:
+        if not gateway.connected.wait(timeout=10):
+            raise RuntimeError("agente não conectou ao gateway falso")
+        started = time.perf_counter()
+        for offset, payload in traffic:
+            delay = started + offset / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            with done:
+                pending[payload.get("from", "")].append(time.perf_counter())
+                report.pushed += 1
+            gateway.push(payload)
+        deadline = time.perf_counter() + timeout_sec
+        with done:
+            while report.replied < report.pushed and time.perf_counter() < deadline:
+                done.wait(timeout=0.5)
+        report.wall_sec = time.perf_counter() - started
+        if pool:
+            # stats() also merges the counters of supervisor workers.
+            counters = runtime.stats().get("counters", {})
+            report.pool_counters = {name: counters.get(name, 0) for name in ("llm_failover", "llm_hedged", "llm_hedge_won")}
+    finally:
+        runtime.stop()
+        gateway.stop()
+        llm.stop()
+        for endpoint in pool or ():
+            endpoint.stop()
+    return report
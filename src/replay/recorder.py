@@ -0,0 +1,83 @@
+﻿from __future__ import annotations
+
+import json
+import threading
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, ClassVar, Iterator
+
+from adapters.grok import LLMClient, LLMRequest, LLMResponse
+
+
+class Recorder:
+    # One instance per file, shared by the gateway and the LLM wrapper so their
+    # lines never interleave.
+    _instances: ClassVar[dict[str, "Recorder"]] = {}
+    _instances_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._fh = open(self.path, "a", encoding="utf-8")
+
+    @classmethod
+    def for_path(cls, path: str | Path) -> "Recorder":
+        key = str(Path(path).resolve())
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(path)
+            return cls._instances[key]
+
+    def _write(self, record: dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            self._fh.write(line)
+            self._fh.flush()
+
+    def record_event(self, payload: dict[str, Any]) -> None:
+        self._write({"kind": "event", "at": time.time(), "payload": payload})
+
+    def record_llm(self, req: LLMRequest, resp: LLMResponse, latency_ms: float) -> None:
+        self._write(
+            {
+                "kind": "llm",
+                "at": time.time(),
+                "request": asdict(req),
+                "response": asdict(resp),
+                "latency_ms": round(latency_ms, 2),
+            }
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._fh.close()
+
+
+@dataclass
+class RecordingLLM:
+    client: LLMClient
+    recorder: Recorder
+
+    def generate(self, req: LLMRequest) -> LLMResponse:
+        started = time.perf_counter()
+        resp = self.client.generate(req)
+        self.recorder.record_llm(req, resp, (time.perf_counter() - started) * 1000)
+        return resp
+
+    def stream(self, req: LLMRequest) -> Iterator[str]:
+        started = time.perf_counter()
+        parts = []
+        for delta in self.client.stream(req):
+            parts.append(delta)
+            yield delta
+        self.recorder.record_llm(req, LLMResponse(text="".join(parts)), (time.perf_counter() - started) * 1000)
+
+
+def read_recording(path: str | Path) -> Iterator[dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
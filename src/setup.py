@@ -10,11 +10,8 @@ from dataclasses import dataclass
 from typing import Optional
 
 import requests
-import segno
-import websockets
 
 from config.settings import Settings
-from memory.store import MemoryConfig, MemoryService
 from memory.types import UserProfile
 
 
@@ -41,6 +38,8 @@ def _ask(prompt: str, default: str | None = None) -> str:
 
 
 def _render_qr(qr_text: str) -> None:
+    import segno
+
     qr = segno.make(qr_text)
     print(qr.terminal(compact=True))
 
@@ -63,6 +62,8 @@ def _wait_for_connected() -> None:
 
 
 async def _listen_events(gateway_url: str, api_key: str | None) -> bool:
+    import websockets
+
     ws_url = gateway_url.replace("http://", "ws://").replace("https://", "wss://")
     ws_url = f"{ws_url}/events"
     headers = {}
@@ -231,6 +232,8 @@ def _run_qr_flow(settings: Settings) -> bool:
 
 
 def _save_profile(settings: Settings, answers: SetupAnswers) -> None:
+    from memory.store import MemoryConfig, MemoryService
+
     memory = MemoryService(
         MemoryConfig(
             host=settings.db_host,
@@ -239,6 +242,7 @@ def _save_profile(settings: Settings, answers: SetupAnswers) -> None:
             user=settings.db_user,
             password=settings.db_password,
             cache_ttl_sec=settings.memory_cache_ttl_sec,
+            notify=settings.memory_notify,
         )
     )
 